@@ -32,6 +32,7 @@ from xml.etree import ElementTree
 
 import libbe
 import libbe.comment as comment
+import libbe.storage.util.index
 import libbe.storage.util.mapfile as mapfile
 import libbe.storage.util.settings_object as settings_object
 import libbe.util.id
@@ -227,7 +228,18 @@ class Bug(settings_object.SavedSettingsObject):
 
     def _get_comment_root(self, load_full=False):
         if self.storage != None and self.storage.is_readable():
-            return comment.load_comments(self, load_full=load_full)
+            values = self._comment_values
+            self._comment_values = None
+            if values is not None:
+                return comment.load_comments(
+                    self, load_full=load_full, values=values)
+            loaded = {}
+            comment_root = comment.load_comments(
+                self, load_full=load_full, loaded=loaded)
+            snapshot = getattr(self.bugdir, 'snapshot', None)
+            if snapshot is not None:
+                snapshot.add_comments(self.bugdir.uuid, self.uuid, loaded)
+            return comment_root
         else:
             return comment.Comment(self, uuid=comment.INVALID_UUID)
 
@@ -244,6 +256,7 @@ class Bug(settings_object.SavedSettingsObject):
         self.storage = None
         self.uuid = uuid
         self.id = libbe.util.id.ID(self, 'bug')
+        self._comment_values = None  # see BugDir.load_snapshot()
         if not from_storage:
             if uuid is None:
                 self.uuid = libbe.util.id.uuid_gen()
@@ -754,6 +767,10 @@ class Bug(settings_object.SavedSettingsObject):
     def save_settings(self):
         json_map = mapfile.generate(self._get_saved_settings())
         self.storage.set(self.id.storage('values'), json_map)
+        if self.bugdir is not None:
+            bug_index = libbe.storage.util.index.get_index(self.storage)
+            if bug_index is not None:
+                bug_index.update(self, json_map)
 
     def save(self):
         """
@@ -24,6 +24,7 @@
 """Define :py:class:`BugDir` for storing a collection of bugs.
 """
 
+import contextlib
 import copy
 import errno
 import os
@@ -40,7 +41,9 @@ from libbe.storage.util.properties import Property, doc_property, \
     fn_checked_property, cached_property, primed_property, \
     change_hook_property, settings_property
 import libbe.storage.util.settings_object as settings_object
+import libbe.storage.util.index
 import libbe.storage.util.mapfile as mapfile
+import libbe.storage.util.snapshot
 import libbe.bug as bug
 import libbe.util.utility as utility
 import libbe.util.id
@@ -159,12 +162,16 @@ class BugDir (list, settings_object.SavedSettingsObject):
     @doc_property(doc="A dict of (bug-uuid, bug-instance) pairs.")
     def _bug_map(): return {}
 
-    def __init__(self, storage, uuid=None, from_storage=False):
+    def __init__(self, storage, uuid=None, from_storage=False,
+                 snapshot=None):
         list.__init__(self)
         settings_object.SavedSettingsObject.__init__(self)
         self.storage = storage
         self.id = libbe.util.id.ID(self, 'bugdir')
         self.uuid = uuid
+        self._snapshot = None  # this bugdir's data, see load_snapshot()
+        # a Snapshot shared by the command, see load_all_bugs()
+        self._shared_snapshot = self.snapshot = snapshot
         if from_storage == True:
             if self.uuid == None:
                 self.uuid = [c for c in self.storage.children()
@@ -198,10 +205,94 @@ class BugDir (list, settings_object.SavedSettingsObject):
     def load_all_bugs(self):
         """
         Warning: this could take a while.
+
+        Bugs are loaded from a snapshot (see
+        :py:mod:`libbe.storage.util.snapshot`) when there is a current
+        one, and a new snapshot is saved otherwise.  A BugDir created
+        with a `snapshot` shares it with the rest of the command, so
+        the snapshot key is computed at most once; otherwise each call
+        starts afresh.
         """
         self._clear_bugs()
-        for uuid in self.uuids():
-            self._load_bug(uuid)
+        if self.storage == None or not self.storage.is_readable():
+            bugs = [bug.Bug(bugdir=self, uuid=uuid, from_storage=True)
+                    for uuid in self.uuids()]
+        else:
+            if self._shared_snapshot is None:
+                if self.snapshot is not None:
+                    self.snapshot.flush()
+                self.snapshot = libbe.storage.util.snapshot.Snapshot(
+                    self.storage)
+            data = self.snapshot.load()
+            if data is not None and self.uuid in data:
+                self.load_snapshot(data[self.uuid])
+                bugs = []
+                for uuid in self.uuids():
+                    bg = bug.Bug(bugdir=self, uuid=uuid, from_storage=True)
+                    values, bg._comment_values = self._snapshot[uuid]
+                    bg.load_settings(values)
+                    bugs.append(bg)
+            else:
+                bugs = [bug.Bug(bugdir=self, uuid=uuid, from_storage=True)
+                        for uuid in self.uuids()]
+                # fetch all the settings in a single storage request
+                results = self.storage.read_many(
+                    [('get', bg.id.storage('values')) for bg in bugs])
+                snapshot = {}
+                for bg, value in zip(bugs, results):
+                    if value is None:
+                        value = '{}\n'
+                    bg.load_settings(value)
+                    # comment values are added as they are loaded
+                    snapshot[bg.uuid] = [value, None]
+                self.snapshot.save(self.uuid, snapshot)
+        for bg in bugs:
+            self.append(bg)
+        self._bug_map_gen()
+
+    def load_snapshot(self, snapshot):
+        """
+        Load bugs from `snapshot` (see :py:mod:`libbe.storage.util.snapshot`)
+        instead of reading them from storage.  The snapshot is dropped
+        the next time the bugs are cleared.
+        """
+        self._snapshot = snapshot
+        if hasattr(self, '_uuids_cache'):
+            del(self._uuids_cache)
+
+    @contextlib.contextmanager
+    def batch(self):
+        """
+        Buffer storage writes made inside a `with` block, and flush
+        them once at the end.  See
+        :py:meth:`libbe.storage.base.Storage.transaction`.  Changes
+        to the bug index (see :py:mod:`libbe.storage.util.index`) are
+        committed once as well.
+
+        >>> bugdir = SimpleBugDir(memory=False)
+        >>> with bugdir.batch():
+        ...     bug = bugdir.new_bug(summary='New bug')
+        ...     bug.status = 'fixed'
+        ...     bug.severity = 'minor'
+        >>> values = bugdir.storage.get(bug.id.storage('values'))
+        >>> '"status": "fixed"' in values
+        True
+        >>> '"severity": "minor"' in values
+        True
+        >>> bugdir.cleanup()
+        """
+        if self.storage is None or not self.storage.is_writeable():
+            yield self
+            return
+        bug_index = libbe.storage.util.index.get_index(self.storage)
+        if bug_index is None:
+            with self.storage.transaction():
+                yield self
+        else:
+            # commit the index once, after the storage is flushed
+            with bug_index.batch():
+                with self.storage.transaction():
+                    yield self
 
     def save(self):
         """
@@ -232,8 +323,10 @@ class BugDir (list, settings_object.SavedSettingsObject):
 
     def _refresh_uuid_cache(self):
         self._uuids_cache = set()
+        if self._snapshot is not None:
+            self._uuids_cache.update(self._snapshot.keys())
         # list bugs that are in storage
-        if self.storage != None and self.storage.is_readable():
+        elif self.storage != None and self.storage.is_readable():
             child_uuids = libbe.util.id.child_uuids(
                 self.storage.children(self.id.storage()))
             for id in child_uuids:
@@ -244,10 +337,16 @@ class BugDir (list, settings_object.SavedSettingsObject):
             self.pop()
         if hasattr(self, '_uuids_cache'):
             del(self._uuids_cache)
+        self._snapshot = None
         self._bug_map_gen()
 
-    def _load_bug(self, uuid):
+    def _load_bug(self, uuid, settings_mapfile=None):
         bg = bug.Bug(bugdir=self, uuid=uuid, from_storage=True)
+        if (settings_mapfile is None and self._snapshot is not None
+                and uuid in self._snapshot):
+            settings_mapfile, bg._comment_values = self._snapshot[uuid]
+        if settings_mapfile is not None:
+            bg.load_settings(settings_mapfile)
         self.append(bg)
         self._bug_map_gen()
         return bg
@@ -274,14 +373,22 @@ class BugDir (list, settings_object.SavedSettingsObject):
         self.remove(bug)
         if self.storage != None and self.storage.is_writeable():
             bug.remove()
+            bug_index = libbe.storage.util.index.get_index(self.storage)
+            if bug_index is not None:
+                bug_index.remove(self.uuid, bug.uuid)
 
-    def bug_from_uuid(self, uuid):
+    def bug_from_uuid(self, uuid, settings_mapfile=None):
+        """
+        Return the bug with the given `uuid`, loading it from storage
+        if necessary.  If `settings_mapfile` is given, it is used
+        instead of the bug's stored ``values``.
+        """
         if not self.has_bug(uuid):
             raise NoBugMatches(
                 uuid, self.uuids(),
                 'No bug matches %s in %s' % (uuid, self.storage))
         if self._bug_map[uuid] == None:
-            self._load_bug(uuid)
+            self._load_bug(uuid, settings_mapfile)
         return self._bug_map[uuid]
 
     def has_bug(self, bug_uuid):
@@ -678,40 +785,7 @@ class RevisionedBugDir (BugDir):
         storage_version = bugdir.storage.storage_version(revision)
         if storage_version != libbe.storage.STORAGE_VERSION:
             raise libbe.storage.InvalidStorageVersion(storage_version)
-        s = copy.deepcopy(bugdir.storage)
-        s.writeable = False
-        class RevisionedStorage (object):
-            def __init__(self, storage, default_revision):
-                self.s = storage
-                self.sget = self.s.get
-                self.sancestors = self.s.ancestors
-                self.schildren = self.s.children
-                self.schanged = self.s.changed
-                self.r = default_revision
-            def get(self, *args, **kwargs):
-                if not 'revision' in kwargs or kwargs['revision'] == None:
-                    kwargs['revision'] = self.r
-                return self.sget(*args, **kwargs)
-            def ancestors(self, *args, **kwargs):
-                print 'getting ancestors', args, kwargs
-                if not 'revision' in kwargs or kwargs['revision'] == None:
-                    kwargs['revision'] = self.r
-                ret = self.sancestors(*args, **kwargs)
-                print 'got ancestors', ret
-                return ret
-            def children(self, *args, **kwargs):
-                if not 'revision' in kwargs or kwargs['revision'] == None:
-                    kwargs['revision'] = self.r
-                return self.schildren(*args, **kwargs)
-            def changed(self, *args, **kwargs):
-                if not 'revision' in kwargs or kwargs['revision'] == None:
-                    kwargs['revision'] = self.r
-                return self.schanged(*args, **kwargs)
-        rs = RevisionedStorage(s, revision)
-        s.get = rs.get
-        s.ancestors = rs.ancestors
-        s.children = rs.children
-        s.changed = rs.changed
+        s = bugdir.storage.revision_storage(revision)
         BugDir.__init__(self, s, from_storage=True)
         self.revision = revision
     def changed(self):
@@ -28,6 +28,7 @@ import urlparse
 import libbe
 import libbe.storage
 import libbe.storage.util.mapfile
+import libbe.storage.util.snapshot
 import libbe.ui.util.user
 import libbe.util.encoding
 import libbe.util.http
@@ -559,11 +560,15 @@ class StorageCallbacks (object):
         """Callback for use by commands that need it."""
         if not hasattr(self, '_bugdirs'):
             storage = self.get_storage()
+            # one snapshot for the whole command; its key is only
+            # computed if some bugdir loads all its bugs
+            self._snapshot = libbe.storage.util.snapshot.Snapshot(storage)
             self._bugdirs = dict(
                 (uuid, libbe.bugdir.BugDir(
                         storage=storage,
                         uuid=uuid,
-                        from_storage=True))
+                        from_storage=True,
+                        snapshot=self._snapshot))
                 for uuid in storage.children())
         return self._bugdirs
 
@@ -571,6 +576,8 @@ class StorageCallbacks (object):
         self._bugdirs = bugdirs
 
     def cleanup(self):
+        if hasattr(self, '_snapshot'):
+            self._snapshot.flush()
         if hasattr(self, '_storage'):
             self._storage.disconnect()
 
@@ -162,8 +162,9 @@ class Import_XML (libbe.command.Command):
 
         # save new information
         storage.writeable = writeable
-        for item in dirty_items:
-            item.save()
+        with storage.transaction():
+            for item in dirty_items:
+                item.save()
 
     def _read_xml(self, storage, params):
         if params['xml-file'] == '-':
@@ -32,6 +32,7 @@ from libbe.command.depend import Filter, parse_status, parse_severity
 import libbe.command.tag
 import libbe.command.target
 import libbe.command.util
+import libbe.storage.util.index
 
 # get a list of * for cmp_*() comparing two bugs.
 AVAILABLE_CMPS = [fn[4:] for fn in dir(libbe.bug) if fn[:4] == 'cmp_']
@@ -134,9 +135,16 @@ class List (libbe.command.Command):
             self._parse_params(bugdirs, params)
         filter = Filter(status, severity, assigned,
                         extra_strings_regexps=extra_strings_regexps)
-        bugs = list(itertools.chain(*list(
-                    [bugdir.bug_from_uuid(uuid) for uuid in bugdir.uuids()]
-                    for bugdir in bugdirs.values())))
+        bug_index = libbe.storage.util.index.get_index(storage)
+        if bug_index is None:
+            for bugdir in bugdirs.values():
+                if bugdir.storage is not None:
+                    bugdir.load_all_bugs()
+            bugs = list(itertools.chain(*list(
+                        [bugdir.bug_from_uuid(uuid) for uuid in bugdir.uuids()]
+                        for bugdir in bugdirs.values())))
+        else:
+            bugs = self._indexed_bugs(bug_index, bugdirs, filter)
         bugs = [b for b in bugs if filter(bugdirs, b) == True]
         self.result = bugs
         if len(bugs) == 0 and params['xml'] == False:
@@ -154,6 +162,20 @@ class List (libbe.command.Command):
         storage.writeable = writeable
         return 0
 
+    def _indexed_bugs(self, bug_index, bugdirs, filter):
+        """Select bugs using the :py:mod:`~libbe.storage.util.index`,
+        only loading the bugs that match `filter`.
+        """
+        bugs = []
+        for bugdir in bugdirs.values():
+            bug_index.refresh(bugdir)
+            for row in bug_index.select(bugdir.uuid, status=filter.status,
+                                        severity=filter.severity):
+                if filter(bugdirs, row) == True:
+                    bugs.append(bugdir.bug_from_uuid(
+                            row.uuid, settings_mapfile=row.settings))
+        return bugs
+
     def _parse_params(self, bugdirs, params):
         cmp_list = []
         if params['sort'] != None:
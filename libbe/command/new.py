@@ -144,7 +144,8 @@ class New (libbe.command.Command):
         if params['severity'] != None:
             bug.severity = params['severity']
         storage.writeable = True
-        bug.save()
+        with bugdir.batch():
+            bug.save()
         if params['full-uuid']:
             bug_id = bug.id.long_user()
         else:
@@ -0,0 +1,91 @@
+# Copyright (C) 2026 agent <agent@local>
+#
+# This file is part of Bugs Everywhere.
+#
+# Bugs Everywhere is free software: you can redistribute it and/or modify it
+# under the terms of the GNU General Public License as published by the Free
+# Software Foundation, either version 2 of the License, or (at your option) any
+# later version.
+#
+# Bugs Everywhere is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+# FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General Public License for
+# more details.
+#
+# You should have received a copy of the GNU General Public License along with
+# Bugs Everywhere.  If not, see <http://www.gnu.org/licenses/>.
+
+import libbe
+import libbe.command
+import libbe.storage.util.index
+
+
+class Reindex (libbe.command.Command):
+    """(Re)build the bug index used to speed up queries
+
+    >>> import sys
+    >>> import libbe.bugdir
+    >>> import libbe.command.list
+    >>> import libbe.storage.vcs.base
+    >>> import libbe.util.utility
+    >>> dir = libbe.util.utility.Dir()
+    >>> storage = libbe.storage.vcs.base.VCS(repo=dir.path)
+    >>> storage.init()
+    >>> storage.connect()
+    >>> bd = libbe.bugdir.BugDir(storage, uuid='abc123')
+    >>> bug = bd.new_bug(summary='Bug A', _uuid='a')
+    >>> io = libbe.command.StringInputOutput()
+    >>> io.stdout = sys.stdout
+    >>> ui = libbe.command.UserInterface(io=io)
+    >>> ui.storage_callbacks.set_storage(storage)
+    >>> ui.storage_callbacks.set_bugdirs({bd.uuid: bd})
+    >>> cmd = Reindex(ui=ui)
+
+    >>> ret = ui.run(cmd)
+    Indexed 1 bug
+    >>> bug = bd.new_bug(summary='Bug B', _uuid='b')
+    >>> ret = ui.run(libbe.command.list.List(ui=ui))
+    abc/a:om: Bug A
+    abc/b:om: Bug B
+    >>> ret = ui.run(cmd, {'remove':True})
+    >>> libbe.storage.util.index.get_index(storage)
+    >>> ui.cleanup()
+    >>> storage.destroy()
+    >>> dir.cleanup()
+    """
+    name = 'reindex'
+
+    def __init__(self, *args, **kwargs):
+        libbe.command.Command.__init__(self, *args, **kwargs)
+        self.options.extend([
+                libbe.command.Option(name='remove', short_name='r',
+                    help='Remove the index instead of rebuilding it'),
+                ])
+
+    def _run(self, **params):
+        storage = self._get_storage()
+        if libbe.storage.util.index.index_path(storage) is None:
+            raise libbe.command.UserError(
+                'Storage %s does not support an index' % storage)
+        if params['remove'] == True:
+            libbe.storage.util.index.remove_index(storage)
+            return 0
+        bugdirs = self._get_bugdirs()
+        bug_index = libbe.storage.util.index.get_index(storage, create=True)
+        bug_index.rebuild(bugdirs.values())
+        count = sum(len(bug_index.select(uuid)) for uuid in bugdirs.keys())
+        if count == 1:
+            print >> self.stdout, 'Indexed 1 bug'
+        else:
+            print >> self.stdout, 'Indexed %d bugs' % count
+        return 0
+
+    def _long_help(self):
+        return """
+Build an index of the bug metadata in .be/index.sqlite.  Once the
+index exists, commands like "be list" use it to select bugs instead of
+loading every bug in the repository, and BE keeps it up to date as
+bugs change.  The index is revalidated against the bug files before
+each use, so running this command again is only needed if the index
+is lost or damaged.  Use --remove to stop using the index.
+"""
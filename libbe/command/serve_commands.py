@@ -76,6 +76,8 @@ class ServerApp (libbe.util.wsgi.WSGI_AppObject,
             **kwargs)
         self.storage = storage
         self.ui = libbe.command.base.UserInterface()
+        if storage is not None:
+            self.ui.storage_callbacks.set_storage(storage)
         self.notify = notify
 
     # handlers
@@ -23,6 +23,7 @@ See Also
 :py:mod:`libbe.storage.http` : the associated client
 """
 
+import hashlib
 import logging
 import os.path
 
@@ -51,6 +52,11 @@ if libbe.TESTING:
     import libbe.util.wsgi
 
 
+def _etag(content):
+    """Return the HTTP entity tag for `content`."""
+    return '"{}"'.format(hashlib.sha1(content).hexdigest())
+
+
 class ServerApp (libbe.util.wsgi.WSGI_AppObject,
                  libbe.util.wsgi.WSGI_DataObject):
     """WSGI server for a BE Storage instance over HTTP.
@@ -81,7 +87,10 @@ class ServerApp (libbe.util.wsgi.WSGI_AppObject,
                 (r'^exists/?', self.exists),
                 (r'^remove/?', self.remove),
                 (r'^ancestors/?', self.ancestors),
+                (r'^children-many/?', self.children_many),
                 (r'^children/?', self.children),
+                (r'^get-many/?', self.get_many),
+                (r'^batch/?', self.batch),
                 (r'^get/(.+)', self.get),
                 (r'^set/(.+)', self.set),
                 (r'^commit/?', self.commit),
@@ -154,6 +163,92 @@ class ServerApp (libbe.util.wsgi.WSGI_AppObject,
         content = '\n'.join(self.storage.children(id, revision))
         return self.ok_response(environ, start_response, content)
 
+    def children_many(self, environ, start_response):
+        self.check_login(environ)
+        data = self.post_data(environ)
+        source = 'post'
+        ids = self._data_get_ids(data, source=source)
+        revision = self.data_get_string(
+            data, 'revision', default=None, source=source)
+        children = self.storage.children_many(ids, revision)
+        content = libbe.util.http.encode_frames(
+            [(id or '', '\n'.join(children[id])) for id in ids])
+        return self.ok_response(environ, start_response, content)
+
+    def get_many(self, environ, start_response):
+        self.check_login(environ)
+        data = self.post_data(environ)
+        source = 'post'
+        ids = self._data_get_ids(data, source=source)
+        revision = self.data_get_string(
+            data, 'revision', default=None, source=source)
+        values = self.storage.get_many(ids, default=None, revision=revision)
+        content = libbe.util.http.encode_frames(
+            [(id, values[id]) for id in ids])
+        be_version = self.storage.storage_version(revision)
+        return self.ok_response(environ, start_response, content,
+                                headers=[('X-BE-Version', be_version)])
+
+    def batch(self, environ, start_response):
+        """Answer a list of read operations in one response.
+
+        The `ops` field holds one `OP\tREVISION\tID` or
+        `get\tREVISION\tETAG\tID` line per operation, where `OP` is
+        `get`, `children` or `exists`, and an empty `REVISION` or `ID`
+        stands for `None`.  The response holds one frame per line,
+        keyed by `OP`.  Existing `get` values are keyed by
+        `get ETAG`, or sent as an empty `not-modified` frame if they
+        still match the `ETAG` sent with the request.
+        """
+        self.check_login(environ)
+        data = self.post_data(environ)
+        source = 'post'
+        lines = self.data_get_string(
+            data, 'ops', default=libbe.util.wsgi.HandlerError, source=source)
+        ops = []
+        etags = []
+        for line in lines.split('\n'):
+            fields = line.split('\t')
+            if len(fields) == 3:
+                op,revision,id = fields
+                etag = None
+            elif len(fields) == 4 and fields[0] == 'get':
+                op,revision,etag,id = fields
+            else:
+                raise libbe.util.wsgi.HandlerError(
+                    406, 'Invalid batch operation {!r}'.format(line))
+            ops.append((op, id or None, revision or None))
+            etags.append(etag)
+        try:
+            results = self.storage.read_many(ops)
+        except ValueError, e:
+            raise libbe.util.wsgi.HandlerError(406, str(e))
+        frames = []
+        for (op,id,revision),etag,result in zip(ops, etags, results):
+            if op == 'get' and result is not None:
+                current = _etag(result)
+                if current == etag:
+                    op,result = ('not-modified', '')
+                else:
+                    op = 'get {}'.format(current)
+            elif op == 'children':
+                result = '\n'.join(result)
+            elif op == 'exists':
+                result = str(result)
+            frames.append((op, result))
+        content = libbe.util.http.encode_frames(frames)
+        be_version = self.storage.storage_version()
+        return self.ok_response(environ, start_response, content,
+                                headers=[('X-BE-Version', be_version)])
+
+    def _data_get_ids(self, data, source='query'):
+        """Return the newline-separated `ids` list.  An empty line
+        stands for the root (`None`).
+        """
+        ids = self.data_get_string(
+            data, 'ids', default=libbe.util.wsgi.HandlerError, source=source)
+        return [id or None for id in ids.split('\n')]
+
     def get(self, environ, start_response):
         self.check_login(environ)
         data = self.query_data(environ)
@@ -166,8 +261,15 @@ class ServerApp (libbe.util.wsgi.WSGI_AppObject,
             data, 'revision', default=None, source=source)
         content = self.storage.get(id, revision=revision)
         be_version = self.storage.storage_version(revision)
+        etag = _etag(content)
+        headers = [('X-BE-Version', be_version), ('ETag', etag)]
+        matches = [tag.strip() for tag
+                   in environ.get('HTTP_IF_NONE_MATCH', '').split(',')]
+        if etag in matches or '*' in matches:
+            return self.not_modified_response(
+                environ, start_response, headers=headers)
         return self.ok_response(environ, start_response, content,
-                                headers=[('X-BE-Version', be_version)])
+                                headers=headers)
 
     def set(self, environ, start_response):
         self.check_login(environ)
@@ -344,6 +446,34 @@ if libbe.TESTING:
             self.failUnless(self.response_headers == [],
                             self.response_headers)
             self.failUnless(self.exc_info is None, self.exc_info)
+
+        def test_get_etag(self):
+            self.bd.storage.add('123456', directory=False)
+            self.bd.storage.set('123456', 'value')
+            content = self.getURL(self.app, '/get/123456', method='GET')
+            self.failUnless(content == 'value', content)
+            etag = dict(self.response_headers)['ETag']
+            content = self.getURL(self.app, '/get/123456', method='GET',
+                                  environ={'HTTP_IF_NONE_MATCH': etag})
+            self.failUnless(self.status == '304 Not Modified', self.status)
+            self.failUnless(content == '', content)
+            self.bd.storage.set('123456', 'changed')
+            content = self.getURL(self.app, '/get/123456', method='GET',
+                                  environ={'HTTP_IF_NONE_MATCH': etag})
+            self.failUnless(self.status == '200 OK', self.status)
+            self.failUnless(content == 'changed', content)
+
+        def test_batch_non_ascii(self):
+            # VCS storages list unicode ids
+            self.bd.storage.add(u'123456', directory=False)
+            self.bd.storage.set('123456', u'caf\xe9'.encode('utf-8'))
+            content = self.getURL(
+                self.app, '/batch/', method='POST',
+                data_dict={'ops':'get\t\t123456\nchildren\t\t'})
+            self.failUnless(self.status == '200 OK', self.status)
+            frames = libbe.util.http.decode_frames(content)
+            self.failUnless(frames[0][1] == 'caf\xc3\xa9', frames)
+            self.failUnless('123456' in frames[1][1].split('\n'), frames)
         # Note: other methods tested in libbe.storage.http
 
         # TODO: integration tests on Serve?
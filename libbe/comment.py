@@ -57,23 +57,51 @@ class MissingReference(ValueError):
 
 INVALID_UUID = "!!~~\n INVALID-UUID \n~~!!"
 
-def load_comments(bug, load_full=False):
+def load_comments(bug, load_full=False, values=None, loaded=None):
     """
     Set load_full=True when you want to load the comment completely
     from disk *now*, rather than waiting and lazy loading as required.
+
+    If given, `values` maps comment uuids to their settings mapfiles,
+    and is used instead of listing and reading the comments from
+    storage.  Otherwise the settings mapfiles read from storage are
+    stored in the `loaded` dict, if one is given.
     """
-    uuids = []
-    for id in libbe.util.id.child_uuids(
-                  bug.storage.children(
-                      bug.id.storage())):
-        uuids.append(id)
-    comments = []
-    for uuid in uuids:
-        comm = Comment(bug, uuid, from_storage=True)
+    if values is not None:
+        comments = []
+        for uuid in sorted(values.keys()):
+            comm = Comment(bug, uuid, from_storage=True)
+            comm.load_settings(values[uuid])
+            comments.append(comm)
+    else:
+        uuids = []
+        for id in libbe.util.id.child_uuids(
+                      bug.storage.children(
+                          bug.id.storage())):
+            uuids.append(id)
+        comments = [Comment(bug, uuid, from_storage=True) for uuid in uuids]
+    if bug.storage != None and bug.storage.is_readable():
+        # threading needs every comment's settings, so fetch them all
+        # (and with load_full, the bodies) in a single storage request
+        ops = []
+        if values is None:
+            ops.extend(('get', comm.id.storage('values')) for comm in comments)
         if load_full == True:
-            comm.load_settings()
+            ops.extend(('get', comm.id.storage('body')) for comm in comments)
+        results = bug.storage.read_many(ops)
+        if values is None:
+            for comm, value in zip(comments, results):
+                if value is None:
+                    value = '{}\n'
+                comm.load_settings(value)
+                if loaded is not None:
+                    loaded[comm.uuid] = value
+            results = results[len(comments):]
+        for comm, body in zip(comments, results):  # only with load_full
+            comm._body_value = body
+    if load_full == True:
+        for comm in comments:
             dummy = comm.body # force the body to load
-        comments.append(comm)
     bug.comment_root = Comment(bug, uuid=INVALID_UUID)
     bug.add_comments(comments, ignore_missing_references=True)
     return bug.comment_root
@@ -144,6 +172,12 @@ class Comment (Tree, settings_object.SavedSettingsObject):
                     doc="An integer version of .date")
 
     def _get_comment_body(self):
+        if self._body_value is not None:  # see load_comments()
+            body = self._body_value
+            self._body_value = None
+            if self.content_type.startswith("text/"):
+                return unicode(body, self.storage.encoding)
+            return body
         if self.storage != None and self.storage.is_readable() \
                 and self.uuid != INVALID_UUID:
             return self.storage.get(self.id.storage("body"),
@@ -203,6 +237,7 @@ class Comment (Tree, settings_object.SavedSettingsObject):
         self.storage = None
         self.uuid = uuid
         self.id = libbe.util.id.ID(self, 'comment')
+        self._body_value = None  # see load_comments()
         if from_storage == False:
             if uuid == None:
                 self.uuid = libbe.util.id.uuid_gen()
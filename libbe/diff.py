@@ -440,8 +440,11 @@ class Diff (object):
         subs_types = [s.type for s in subscriptions if s.id == BUGDIR_ID]
         new_uuids = self._find_new_uuids(subscribed_bugs, subs_types)
         old_uuids = self._find_old_uuids(subscribed_bugs, subs_types)
+        unchanged = self._unchanged_bugs(new_uuids)
 
         for uuid in new_uuids:
+            if uuid in unchanged:
+                continue
             new_bug = self.new_bugdir.bug_from_uuid(uuid)
 
             try:
@@ -475,6 +478,20 @@ class Diff (object):
         modified.sort(Diff._bug_modified_cmp)
         return (added, modified, removed)
 
+    def _unchanged_bugs(self, uuids):
+        """Return the set of bugs in uuids whose storage fingerprints
+        show they are the same in .old_bugdir and .new_bugdir, without
+        loading them.
+        """
+        fingerprints = []
+        for bugdir in [self.old_bugdir, self.new_bugdir]:
+            if bugdir.storage is None or not bugdir.storage.is_readable():
+                return set()
+            fingerprints.append(bugdir.storage.fingerprints(uuids))
+        old, new = fingerprints
+        return set(uuid for uuid in uuids
+                   if old[uuid] is not None and old[uuid] == new[uuid])
+
     @staticmethod
     def _bug_modified_cmp(left, right):
         return cmp(left[1], right[1])
@@ -25,6 +25,10 @@ Also define assorted implementations for the Storage classes:
 * :py:mod:`libbe.storage.vcs`
 * :py:mod:`libbe.storage.http`
 
+Locations starting with ``git-branch:`` select
+:py:class:`libbe.storage.vcs.git.PygitBranch`, which keeps the bug
+database on a git ref instead of in the working tree.
+
 Also define an assortment of storage-related tools and utilities:
 
 * :py:mod:`libbe.storage.util`
@@ -57,6 +61,10 @@ def get_http_storage(location):
     import http
     return http.HTTP(location)
 
+def get_git_branch_storage(location):
+    import vcs.git
+    return vcs.git.PygitBranch(location)
+
 def get_vcs_storage(location):
     import vcs
     s = vcs.detect_vcs(location)
@@ -69,6 +77,8 @@ def get_storage(location):
     """
     if location.startswith('http://') or location.startswith('https://'):
         return get_http_storage(location)
+    if location.startswith('git-branch:'):
+        return get_git_branch_storage(location[len('git-branch:'):])
     return get_vcs_storage(location)
 
 __all__ = [ConnectionError, InvalidStorageVersion, InvalidID,
@@ -21,9 +21,10 @@
 Abstract bug repository data storage to easily support multiple backends.
 """
 
-import copy
+import contextlib
 import os
 import pickle
+import tempfile
 import types
 
 import libbe.storage
@@ -31,6 +32,7 @@ import libbe.version
 from libbe import TESTING
 from libbe.error import NotSupported
 from libbe.util import InvalidObject
+from libbe.util.lru import LRUCache
 from libbe.util.tree import Tree
 
 if TESTING:
@@ -163,13 +165,74 @@ class Entry(Tree):
         return self
 
 
+# number of past revisions whose trees VersionedStorage keeps in memory
+_REVISION_CACHE_SIZE = 8
+
+
+def _entry_record(entry):
+    """Return the `(value, parent id, directory)` record for entry."""
+    if entry.parent is None:
+        parent = None
+    else:
+        parent = entry.parent.id
+    return (entry.value, parent, entry.directory)
+
+
+def _apply_changes(records, changes):
+    """Update the `{id: record}` dict records with a change set."""
+    for id, record in changes.items():
+        if record is None:
+            records.pop(id, None)
+        else:
+            records[id] = record
+
+
+def _diff_records(old, new):
+    """Return the change set turning the `{id: record}` dict old into
+    new.
+    """
+    changes = dict((id, record) for id, record in new.items()
+                   if old.get(id) != record)
+    changes.update((id, None) for id in old if id not in new)
+    return changes
+
+
+def _build_tree(records):
+    """Return a `{id: Entry}` tree for the `{id: record}` dict records.
+    Children are sorted by id.
+    """
+    tree = dict((id, Entry(id, value=value, directory=directory))
+                for id, (value, parent, directory) in records.items())
+    for id in sorted(records):
+        parent = records[id][1]
+        if parent is not None:
+            entry = tree[id]
+            entry.parent = tree[parent]
+            entry.parent.append(entry)
+    return tree
+
+
 class Storage(object):
     """
     This class declares all the methods required by a Storage
     interface.  This implementation just keeps the data in a
     dictionary and uses pickle for persistent storage.
+
+    The dictionary is checkpointed to ``repo.pkl``, and later changes
+    are appended to ``repo.log`` as a sequence of pickled records::
+
+        ('generation', GENERATION)  # first record, see _compact()
+        ('add', ID, PARENT-ID, DIRECTORY)
+        ('set', ID, VALUE)
+        ('remove', ID)
+
+    so disconnecting writes in proportion to the session's edits.
+    Once the log outgrows the checkpoint, it is folded into a new
+    checkpoint.
     """
     name = 'Storage'
+    _checkpoint_file = 'repo.pkl'
+    _log_file = 'repo.log'
 
     def __init__(self, repo='/', encoding='utf-8', options=None):
         self.repo = repo
@@ -182,6 +245,13 @@ class Storage(object):
         self.versioned = False
         self.can_init = True
         self.connected = False
+        self._transaction_depth = 0
+        self._pending = {}  # buffered set() values, see transaction()
+        self.writes = 0  # add/set/remove calls, see libbe.storage.util.snapshot
+        self._log = []  # records to append to the log on disconnect
+        self._generation = 0  # checkpoint generation
+        self._log_size = 0  # bytes of valid records in the log
+        self._checkpoint_size = 0
 
     def __str__(self):
         return '<%s %s %s>' % (self.__class__.__name__, id(self), self.repo)
@@ -213,11 +283,8 @@ class Storage(object):
         return self._init()
 
     def _init(self):
-        f = open(os.path.join(self.repo, 'repo.pkl'), 'wb')
         root = Entry(id='__ROOT__', directory=True)
-        d = {root.id: root}
-        pickle.dump(dict((k, v._objects_to_ids()) for k, v in d.items()), f, -1)
-        f.close()
+        self._write_checkpoint({root.id: root}, 0)
 
     def destroy(self):
         """Remove the storage repository."""
@@ -226,7 +293,10 @@ class Storage(object):
         return self._destroy()
 
     def _destroy(self):
-        os.remove(os.path.join(self.repo, 'repo.pkl'))
+        os.remove(os.path.join(self.repo, self._checkpoint_file))
+        log = os.path.join(self.repo, self._log_file)
+        if os.path.exists(log):
+            os.remove(log)
 
     def connect(self):
         """Open a connection to the repository."""
@@ -236,13 +306,54 @@ class Storage(object):
         self.connected = True
 
     def _connect(self):
+        path = os.path.join(self.repo, self._checkpoint_file)
         try:
-            f = open(os.path.join(self.repo, 'repo.pkl'), 'rb')
+            f = open(path, 'rb')
         except IOError:
             raise ConnectionError(self)
-        d = pickle.load(f)
+        with f:
+            d = pickle.load(f)
+            self._checkpoint_size = f.tell()
+        if isinstance(d, tuple):
+            self._generation, d = d
+        else:  # checkpoint from an older BE, without a log
+            self._generation = 0
         self._data = dict((k, v._ids_to_objects(d)) for k, v in d.items())
-        f.close()
+        self._log = []
+        self._log_size = 0
+        try:
+            f = open(os.path.join(self.repo, self._log_file), 'rb')
+        except IOError:
+            return
+        with f:
+            records = []
+            while True:
+                try:
+                    records.append(pickle.load(f))
+                except EOFError:
+                    break
+                except (pickle.UnpicklingError, ValueError, IndexError):
+                    break  # torn write, overwritten by the next append
+                self._log_size = f.tell()
+        if not records or records[0] != ('generation', self._generation):
+            # written for an older checkpoint, which already includes it
+            self._log_size = 0
+            return
+        for record in records[1:]:
+            self._replay(record)
+
+    def _replay(self, record):
+        """Apply a log record to the connected data."""
+        if record[0] == 'add':
+            _, id, parent, directory = record
+            self._data[id] = Entry(id, parent=self._data[parent],
+                                   directory=directory)
+        elif record[0] == 'set':
+            _, id, value = record
+            self._data[id].value = value
+        elif record[0] == 'remove':
+            e = self._data.pop(record[1])
+            e.parent.remove(e)
 
     def disconnect(self):
         """Close the connection to the repository."""
@@ -250,21 +361,93 @@ class Storage(object):
             return
         if not self.connected:
             return
+        self.flush()
         self._disconnect()
         self.connected = False
 
     def _disconnect(self):
-        f = open(os.path.join(self.repo, 'repo.pkl'), 'wb')
-        pickle.dump(dict((k, v._objects_to_ids())
-                         for k, v in self._data.items()), f, -1)
-        f.close()
+        if self._log:
+            path = os.path.join(self.repo, self._log_file)
+            with open(path, 'r+b' if self._log_size else 'wb') as f:
+                f.seek(self._log_size)
+                f.truncate()
+                if self._log_size == 0:
+                    pickle.dump(('generation', self._generation), f, -1)
+                for record in self._log:
+                    pickle.dump(record, f, -1)
+                self._log_size = f.tell()
+            self._log = []
+            if self._log_size > max(self._checkpoint_size, 64 * 1024):
+                self._compact()
         self._data = None
 
+    def _compact(self):
+        """Fold the log into a new checkpoint.
+
+        The checkpoint is written first, with the next generation, so
+        if the log can't be emptied afterwards it is just ignored by
+        later connections.
+        """
+        self._write_checkpoint(self._data, self._generation + 1)
+        os.remove(os.path.join(self.repo, self._log_file))
+        self._log_size = 0
+
+    def _write_checkpoint(self, data, generation):
+        """Write data as the checkpoint.  This breaks the links
+        between data's entries, so only call it on data you are about
+        to drop.
+        """
+        path = os.path.join(self.repo, self._checkpoint_file)
+        descriptor, filename = tempfile.mkstemp(dir=self.repo)
+        with os.fdopen(descriptor, 'wb') as f:
+            pickle.dump((generation, dict((k, v._objects_to_ids())
+                                          for k, v in data.items())), f, -1)
+            self._checkpoint_size = f.tell()
+        if os.name == 'nt' and os.path.exists(path):
+            os.remove(path)  # rename() won't replace on Windows
+        os.rename(filename, path)
+        self._generation = generation
+
+    @contextlib.contextmanager
+    def transaction(self):
+        """Buffer writes until the end of a `with` block.
+
+        Inside the block, set() calls are held in memory (later values
+        for the same id replace earlier ones) and backends may defer
+        their own bookkeeping, such as VCS index updates.  Everything
+        is flushed once when the outermost block exits, even if it
+        exits with an exception.  Reads see the buffered values.
+
+        Because the writes are deferred, errors such as setting a
+        nonexistent id are raised on exit rather than by set().
+        """
+        self._transaction_depth += 1
+        try:
+            yield self
+        finally:
+            try:
+                if self._transaction_depth == 1:
+                    self.flush()
+            finally:
+                self._transaction_depth -= 1
+
+    def flush(self):
+        """Write any changes buffered by transaction() to the backend."""
+        pending = self._pending
+        self._pending = {}
+        for id, value in sorted(pending.items()):
+            self._set(id, value)
+        self._flush()
+
+    def _flush(self):
+        pass
+
     def add(self, id, *args, **kwargs):
         """Add an entry"""
         if not self.is_writeable():
             raise NotWriteable('Cannot add entry to unwriteable storage.')
         if not self.exists(id):
+            self.writes += 1
             self._add(id, *args, **kwargs)
 
     def _add(self, id, parent=None, directory=False):
@@ -272,6 +455,7 @@ class Storage(object):
             parent = '__ROOT__'
         self._data[id] = Entry(id, parent=self._data[parent],
                                directory=directory)
+        self._log.append(('add', id, parent, directory))
 
     def exists(self, *args, **kwargs):
         """Check an entry's existence"""
@@ -283,24 +467,29 @@ class Storage(object):
     def _exists(self, id, revision=None):
         return id in self._data
 
-    def remove(self, *args, **kwargs):
+    def remove(self, id, *args, **kwargs):
         """Remove an entry."""
         if not self.is_writeable():
             raise NotSupported('write',
                                'Cannot remove entry from unwriteable storage.')
-        self._remove(*args, **kwargs)
+        self.writes += 1
+        self._pending.pop(id, None)
+        self._remove(id, *args, **kwargs)
 
     def _remove(self, id):
         if self._data[id].directory and self.children(id):
             raise DirectoryNotEmpty(id)
         e = self._data.pop(id)
         e.parent.remove(e)
+        self._log.append(('remove', id))
 
     def recursive_remove(self, *args, **kwargs):
         """Remove an entry and all its decendents."""
         if not self.is_writeable():
             raise NotSupported('write',
                                'Cannot remove entries from unwriteable storage.')
+        self.writes += 1
+        self.flush()
         self._recursive_remove(*args, **kwargs)
 
     def _recursive_remove(self, id):
@@ -338,6 +527,19 @@ class Storage(object):
             id = '__ROOT__'
         return [c.id for c in self._data[id] if not c.id.startswith('__')]
 
+    def children_many(self, *args, **kwargs):
+        """
+        Return a dict mapping each of the specified ids to a list of
+        its children's ids.  Equivalent to calling children() on each
+        id, but backends may answer the whole request at once.
+        """
+        if not self.is_readable():
+            raise NotReadable('Cannot list children with unreadable storage.')
+        return self._children_many(*args, **kwargs)
+
+    def _children_many(self, ids, revision=None):
+        return dict((id, self._children(id, revision=revision)) for id in ids)
+
     def get(self, *args, **kwargs):
         """
         Get contents of and entry as they were in a given revision.
@@ -352,7 +554,15 @@ class Storage(object):
             decode = kwargs.pop('decode')
         else:
             decode = False
-        value = self._get(*args, **kwargs)
+        value = self._get_pending(*args, **kwargs)
+        return self._decode_value(value, decode)
+
+    def _get_pending(self, id, default=InvalidObject, revision=None):
+        if revision is None and id in self._pending:
+            return self._pending[id]
+        return self._get(id, default=default, revision=revision)
+
+    def _decode_value(self, value, decode=False):
         if value != None:
             if decode == True and type(value) != types.UnicodeType:
                 return unicode(value, self.encoding)
@@ -367,6 +577,115 @@ class Storage(object):
             raise InvalidID(id)
         return default
 
+    def get_many(self, ids, *args, **kwargs):
+        """
+        Get the contents of several entries as they were in a given
+        revision.  Return a dict mapping each id to its contents.
+
+        The remaining arguments are as for get(), and apply to every
+        id.  In particular, if default is not given, a missing id
+        raises InvalidID.
+        """
+        if not self.is_readable():
+            raise NotReadable('Cannot get entry with unreadable storage.')
+        if 'decode' in kwargs:
+            decode = kwargs.pop('decode')
+        else:
+            decode = False
+        values = self._get_many_pending(list(ids), *args, **kwargs)
+        for id, value in values.items():
+            values[id] = self._decode_value(value, decode)
+        return values
+
+    def _get_many_pending(self, ids, default=InvalidObject, revision=None):
+        if revision is not None or not self._pending:
+            return self._get_many(ids, default=default, revision=revision)
+        values = self._get_many(
+            [id for id in ids if id not in self._pending],
+            default=default, revision=revision)
+        for id in ids:
+            if id in self._pending:
+                values[id] = self._pending[id]
+        return values
+
+    def _get_many(self, ids, default=InvalidObject, revision=None):
+        return dict((id, self._get(id, default=default, revision=revision))
+                    for id in ids)
+
+    def read_many(self, ops):
+        """
+        Answer several read requests at once.  `ops` is a list of
+        `(op, id)` or `(op, id, revision)` tuples, where `op` is one
+        of 'get', 'children' or 'exists'.  Return a list with one
+        result per op: the entry's contents (or None if there is no
+        such entry) for 'get', the list of children's ids for
+        'children', and a bool for 'exists'.  Backends may answer the
+        whole list in a single request.
+        """
+        if not self.is_readable():
+            raise NotReadable('Cannot read entries from unreadable storage.')
+        ops = [(op[0], op[1], op[2] if len(op) > 2 else None) for op in ops]
+        for op, id, revision in ops:
+            if op not in self._read_ops:
+                raise ValueError('unknown read operation %s' % op)
+        results = self._read_many(ops)
+        for i, (op, id, revision) in enumerate(ops):
+            if op == 'get':
+                if revision is None and id in self._pending:
+                    results[i] = self._pending[id]
+                results[i] = self._decode_value(results[i])
+        return results
+
+    _read_ops = ['get', 'children', 'exists']
+
+    def _read_many(self, ops):
+        # one _get_many() and _children_many() per revision
+        ids = {}
+        for op, id, revision in ops:
+            if op != 'exists':
+                ids.setdefault((op, revision), set()).add(id)
+        answers = {}
+        for (op, revision), op_ids in ids.items():
+            if op == 'get':
+                answers[(op, revision)] = self._get_many(
+                    list(op_ids), default=None, revision=revision)
+            else:
+                answers[(op, revision)] = self._children_many(
+                    list(op_ids), revision=revision)
+        results = []
+        for op, id, revision in ops:
+            if op == 'exists':
+                results.append(self._exists(id, revision=revision))
+            else:
+                results.append(answers[(op, revision)][id])
+        return results
+
+    def fingerprint(self, id, revision=None):
+        """
+        Return a fingerprint of an entry and all of its descendants as
+        they were in a given revision, or None if the backend cannot
+        compute one cheaply.  Entries with equal (non-None)
+        fingerprints have equal contents.
+        """
+        return self.fingerprints([id], revision=revision)[id]
+
+    def fingerprints(self, ids, revision=None):
+        """
+        Return a dict mapping each of the specified ids to its
+        fingerprint(), computing them all at once where the backend
+        supports it.
+        """
+        if not self.is_readable():
+            raise NotReadable('Cannot fingerprint entry with unreadable storage.')
+        ids = list(ids)
+        if revision is None and self._pending:
+            # unflushed changes are not reflected by the backend
+            return dict((id, None) for id in ids)
+        return self._fingerprints(ids, revision=revision)
+
+    def _fingerprints(self, ids, revision=None):
+        return dict((id, None) for id in ids)
+
     def set(self, id, value, *args, **kwargs):
         """
         Set the entry contents.
@@ -375,7 +694,11 @@ class Storage(object):
             raise NotWriteable('Cannot set entry in unwriteable storage.')
         if type(value) == types.UnicodeType:
             value = value.encode(self.encoding)
-        self._set(id, value, *args, **kwargs)
+        self.writes += 1
+        if self._transaction_depth > 0 and not args and not kwargs:
+            self._pending[id] = value
+        else:
+            self._set(id, value, *args, **kwargs)
 
     def _set(self, id, value):
         if id not in self._data:
@@ -384,83 +707,188 @@ class Storage(object):
             raise InvalidDirectory(
                 'Directory %s cannot have data' % self.parent)
         self._data[id].value = value
+        self._log.append(('set', id, value))
 
 
 class VersionedStorage (Storage):
     """
     This class declares all the methods required by a Storage
-    interface that supports versioning.  This implementation just
-    keeps the data in a list and uses pickle for persistent
-    storage.
+    interface that supports versioning.  This implementation keeps
+    the working tree in a dictionary, like :py:class:`Storage`, and
+    each committed revision as the set of entries it changed::
+
+        {ID: (VALUE, PARENT-ID, DIRECTORY) or None, ...}
+
+    where `None` marks a removed entry.  Revision 0 is the initial
+    tree.  The record tuples are shared between revisions, so a
+    commit costs memory in proportion to what it changed.  Past
+    revisions are rebuilt from the change sets when they are read,
+    and the most recently read ones are kept.
+
+    The change sets are appended to ``revisions.pkl``, one pickle per
+    revision, and the uncommitted changes are kept in the small
+    ``working.pkl``, so disconnecting only writes what changed since
+    the last connection.  A ``repo.pkl`` from an older BE, holding
+    every revision as a full tree, is converted on connect.
     """
     name = 'VersionedStorage'
+    _revisions_file = 'revisions.pkl'
+    _working_file = 'working.pkl'
+    _legacy_file = 'repo.pkl'
 
     def __init__(self, *args, **kwargs):
         Storage.__init__(self, *args, **kwargs)
         self.versioned = True
+        self._revisions = None  # change sets, oldest first
+        self._head = None  # id -> record, as of the last commit
+        self._changes = None  # ids touched since the last commit
+        self._saved = 0  # change sets already in the revisions file
+        self._trees = LRUCache(size=_REVISION_CACHE_SIZE)
+
+    def _path(self, filename):
+        return os.path.join(self.repo, filename)
 
     def _init(self):
-        f = open(os.path.join(self.repo, 'repo.pkl'), 'wb')
-        root = Entry(id='__ROOT__', directory=True)
-        summary = Entry(id='__COMMIT__SUMMARY__', value='Initial commit')
-        body = Entry(id='__COMMIT__BODY__')
-        initial_commit = {root.id: root, summary.id :summary, body.id: body}
-        d = dict((k, v._objects_to_ids()) for k, v in initial_commit.items())
-        pickle.dump([d, copy.deepcopy(d)], f, -1)  # [inital tree, working tree]
-        f.close()
+        initial = {
+            '__ROOT__': (_EMPTY, None, True),
+            '__COMMIT__SUMMARY__': ('Initial commit', None, False),
+            '__COMMIT__BODY__': (_EMPTY, None, False),
+            }
+        with open(self._path(self._revisions_file), 'wb') as f:
+            pickle.dump(initial, f, -1)
+        with open(self._path(self._working_file), 'wb') as f:
+            pickle.dump({}, f, -1)
+
+    def _destroy(self):
+        for filename in [self._revisions_file, self._working_file]:
+            os.remove(self._path(filename))
 
     def _connect(self):
+        if (not os.path.exists(self._path(self._revisions_file)) and
+                os.path.exists(self._path(self._legacy_file))):
+            self._convert_legacy()
         try:
-            f = open(os.path.join(self.repo, 'repo.pkl'), 'rb')
+            f = open(self._path(self._revisions_file), 'rb')
         except IOError:
             raise ConnectionError(self)
-        d = pickle.load(f)
-        self._data = [dict((k, v._ids_to_objects(t)) for k, v in t.items())
-                      for t in d]
-        f.close()
+        revisions = []
+        with f:
+            while True:
+                try:
+                    revisions.append(pickle.load(f))
+                except EOFError:
+                    break
+        with open(self._path(self._working_file), 'rb') as f:
+            working = pickle.load(f)
+        self._revisions = revisions
+        self._saved = len(revisions)
+        self._head = {}
+        for changes in revisions:
+            _apply_changes(self._head, changes)
+        records = dict(self._head)
+        _apply_changes(records, working)
+        self._data = _build_tree(records)
+        self._changes = set(working)
+        self._trees.clear()
+
+    def _convert_legacy(self):
+        """Replace an older BE's ``repo.pkl``, a pickled list
+        `[initial tree, revision 1, ..., working tree]` of `{id:
+        Entry}` trees with ids for parents and children, with the
+        revisions and working files.
+        """
+        with open(self._path(self._legacy_file), 'rb') as f:
+            trees = pickle.load(f)
+        revisions = []
+        old = {}
+        for tree in trees:
+            new = dict((id, (entry.value, entry.parent, entry.directory))
+                       for id, entry in tree.items())
+            revisions.append(_diff_records(old, new))
+            old = new
+        working = revisions.pop()
+        with open(self._path(self._working_file), 'wb') as f:
+            pickle.dump(working, f, -1)
+        with open(self._path(self._revisions_file), 'wb') as f:
+            for changes in revisions:
+                pickle.dump(changes, f, -1)
+        os.remove(self._path(self._legacy_file))
 
     def _disconnect(self):
-        f = open(os.path.join(self.repo, 'repo.pkl'), 'wb')
-        pickle.dump([dict((k, v._objects_to_ids())
-                          for k, v in t.items()) for t in self._data], f, -1)
-        f.close()
+        if len(self._revisions) > self._saved:
+            with open(self._path(self._revisions_file), 'ab') as f:
+                for changes in self._revisions[self._saved:]:
+                    pickle.dump(changes, f, -1)
+        with open(self._path(self._working_file), 'wb') as f:
+            pickle.dump(self._working_changes(), f, -1)
         self._data = None
+        self._revisions = None
+        self._head = None
+        self._changes = None
+        self._trees.clear()
+
+    def _working_changes(self):
+        """Return the uncommitted change set."""
+        changes = {}
+        for id in self._changes:
+            if id in self._data:
+                record = _entry_record(self._data[id])
+            else:
+                record = None
+            if record != self._head.get(id):
+                changes[id] = record
+        return changes
+
+    def _tree(self, revision=None):
+        """Return the `{id: Entry}` tree for revision.  Don't modify
+        past revisions' trees, they are cached.
+        """
+        if revision is None:
+            return self._data
+        revision = int(revision)
+        if revision < 0:  # -1 is the working tree
+            revision += len(self._revisions) + 1
+        if revision == len(self._revisions):
+            return self._data
+        if revision < 0 or revision > len(self._revisions):
+            raise InvalidRevision(revision)
+        if revision not in self._trees:
+            records = {}
+            for changes in self._revisions[:revision+1]:
+                _apply_changes(records, changes)
+            self._trees[revision] = _build_tree(records)
+        return self._trees[revision]
 
     def _add(self, id, parent=None, directory=False):
         if parent is None:
             parent = '__ROOT__'
-        self._data[-1][id] = Entry(id, parent=self._data[-1][parent],
-                                   directory=directory)
+        self._data[id] = Entry(id, parent=self._data[parent],
+                               directory=directory)
+        self._changes.add(id)
 
     def _exists(self, id, revision=None):
-        if revision is None:
-            revision = -1
-        else:
-            revision = int(revision)
-        return id in self._data[revision]
+        return id in self._tree(revision)
 
     def _remove(self, id):
-        if self._data[-1][id].directory and self.children(id):
+        if self._data[id].directory and self.children(id):
             raise DirectoryNotEmpty(id)
-        e = self._data[-1].pop(id)
+        e = self._data.pop(id)
         e.parent.remove(e)
+        self._changes.add(id)
 
     def _recursive_remove(self, id):
-        for entry in reversed(list(self._data[-1][id].traverse())):
+        for entry in reversed(list(self._data[id].traverse())):
             self._remove(entry.id)
 
     def _ancestors(self, id=None, revision=None):
         if id is None:
             return []
-        if revision is None:
-            revision = -1
-        else:
-            revision = int(revision)
+        tree = self._tree(revision)
         ancestors = []
         stack = [id]
         while stack:
             id = stack.pop(0)
-            parent = self._data[revision][id].parent
+            parent = tree[id].parent
             if parent is not None and not parent.id.startswith('__'):
                 ancestor = parent.id
                 ancestors.append(ancestor)
@@ -470,29 +898,45 @@ class VersionedStorage (Storage):
     def _children(self, id=None, revision=None):
         if id is None:
             id = '__ROOT__'
-        if revision is None:
-            revision = -1
-        else:
-            revision = int(revision)
-        return [c.id for c in self._data[revision][id]
+        return [c.id for c in self._tree(revision)[id]
                 if not c.id.startswith('__')]
 
+    def _children_many(self, ids, revision=None):
+        tree = self._tree(revision)
+        children = {}
+        for id in ids:
+            if id is None:
+                entry = tree['__ROOT__']
+            else:
+                entry = tree[id]
+            children[id] = [c.id for c in entry if not c.id.startswith('__')]
+        return children
+
     def _get(self, id, default=InvalidObject, revision=None):
-        if revision is None:
-            revision = -1
-        else:
-            revision = int(revision)
-        if id in self._data[revision] \
-                and self._data[revision][id].value != _EMPTY:
-            return self._data[revision][id].value
+        tree = self._tree(revision)
+        if id in tree and tree[id].value != _EMPTY:
+            return tree[id].value
         elif default == InvalidObject:
             raise InvalidID(id)
         return default
 
+    def _get_many(self, ids, default=InvalidObject, revision=None):
+        tree = self._tree(revision)
+        values = {}
+        for id in ids:
+            if id in tree and tree[id].value != _EMPTY:
+                values[id] = tree[id].value
+            elif default == InvalidObject:
+                raise InvalidID(id)
+            else:
+                values[id] = default
+        return values
+
     def _set(self, id, value):
-        if id not in self._data[-1]:
+        if id not in self._data:
             raise InvalidID(id)
-        self._data[-1][id].value = value
+        self._data[id].value = value
+        self._changes.add(id)
 
     def commit(self, *args, **kwargs):
         """
@@ -504,15 +948,21 @@ class VersionedStorage (Storage):
         """
         if not self.is_writeable():
             raise NotWriteable('Cannot commit to unwriteable storage.')
+        self.flush()
         return self._commit(*args, **kwargs)
 
     def _commit(self, summary, body=None, allow_empty=False):
-        if self._data[-1] == self._data[-2] and not allow_empty:
+        changes = self._working_changes()
+        if not changes and not allow_empty:
             raise EmptyCommit
-        self._data[-1]["__COMMIT__SUMMARY__"].value = summary
-        self._data[-1]["__COMMIT__BODY__"].value = body
-        rev = str(len(self._data)-1)
-        self._data.append(copy.deepcopy(self._data[-1]))
+        for id, value in [('__COMMIT__SUMMARY__', summary),
+                          ('__COMMIT__BODY__', body)]:
+            self._data[id].value = value
+            changes[id] = _entry_record(self._data[id])
+        rev = str(len(self._revisions))
+        self._revisions.append(changes)
+        _apply_changes(self._head, changes)
+        self._changes = set()
         return rev
 
     def revision_id(self, index=None):
@@ -533,7 +983,7 @@ class VersionedStorage (Storage):
                 raise InvalidRevision(index)
         except ValueError:
             raise InvalidRevision(index)
-        length = len(self._data) - 1  # -1 b/c of initial commit
+        length = len(self._revisions)
         if index >= -length and index <= length:
             return str(index % length)
         raise InvalidRevision(index)
@@ -542,21 +992,98 @@ class VersionedStorage (Storage):
         """Return a tuple of lists of ids `(new, modified, removed)` from the
         specified revision to the current situation.
         """
+        old = self._tree(revision)
+        ids = set(self._changes)
+        for changes in self._revisions[int(revision)+1:]:
+            ids.update(changes)
         new = []
         modified = []
         removed = []
-        for _id, value in self._data[int(revision)].items():
+        for _id in sorted(ids):
             if _id.startswith('__'):
                 continue
-            if _id not in self._data[-1]:
-                removed.append(_id)
-            elif value.value != self._data[-1][_id].value:
-                modified.append(_id)
-        for _id in self._data[-1]:
-            if _id not in self._data[int(revision)]:
+            if _id not in self._data:
+                if _id in old:
+                    removed.append(_id)
+            elif _id not in old:
                 new.append(_id)
+            elif old[_id].value != self._data[_id].value:
+                modified.append(_id)
         return (new, modified, removed)
 
+    def revision_storage(self, revision):
+        """
+        Return a read-only :py:class:`RevisionStorage` holding the
+        repository contents as they were in the given revision, so
+        they can be read without going back to the backend.
+        """
+        if not self.is_readable():
+            raise NotReadable('Cannot copy unreadable storage.')
+        storage = RevisionStorage(self, revision)
+        ids = [None]
+        while ids:  # one children_many() per level
+            children = self.children_many(ids, revision=revision)
+            ids = []
+            for parent in sorted(children):
+                for id in children[parent]:
+                    storage.add_entry(id, parent=parent, directory=True)
+                    ids.append(id)
+        values = self.get_many(
+            [id for id in storage._data if not id.startswith('__')],
+            default=None, revision=revision)
+        for id, value in values.items():
+            storage.set_entry(id, value)
+        return storage
+
+
+class RevisionStorage (Storage):
+    """
+    A read-only, in-memory copy of another storage's contents as of
+    a revision.  Use :py:meth:`VersionedStorage.revision_storage` to
+    create one.
+    """
+    name = 'RevisionStorage'
+
+    def __init__(self, storage, revision):
+        Storage.__init__(self, repo=storage.repo, encoding=storage.encoding,
+                         options=storage.options)
+        self.storage = storage
+        self.revision = revision
+        self.versioned = storage.versioned
+        self._writeable = False
+        self.can_init = False
+        self._data = {'__ROOT__': Entry(id='__ROOT__', directory=True)}
+        self.connected = True
+
+    def add_entry(self, id, parent=None, directory=False, value=_EMPTY):
+        """Add an entry while filling in the copy."""
+        if parent is None:
+            parent = '__ROOT__'
+        self._data[id] = Entry(id, value=value, parent=self._data[parent],
+                               directory=directory)
+
+    def set_entry(self, id, value=None):
+        """Set an entry's value while filling in the copy.  Entries
+        without children are files from now on.
+        """
+        entry = self._data[id]
+        if value is not None:
+            entry.value = value
+        entry.directory = len(entry) > 0
+
+    def storage_version(self, revision=None):
+        return self.storage.storage_version(self.revision)
+
+    def _fingerprints(self, ids, revision=None):
+        return self.storage.fingerprints(ids, revision=self.revision)
+
+    def changed(self, revision=None):
+        """Return the changes from this copy's revision to the current
+        contents of the original storage, see
+        :py:meth:`VersionedStorage.changed`.
+        """
+        return self.storage.changed(self.revision)
+
 
 if TESTING:
     class StorageTestCase(unittest.TestCase):
@@ -721,6 +1248,22 @@ if TESTING:
                 s = sorted(self.s.children('parent'))
                 self.failUnless(s == ids, '\n  %s\n  !=\n  %s' % (s, ids))
 
+        def test_children_many(self):
+            """Children_many should match children for each requested id.
+            """
+            expected = {None: ['a', 'b']}
+            for parent in ['a', 'b']:
+                self.s.add(parent, directory=True)
+                expected[parent] = []
+                for i in range(3):
+                    child = '%s/%d' % (parent, i)
+                    self.s.add(child, parent, directory=False)
+                    expected[parent].append(child)
+            ret = self.s.children_many([None, 'a', 'b'])
+            ret = dict((k, sorted(v)) for k, v in ret.items())
+            self.failUnless(ret == expected,
+                            '\n  %s\n  !=\n  %s' % (ret, expected))
+
         def test_add_invalid_directory(self):
             """Should not be able to add children to non-directories.
             """
@@ -873,6 +1416,147 @@ if TESTING:
             self.failUnless(s == val, "%s.get() returned %s not %s"
                             % (vars(self.Class)['name'], s, self.val))
 
+        def test_get_many(self):
+            """Get_many should return the values get would.
+            """
+            ids = ['%s %d' % (self.id, i) for i in range(5)]
+            expected = {}
+            for i, id in enumerate(ids):
+                self.s.add(id, directory=False)
+                expected[id] = '%s %d' % (self.val, i)
+                self.s.set(id, expected[id])
+            ret = self.s.get_many(ids)
+            self.failUnless(ret == expected,
+                            '%s.get_many() returned %s not %s'
+                            % (vars(self.Class)['name'], ret, expected))
+
+        def test_fingerprint(self):
+            """Fingerprints should be None or change with the contents.
+            """
+            self.s.add(self.id, directory=False)
+            self.s.set(self.id, self.val)
+            first = self.s.fingerprint(self.id)
+            self.failUnless(
+                self.s.fingerprints([self.id]) == {self.id: first},
+                '%s.fingerprints() disagrees with fingerprint()'
+                % vars(self.Class)['name'])
+            self.s.set(self.id, self.val + ' changed')
+            second = self.s.fingerprint(self.id)
+            if first is not None:
+                self.failIf(first == second,
+                            '%s.fingerprint() did not change: %s'
+                            % (vars(self.Class)['name'], first))
+            with self.s.transaction():
+                self.s.set(self.id, self.val)
+                self.failUnless(self.s.fingerprint(self.id) is None)
+
+        def test_get_many_default(self):
+            """Get_many should fill in default for missing ids, or raise
+            InvalidID if no default is given.
+            """
+            self.s.add(self.id, directory=False)
+            self.s.set(self.id, self.val)
+            missing = 'missing %s' % self.id
+            ret = self.s.get_many([self.id, missing], default=None)
+            expected = {self.id: self.val, missing: None}
+            self.failUnless(ret == expected,
+                            '%s.get_many() returned %s not %s'
+                            % (vars(self.Class)['name'], ret, expected))
+            try:
+                ret = self.s.get_many([self.id, missing])
+                self.fail(
+                    "%s.get_many() returned %s instead of raising InvalidID"
+                    % (vars(self.Class)['name'], ret))
+            except InvalidID:
+                pass
+
+        def test_read_many(self):
+            """Read_many should return what get, children and exists would.
+            """
+            self.s.add('dir', directory=True)
+            self.s.add(self.id, 'dir', directory=False)
+            self.s.set(self.id, self.val)
+            missing = 'missing %s' % self.id
+            ret = self.s.read_many([
+                    ('get', self.id), ('get', missing), ('children', 'dir'),
+                    ('exists', self.id), ('exists', missing)])
+            expected = [self.val, None, [self.id], True, False]
+            self.failUnless(ret == expected,
+                            '%s.read_many() returned %s not %s'
+                            % (vars(self.Class)['name'], ret, expected))
+            self.failUnless(self.s.read_many([]) == [])
+
+    class Storage_transaction_TestCase(StorageTestCase):
+        """Test cases for Storage.transaction method."""
+
+        id = 'unlikely id'
+        val = 'unlikely value'
+
+        def test_get_inside_transaction(self):
+            """Get should return buffered values inside a transaction.
+            """
+            self.s.add(self.id, directory=False)
+            with self.s.transaction():
+                for i in range(3):
+                    self.s.set(self.id, '%s %d' % (self.val, i))
+                    ret = self.s.get(self.id)
+                    self.failUnless(ret == '%s %d' % (self.val, i), ret)
+                ret = self.s.get_many([self.id])
+                self.failUnless(ret == {self.id: '%s 2' % self.val}, ret)
+            ret = self.s.get(self.id)
+            self.failUnless(ret == '%s 2' % self.val, ret)
+
+        def test_transaction_persistence(self):
+            """Buffered values should survive a reconnect.
+            """
+            ids = ['%s %d' % (self.id, i) for i in range(5)]
+            with self.s.transaction():
+                for id in ids:
+                    self.s.add(id, directory=False)
+                    self.s.set(id, self.val)
+            self.s.disconnect()
+            self.s.connect()
+            ret = self.s.get_many(ids)
+            expected = dict((id, self.val) for id in ids)
+            self.failUnless(ret == expected, ret)
+
+        def test_nested_transaction(self):
+            """Only the outermost transaction should flush.
+            """
+            self.s.add(self.id, directory=False)
+            with self.s.transaction():
+                with self.s.transaction():
+                    self.s.set(self.id, self.val)
+                self.failUnless(self.s._pending == {self.id: self.val},
+                                self.s._pending)
+            self.failUnless(self.s._pending == {}, self.s._pending)
+            ret = self.s.get(self.id)
+            self.failUnless(ret == self.val, ret)
+
+        def test_flush_on_exception(self):
+            """Buffered values should be flushed even if the block raises.
+            """
+            self.s.add(self.id, directory=False)
+            try:
+                with self.s.transaction():
+                    self.s.set(self.id, self.val)
+                    raise ValueError(self.id)
+            except ValueError:
+                pass
+            self.s.disconnect()
+            self.s.connect()
+            ret = self.s.get(self.id)
+            self.failUnless(ret == self.val, ret)
+
+        def test_remove_inside_transaction(self):
+            """Removing an entry should drop its buffered value.
+            """
+            self.s.add(self.id, directory=False)
+            with self.s.transaction():
+                self.s.set(self.id, self.val)
+                self.s.remove(self.id)
+            self.failIf(self.s.exists(self.id))
+
     class Storage_persistence_TestCase(StorageTestCase):
         """ Test cases for Storage.disconnect and .connect methods. """
 
@@ -918,6 +1602,68 @@ if TESTING:
             s = self.s.children()
             self.failUnless(s == ['parent'], s)
 
+    class StorageLogTestCase(unittest.TestCase):
+        """Test cases for the Storage checkpoint and log files."""
+
+        def setUp(self):
+            self.dir = Dir()
+            self.s = Storage(repo=self.dir.path)
+            self.s.init()
+            self.s.connect()
+            self.checkpoint = os.path.join(self.dir.path, 'repo.pkl')
+            self.log = os.path.join(self.dir.path, 'repo.log')
+
+        def tearDown(self):
+            self.s.disconnect()
+            self.s.destroy()
+            self.dir.cleanup()
+
+        def test_disconnect_appends(self):
+            """Disconnecting should leave the checkpoint alone."""
+            self.s.add('parent', directory=True)
+            for i in range(10):
+                self.s.add(str(i), 'parent')
+                self.s.set(str(i), 'value %d' % i)
+            self.s.disconnect()
+            checkpoint = open(self.checkpoint, 'rb').read()
+            size = os.path.getsize(self.log)
+            self.s.connect()
+            self.s.set('0', 'changed')
+            self.s.remove('9')
+            self.s.disconnect()
+            self.assertEqual(open(self.checkpoint, 'rb').read(), checkpoint)
+            self.assertTrue(os.path.getsize(self.log) > size)
+            self.s.connect()
+            self.assertEqual(self.s.get('0'), 'changed')
+            self.assertEqual(sorted(self.s.children('parent')),
+                             [str(i) for i in range(9)])
+
+        def test_compaction(self):
+            """A long log should be folded into the checkpoint."""
+            self.s.add('big')
+            for i in range(5):
+                self.s.set('big', '%d' % i * 2**15)
+            self.s.disconnect()
+            self.assertFalse(os.path.exists(self.log))
+            self.s.connect()
+            self.assertEqual(self.s._generation, 1)
+            self.assertEqual(self.s.get('big'), '4' * 2**15)
+
+        def test_stale_log_is_ignored(self):
+            """A log left behind by an interrupted compaction is stale."""
+            self.s.add('a')
+            self.s.set('a', 'old')
+            self.s.disconnect()
+            self.s.connect()
+            self.s.set('a', 'new')
+            # interrupted after writing the new checkpoint
+            self.s._write_checkpoint(self.s._data, self.s._generation + 1)
+            self.s._data = None
+            self.s.connected = False
+            self.assertTrue(os.path.exists(self.log))
+            self.s.connect()
+            self.assertEqual(self.s.get('a'), 'new')
+
     class VersionedStorageTestCase(StorageTestCase):
         """Test cases for VersionedStorage methods."""
 
@@ -997,6 +1743,23 @@ if TESTING:
                                 "%s.revision_id(%d) returned %s not %s"
                                 % (vars(self.Class)['name'], i, rev, revs[i]))
 
+        def test_revision_id_after_commit(self):
+            """revision_id should see revisions committed since the
+            last lookup.
+            """
+            self.s.add(self.id, directory=False)
+            revs = []
+            for i in range(3):
+                self.s.set(self.id, '%s:%d' % (self.val, i+1))
+                revs.append(self.s.commit('%s: %d' % (self.commit_msg, i),
+                                          self.commit_body))
+                self.failUnlessEqual(self.s.revision_id(-1), revs[-1])
+                self.failUnlessEqual(self.s.revision_id(i+1), revs[-1])
+                self.failUnlessEqual(self.s.revision_id(1), revs[0])
+            self.s.disconnect()
+            self.s.connect()
+            self.failUnlessEqual(self.s.revision_id(-3), revs[0])
+
         def test_get_previous_version(self):
             """Get should be able to return the previous version.
             """
@@ -1015,6 +1778,66 @@ if TESTING:
                                 % (vars(self.Class)['name'], ret, val(i),
                                    revs[i]))
 
+        def test_get_many_previous_version(self):
+            """Get_many should be able to return previous versions.
+            """
+            ids = ['%s %d' % (self.id, i) for i in range(3)]
+            for id in ids:
+                self.s.add(id, directory=False)
+            revs = []
+            for i in range(3):
+                for id in ids:
+                    self.s.set(id, '%s:%s:%d' % (self.val, id, i))
+                revs.append(self.s.commit('%s: %d' % (self.commit_msg, i),
+                                          self.commit_body))
+            for i in range(3):
+                ret = self.s.get_many(ids, revision=revs[i])
+                expected = dict((id, '%s:%s:%d' % (self.val, id, i))
+                                for id in ids)
+                self.failUnless(
+                    ret == expected,
+                    "%s.get_many() returned %s not %s for revision %s"
+                    % (vars(self.Class)['name'], ret, expected, revs[i]))
+
+        def test_read_many_previous_version(self):
+            """Read_many should answer each op at its own revision.
+            """
+            self.s.add(self.id, directory=False)
+            revs = []
+            for i in range(3):
+                self.s.set(self.id, '%s:%d' % (self.val, i))
+                revs.append(self.s.commit('%s: %d' % (self.commit_msg, i),
+                                          self.commit_body))
+            ret = self.s.read_many(
+                [('get', self.id, rev) for rev in revs] + [('get', self.id)])
+            expected = ['%s:%d' % (self.val, i) for i in range(3)
+                        ] + ['%s:2' % self.val]
+            self.failUnless(
+                ret == expected,
+                "%s.read_many() returned %s not %s"
+                % (vars(self.Class)['name'], ret, expected))
+
+        def test_fingerprint_previous_version(self):
+            """Fingerprints should be revision dependent.
+            """
+            self.s.add(self.id, directory=False)
+            revs = []
+            fingerprints = []
+            for i in range(3):
+                self.s.set(self.id, '%s:%d' % (self.val, i))
+                revs.append(self.s.commit('%s: %d' % (self.commit_msg, i),
+                                          self.commit_body))
+                fingerprints.append(self.s.fingerprint(self.id))
+            for i in range(3):
+                ret = self.s.fingerprint(self.id, revision=revs[i])
+                if ret is None or fingerprints[i] is None:
+                    continue
+                self.failUnless(
+                    ret == fingerprints[i],
+                    '%s.fingerprint() returned %s not %s for revision %s'
+                    % (vars(self.Class)['name'], ret, fingerprints[i],
+                       revs[i]))
+
         def test_get_previous_children(self):
             """Children list should be revision dependent.
             """
@@ -1037,6 +1860,35 @@ if TESTING:
                     "%s.children() returned %s not %s for revision %s"
                     % (vars(self.Class)['name'], ret, children[i], revs[i]))
 
+        def test_revision_storage(self):
+            """Revision storages should copy the revision's contents.
+            """
+            self.s.add('parent', directory=True)
+            for i in range(3):
+                self.s.add(str(i), 'parent')
+                self.s.set(str(i), '%s:%d' % (self.val, i))
+            rev = self.s.commit(self.commit_msg, self.commit_body)
+            self.s.set('0', 'changed')
+            self.s.add('3', 'parent')
+            self.s.set('3', self.val)
+            self.s.commit(self.commit_msg, self.commit_body)
+            r = self.s.revision_storage(rev)
+            self.failUnless(r.is_writeable() == False, r.is_writeable())
+            self.failUnless(sorted(r.children()) == ['parent'],
+                            r.children())
+            ret = sorted(r.children('parent'))
+            self.failUnless(ret == ['0', '1', '2'],
+                            "%s.revision_storage() listed %s"
+                            % (vars(self.Class)['name'], ret))
+            for i in range(3):
+                ret = r.get(str(i))
+                self.failUnless(ret == '%s:%d' % (self.val, i),
+                                "%s.revision_storage() returned %s for %d"
+                                % (vars(self.Class)['name'], ret, i))
+            self.failUnless(r.ancestors('1') == ['parent'], r.ancestors('1'))
+            self.failUnless(r.get('parent', default=None) == None,
+                            r.get('parent', default=None))
+
         def test_avoid_previous_grandchildren(self):
             """ Previous grandchildren should not be returned as children. """
             self.s.add('parent', directory=True)
@@ -1097,6 +1949,76 @@ if TESTING:
             self.failUnless(sorted(rem) == ['moved', 'removed'],
                             'Unexpected removed: %s' % rem)
 
+    class VersionedStorage_persistence_TestCase (VersionedStorageTestCase):
+        """Test cases for VersionedStorage revisions across connections."""
+
+        def test_revisions_persist(self):
+            """Past revisions should survive a reconnect"""
+            self.s.add('parent', directory=True)
+            self.s.add('child', parent='parent')
+            self.s.set('child', 'first')
+            rev = self.s.commit('First')
+            self.s.set('child', 'second')
+            self.s.disconnect()
+            self.s.connect()
+            self.failUnless(self.s.get('child') == 'second',
+                            self.s.get('child'))
+            self.failUnless(self.s.get('child', revision=rev) == 'first',
+                            self.s.get('child', revision=rev))
+            rev2 = self.s.commit('Second')
+            self.failUnless(self.s.revision_id(-1) == rev2,
+                            '%s != %s' % (self.s.revision_id(-1), rev2))
+
+        def test_disconnect_appends(self):
+            """Disconnecting should only append the new change sets"""
+            if self.Class != VersionedStorage:
+                self.skipTest('not stored in revisions.pkl')
+            for i in range(50):
+                self.s.add(str(i))
+                self.s.set(str(i), 'value %d' % i)
+            self.s.commit('Many entries')
+            self.s.disconnect()
+            path = os.path.join(self.dirname, VersionedStorage._revisions_file)
+            size = os.path.getsize(path)
+            self.s.connect()
+            self.s.set('0', 'changed')
+            self.s.commit('One change')
+            self.s.disconnect()
+            growth = os.path.getsize(path) - size
+            self.failUnless(growth < size // 4, '%d >= %d' % (growth, size))
+            self.s.connect()
+
+        def test_legacy_repo_is_converted(self):
+            """A repo.pkl from an older BE should be converted"""
+            if self.Class != VersionedStorage:
+                self.skipTest('not stored in revisions.pkl')
+            self.s.disconnect()
+            self.s.destroy()
+            trees = []
+            for summary, value in [('Initial commit', _EMPTY),
+                                   ('First', 'first'), ('First', 'second')]:
+                root = Entry(id='__ROOT__', directory=True)
+                tree = [root,
+                        Entry(id='__COMMIT__SUMMARY__', value=summary),
+                        Entry(id='__COMMIT__BODY__')]
+                if value != _EMPTY:
+                    parent = Entry(id='parent', parent=root, directory=True)
+                    tree.extend([parent, Entry(id='child', value=value,
+                                               parent=parent)])
+                trees.append(dict((e.id, e) for e in tree))
+            trees = [dict((id, e._objects_to_ids()) for id, e in t.items())
+                     for t in trees]
+            path = os.path.join(self.dirname, VersionedStorage._legacy_file)
+            with open(path, 'wb') as f:
+                pickle.dump(trees, f, -1)
+            self.s.connect()
+            self.failIf(os.path.exists(path))
+            self.failUnlessEqual(self.s.revision_id(-1), '1')
+            self.failUnlessEqual(self.s.get('child'), 'second')
+            self.failUnlessEqual(self.s.get('child', revision='1'), 'first')
+            self.failUnlessEqual(self.s.children('parent'), ['child'])
+            self.failUnlessEqual(self.s.changed('1'), ([], ['child'], []))
+
     def make_storage_testcase_subclasses(storage_class, namespace):
         """Make StorageTestCase subclasses for storage_class in namespace."""
         storage_testcase_classes = [
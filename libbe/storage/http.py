@@ -25,6 +25,7 @@ See Also
 """
 
 from __future__ import absolute_import
+import base64
 import sys
 import urllib
 import urlparse
@@ -32,8 +33,9 @@ import urlparse
 import libbe
 import libbe.version
 import libbe.util.http
-from libbe.util.http import HTTP_VALID, HTTP_USER_ERROR
+from libbe.util.http import HTTP_VALID, HTTP_USER_ERROR, HTTP_NOT_MODIFIED
 from . import base
+from .util import http_cache
 
 from libbe import TESTING
 
@@ -41,11 +43,13 @@ if TESTING == True:
     import copy
     import doctest
     import StringIO
+    import tempfile
     import unittest
 
     import libbe.bugdir
     import libbe.command.serve_storage
     import libbe.util.http
+    import libbe.util.utility
     import libbe.util.wsgi
 
 
@@ -54,13 +58,25 @@ class HTTP (base.VersionedStorage):
     HTTP.
 
     Uses GET to retrieve information and POST to set information.
+    Requests share up to :py:attr:`pool_size` keep-alive connections,
+    which are closed on :py:meth:`disconnect`.  Entry contents are
+    kept in a :py:class:`~libbe.storage.util.http_cache.HTTPCache`
+    and only transferred again when they change.  Contents read at a
+    full revision id are never revalidated; those read at symbolic
+    names like ``master`` are (see
+    :py:func:`~libbe.storage.util.http_cache.immutable`).
     """
     name = 'HTTP'
     user_agent = 'BE-HTTP-Storage'
+    pool_size = 4
+    timeout = 30  # seconds
 
     def __init__(self, repo, *args, **kwargs):
         repo,self.uname,self.password = self.parse_repo(repo)
         base.VersionedStorage.__init__(self, repo, *args, **kwargs)
+        self._pool = libbe.util.http.ConnectionPool(
+            size=self.pool_size, timeout=self.timeout)
+        self._cache = http_cache.HTTPCache()
 
     def parse_repo(self, repo):
         """Grab username and password (if any) from the repo URL.
@@ -89,12 +105,13 @@ class HTTP (base.VersionedStorage):
         return (repo, uname, password)
 
     def get_post_url(self, url, get=True, data_dict=None, headers=[]):
+        headers = list(headers)
         if self.uname != None and self.password != None:
             headers.append(('Authorization','Basic %s' % \
-                ('%s:%s' % (self.uname, self.password)).encode('base64')))
+                base64.b64encode('%s:%s' % (self.uname, self.password))))
         return libbe.util.http.get_post_url(
             url, get, data_dict=data_dict, headers=headers,
-            agent=self.user_agent)
+            agent=self.user_agent, pool=self._pool)
 
     def storage_version(self, revision=None):
         """Return the storage format for this backend."""
@@ -114,7 +131,8 @@ class HTTP (base.VersionedStorage):
         self.check_storage_version()
 
     def _disconnect(self):
-        pass
+        self._pool.close()
+        self._cache.trim()
 
     def _add(self, id, parent=None, directory=False):
         url = urlparse.urljoin(self.repo, 'add')
@@ -159,22 +177,109 @@ class HTTP (base.VersionedStorage):
 
     def _get(self, id, default=base.InvalidObject, revision=None):
         url = urlparse.urljoin(self.repo, '/'.join(['get', id]))
+        cached = self._cache.get(url, revision)
+        headers = []
+        if cached is not None:
+            etag,value = cached
+            if http_cache.immutable(revision):
+                return value
+            headers.append(('If-None-Match', etag))
         try:
             page,final_url,info = self.get_post_url(
                 url, get=True,
-                data_dict={'revision':revision})
+                data_dict={'revision':revision}, headers=headers)
         except libbe.util.http.HTTPError, e:
-            if not (hasattr(e.error, 'code') and e.error.code in HTTP_VALID):
+            code = getattr(e.error, 'code', None)
+            if code == HTTP_NOT_MODIFIED and cached is not None:
+                return value
+            if code not in HTTP_VALID:
                 raise
-            elif default == base.InvalidObject:
+            self._cache.remove(url, revision)
+            if default == base.InvalidObject:
                 raise base.InvalidID(id)
             return default
         version = info['X-BE-Version']
         if version != libbe.storage.STORAGE_VERSION:
             raise base.InvalidStorageVersion(
                 version, libbe.storage.STORAGE_VERSION)
+        etag = info.get('ETag')
+        if etag is not None:
+            self._cache.set(url, revision, etag, page)
         return page
 
+    def _children_many(self, ids, revision=None):
+        if not ids:
+            return {}
+        url = urlparse.urljoin(self.repo, 'children-many')
+        page,final_url,info = self.get_post_url(
+            url, get=False,
+            data_dict={'ids':'\n'.join(id or '' for id in ids),
+                       'revision':revision})
+        children = {}
+        for id, value in libbe.util.http.decode_frames(page):
+            children[id or None] = value.strip('\n').splitlines()
+        return children
+
+    def _get_many(self, ids, default=base.InvalidObject, revision=None):
+        ids = list(ids)
+        values = {}
+        for id, value in zip(ids, self._read_many(
+                [('get', id, revision) for id in ids])):
+            if value is None:
+                if default == base.InvalidObject:
+                    raise base.InvalidID(id)
+                value = default
+            values[id] = value
+        return values
+
+    def _read_many(self, ops):
+        # cached get values are sent as ETags, or, if read at a full
+        # revision id, not requested at all (see _get())
+        results = [None] * len(ops)
+        cached = {}
+        lines = []
+        indices = []
+        for i, (op,id,revision) in enumerate(ops):
+            fields = [op, revision or '', id or '']
+            if op == 'get':
+                url = urlparse.urljoin(self.repo, '/'.join(['get', id]))
+                cached[i] = (url, self._cache.get(url, revision))
+                if cached[i][1] is not None:
+                    etag,value = cached[i][1]
+                    if http_cache.immutable(revision):
+                        results[i] = value
+                        continue
+                    fields.insert(2, etag)
+            lines.append('\t'.join(fields))
+            indices.append(i)
+        if not lines:
+            return results
+        url = urlparse.urljoin(self.repo, 'batch')
+        page,final_url,info = self.get_post_url(
+            url, get=False, data_dict={'ops':'\n'.join(lines)})
+        version = info['X-BE-Version']
+        if version != libbe.storage.STORAGE_VERSION:
+            raise base.InvalidStorageVersion(
+                version, libbe.storage.STORAGE_VERSION)
+        frames = libbe.util.http.decode_frames(page)
+        for i, (key, value) in zip(indices, frames):
+            op,revision = (ops[i][0], ops[i][2])
+            if key == 'not-modified':
+                value = cached[i][1][1]
+            elif op == 'get':
+                url = cached[i][0]
+                if value is None:
+                    self._cache.remove(url, revision)
+                elif ' ' in key:
+                    self._cache.set(url, revision, key.split(' ', 1)[1],
+                                    value)
+            elif op == 'children':
+                value = value.strip('\n').splitlines()
+            elif op == 'exists':
+                value = value == 'True'
+            results[i] = value
+        return results
+
     def _set(self, id, value):
         url = urlparse.urljoin(self.repo, '/'.join(['set', id]))
         try:
@@ -269,6 +374,8 @@ if TESTING == True:
                 storage=self._storage_backend)
             self.app = libbe.util.wsgi.BEExceptionApp(app=app)
             HTTP.__init__(self, repo='http://localhost:8000/', *args, **kwargs)
+            self._cache = http_cache.HTTPCache(
+                tempfile.mkdtemp(prefix='be-http-cache-'))
             self.intitialized = False
             # duplicated from libbe.util.wsgi.WSGITestCase
             self.default_environ = {
@@ -324,7 +431,8 @@ if TESTING == True:
             scheme,netloc,path,params,query,fragment = urlparse.urlparse(url)
             environ = {}
             for header_name,header_value in headers:
-                environ['HTTP_%s' % header_name] = header_value
+                environ['HTTP_%s' % header_name.upper().replace('-', '_')
+                        ] = header_value
             output = self.getURL(
                 self.app, path, method, data_dict, scheme, environ)
             if self.status != '200 OK':
@@ -353,6 +461,7 @@ if TESTING == True:
             except base.NotSupported:
                 pass
             self._storage_backend._destroy()
+            self._cache.clear()
         def _connect(self):
             self._storage_backend._connect()
             HTTP._connect(self)
@@ -361,6 +470,88 @@ if TESTING == True:
             self._storage_backend._disconnect()
 
 
+    class HTTPCacheTestCase (unittest.TestCase):
+        def setUp(self):
+            self.dir = libbe.util.utility.Dir()
+            self.s = TestingHTTP(self.dir.path)
+            self.s.init()
+            self.s.connect()
+            self.s.add('id', directory=False)
+            self.s.set('id', 'value')
+            self.statuses = []
+            self.pages = []
+            getURL = self.s.getURL
+            def counting_getURL(*args, **kwargs):
+                try:
+                    page = getURL(*args, **kwargs)
+                    self.pages.append(page)
+                    return page
+                finally:
+                    self.statuses.append(self.s.status)
+            self.s.getURL = counting_getURL
+
+        def tearDown(self):
+            self.s.disconnect()
+            self.s.destroy()
+            self.dir.cleanup()
+
+        def test_unchanged_entry_is_not_transferred(self):
+            self.failUnlessEqual(self.s.get('id'), 'value')
+            self.failUnlessEqual(self.s.get('id'), 'value')
+            self.failUnlessEqual(self.statuses, ['200 OK', '304 Not Modified'])
+
+        def test_changed_entry_is_transferred(self):
+            self.s.get('id')
+            self.s.set('id', 'changed')
+            self.failUnlessEqual(self.s.get('id'), 'changed')
+
+        def test_revision_is_revalidated(self):
+            """Revisions that are not full ids may move."""
+            revision = self.s.commit('initial')
+            self.s.set('id', 'changed')
+            self.failUnlessEqual(self.s.get('id', revision=revision), 'value')
+            self.statuses = []
+            self.failUnlessEqual(self.s.get('id', revision=revision), 'value')
+            self.failUnlessEqual(self.statuses, ['304 Not Modified'])
+
+        def test_full_revision_id_is_not_revalidated(self):
+            revision = '0123456789abcdef0123456789abcdef01234567'
+            url = urlparse.urljoin(self.s.repo, 'get/id')
+            self.s._cache.set(url, revision, '"1"', 'cached')
+            self.failUnlessEqual(
+                self.s.get('id', revision=revision), 'cached')
+            self.failUnlessEqual(
+                self.s.read_many([('get', 'id', revision)]), ['cached'])
+            self.failUnlessEqual(self.statuses, [])
+
+        def test_repeated_bulk_load_transfers_no_values(self):
+            ids = ['id %d' % i for i in range(3)]
+            for id in ids:
+                self.s.add(id, directory=False)
+                self.s.set(id, 'value of %s' % id)
+            expected = dict((id, 'value of %s' % id) for id in ids)
+            self.failUnlessEqual(self.s.get_many(ids), expected)
+            self.pages = []
+            self.failUnlessEqual(self.s.get_many(ids), expected)
+            self.failUnlessEqual(
+                self.s.read_many([('get', id) for id in ids]),
+                [expected[id] for id in ids])
+            self.failUnlessEqual(len(self.pages), 2)
+            for page in self.pages:
+                self.failIf('value of' in page, page)
+            self.s.set('id 1', 'changed')
+            self.failUnlessEqual(self.s.get_many(ids)['id 1'], 'changed')
+
+        def test_bulk_load_at_revision_is_revalidated(self):
+            revision = self.s.commit('initial')
+            self.failUnlessEqual(
+                self.s.read_many([('get', 'id', revision)]), ['value'])
+            self.pages = []
+            self.failUnlessEqual(
+                self.s.read_many([('get', 'id', revision)]), ['value'])
+            self.failUnlessEqual(len(self.pages), 1)
+            self.failIf('value' in self.pages[0], self.pages[0])
+
     base.make_versioned_storage_testcase_subclasses(
         TestingHTTP, sys.modules[__name__])
 
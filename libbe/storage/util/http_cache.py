@@ -0,0 +1,266 @@
+# Copyright (C) 2026 agent <agent@local>
+#
+# This file is part of Bugs Everywhere.
+#
+# Bugs Everywhere is free software: you can redistribute it and/or modify it
+# under the terms of the GNU General Public License as published by the Free
+# Software Foundation, either version 2 of the License, or (at your option) any
+# later version.
+#
+# Bugs Everywhere is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+# FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General Public License for
+# more details.
+#
+# You should have received a copy of the GNU General Public License along with
+# Bugs Everywhere.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Per-user cache of entries read by :py:class:`libbe.storage.http.HTTP`.
+
+Each entry is a small pickle of `(ETAG, VALUE)` in :py:func:`path`,
+named after a hash of the request URL and revision.  Entries read at
+a full revision id (see :py:func:`immutable`) never change, so they
+are used as they are.  Other entries, including those read at
+symbolic revisions like ``master``, are revalidated with
+``If-None-Match``, which costs a round trip but no body when nothing
+changed.  The least recently used entries are evicted once the cache
+outgrows :py:data:`CACHE_BUDGET`.
+"""
+
+import cPickle
+import hashlib
+import os
+import os.path
+import re
+import shutil
+import tempfile
+
+import libbe
+
+if libbe.TESTING == True:
+    import doctest
+    import sys
+    import unittest
+
+    import libbe.util.utility
+
+
+CACHE_BUDGET = 64 * 2**20
+"""Bytes of cached entries :py:class:`HTTPCache` keeps by default."""
+
+_FULL_REVISION_ID = re.compile('^([0-9a-f]{40}|[0-9a-f]{64})$')
+
+
+def immutable(revision):
+    """Return True if entries read at `revision` can never change.
+
+    Only full commit hashes qualify.  Names like ``master`` or
+    ``HEAD~1`` move, and abbreviated hashes may become ambiguous.
+
+    >>> immutable('0123456789abcdef0123456789abcdef01234567')
+    True
+    >>> immutable('master')
+    False
+    >>> immutable('0123456')
+    False
+    >>> immutable(None)
+    False
+    """
+    return revision is not None and \
+        _FULL_REVISION_ID.match(revision) is not None
+
+
+def path():
+    """Return the path to the per-user HTTP cache directory.
+
+    Defaults to :file:`~/.cache/bugs-everywhere/http`, but you can
+    override the parent directory with ``XDG_CACHE_HOME``, or the
+    entire path with the ``BE_HTTP_CACHE_PATH`` environment variable.
+    """
+    default_dir = os.path.join('~', '.cache')
+    dirname = os.path.expanduser(
+        os.environ.get('XDG_CACHE_HOME', default_dir))
+    default = os.path.join(dirname, 'bugs-everywhere', 'http')
+    return os.path.expanduser(os.environ.get('BE_HTTP_CACHE_PATH', default))
+
+
+class HTTPCache (object):
+    """On-disk `(etag, value)` cache keyed by URL and revision.
+
+    >>> dir = libbe.util.utility.Dir()
+    >>> cache = HTTPCache(dir.path)
+    >>> cache.get('http://host/get/abc', None)
+    >>> cache.set('http://host/get/abc', None, '"123"', 'value')
+    >>> cache.get('http://host/get/abc', None)
+    ('"123"', 'value')
+    >>> cache.get('http://host/get/abc', '1')
+    >>> cache.remove('http://host/get/abc', None)
+    >>> cache.get('http://host/get/abc', None)
+    >>> dir.cleanup()
+
+    Reading an entry marks it as recently used.  Once more than a
+    quarter of `budget` has been stored, and by :py:meth:`trim`, the
+    least recently used entries are removed until the rest fit in
+    `budget` bytes.
+    """
+    def __init__(self, root=None, budget=CACHE_BUDGET):
+        if root is None:
+            root = path()
+        self.path = root
+        self.budget = budget
+        self._stored = 0  # bytes stored since the last eviction
+
+    def _filename(self, url, revision):
+        key = '{}\n{}'.format(url, '' if revision is None else revision)
+        digest = hashlib.sha1(key).hexdigest()
+        return os.path.join(self.path, digest[:2], digest[2:])
+
+    def get(self, url, revision):
+        """Return the cached `(etag, value)` or `None`."""
+        filename = self._filename(url, revision)
+        try:
+            with open(filename, 'rb') as f:
+                entry = cPickle.load(f)
+        except (IOError, EOFError, ValueError, cPickle.UnpicklingError):
+            return None
+        try:
+            os.utime(filename, None)  # mark as recently used
+        except OSError:
+            pass
+        return entry
+
+    def set(self, url, revision, etag, value):
+        """Store an entry.  Failing to do so (e.g. a read-only home
+        directory) only costs the next read a transfer.
+        """
+        filename = self._filename(url, revision)
+        dirname = os.path.dirname(filename)
+        try:
+            if not os.path.isdir(dirname):
+                os.makedirs(dirname)
+            fd, tmp = tempfile.mkstemp(prefix='.entry.', dir=dirname)
+            with os.fdopen(fd, 'wb') as f:
+                cPickle.dump((etag, value), f, -1)
+            os.rename(tmp, filename)
+        except (IOError, OSError) as e:
+            libbe.LOG.debug('could not cache %s in %s: %s',
+                            url, filename, e)
+            return
+        self._stored += len(value)
+        if self._stored > self.budget / 4:
+            self.evict()
+
+    def remove(self, url, revision):
+        try:
+            os.remove(self._filename(url, revision))
+        except OSError:
+            pass
+
+    def trim(self):
+        """Evict entries if any were stored since the last eviction."""
+        if self._stored:
+            self.evict()
+
+    def evict(self):
+        """Remove the least recently used entries until the cache
+        fits in :py:attr:`budget`.
+        """
+        self._stored = 0
+        entries = []
+        total = 0
+        for dirpath,dirnames,filenames in os.walk(self.path):
+            for name in filenames:
+                filename = os.path.join(dirpath, name)
+                try:
+                    stat = os.stat(filename)
+                except OSError:
+                    continue
+                entries.append((stat.st_mtime, filename, stat.st_size))
+                total += stat.st_size
+        for mtime,filename,size in sorted(entries):
+            if total <= self.budget:
+                break
+            try:
+                os.remove(filename)
+            except OSError:
+                continue
+            total -= size
+
+    def clear(self):
+        """Remove every cached entry."""
+        if os.path.exists(self.path):
+            shutil.rmtree(self.path)
+
+
+if libbe.TESTING == True:
+    class HTTPCacheTestCase (unittest.TestCase):
+        def setUp(self):
+            self.dir = libbe.util.utility.Dir()
+            self.environ = dict(os.environ)
+            self.cache = HTTPCache(os.path.join(self.dir.path, 'http'))
+
+        def tearDown(self):
+            os.environ.clear()
+            os.environ.update(self.environ)
+            self.dir.cleanup()
+
+        def test_revisions_are_separate(self):
+            url = 'http://host/get/abc'
+            self.cache.set(url, None, '"1"', 'working')
+            self.cache.set(url, 'rev', '"2"', 'committed')
+            self.failUnlessEqual(self.cache.get(url, None), ('"1"', 'working'))
+            self.failUnlessEqual(
+                self.cache.get(url, 'rev'), ('"2"', 'committed'))
+
+        def test_clear(self):
+            self.cache.set('http://host/get/abc', None, '"1"', 'value')
+            self.cache.clear()
+            self.failUnlessEqual(
+                self.cache.get('http://host/get/abc', None), None)
+            self.cache.set('http://host/get/abc', None, '"1"', 'value')
+            self.failUnlessEqual(
+                self.cache.get('http://host/get/abc', None), ('"1"', 'value'))
+
+        def test_eviction(self):
+            """The least recently used entries go first."""
+            self.cache.budget = 3000
+            urls = ['http://host/get/%d' % i for i in range(4)]
+            for i, url in enumerate(urls):
+                self.cache.set(url, None, '"1"', 'x' * 500)
+                when = 1000000000 + i
+                os.utime(self.cache._filename(url, None), (when, when))
+            self.cache.get(urls[0], None)  # now the most recently used
+            self.cache.set('http://host/get/new', None, '"1"', 'x' * 1500)
+            self.failUnlessEqual(
+                [url for url in urls if self.cache.get(url, None)],
+                [urls[0], urls[3]])
+            self.failIfEqual(
+                self.cache.get('http://host/get/new', None), None)
+
+        def test_trim(self):
+            """Trimming only evicts after something was stored."""
+            url = 'http://host/get/abc'
+            self.cache.set(url, None, '"1"', 'value')
+            self.cache.evict()
+            filename = self.cache._filename(url, None)
+            os.utime(filename, (1000000000, 1000000000))
+            self.cache.budget = 30
+            self.cache.trim()
+            self.failUnless(os.path.exists(filename))
+            self.cache.set('http://host/get/def', None, '"1"', 'value')
+            self.failUnless(os.path.exists(filename))
+            self.cache.trim()
+            self.failIf(os.path.exists(filename))
+
+        def test_default_path(self):
+            os.environ['XDG_CACHE_HOME'] = self.dir.path
+            os.environ.pop('BE_HTTP_CACHE_PATH', None)
+            self.failUnlessEqual(
+                HTTPCache().path,
+                os.path.join(self.dir.path, 'bugs-everywhere', 'http'))
+            os.environ['BE_HTTP_CACHE_PATH'] = self.dir.path
+            self.failUnlessEqual(HTTPCache().path, self.dir.path)
+
+    unitsuite = unittest.TestLoader().loadTestsFromModule(
+        sys.modules[__name__])
+    suite = unittest.TestSuite([unitsuite, doctest.DocTestSuite()])
@@ -0,0 +1,422 @@
+# Copyright (C) 2026 agent <agent@local>
+#
+# This file is part of Bugs Everywhere.
+#
+# Bugs Everywhere is free software: you can redistribute it and/or modify it
+# under the terms of the GNU General Public License as published by the Free
+# Software Foundation, either version 2 of the License, or (at your option) any
+# later version.
+#
+# Bugs Everywhere is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+# FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General Public License for
+# more details.
+#
+# You should have received a copy of the GNU General Public License along with
+# Bugs Everywhere.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Optional SQLite index of bug metadata.
+
+The index lives in ``.be/index.sqlite`` and holds one row per bug
+with the settings commonly used for filtering and sorting, along with
+the raw ``values`` mapfile, so commands like ``be list`` can select
+bugs without loading every bug from storage.  It is derived data:
+``be reindex`` creates (or rebuilds) it, and rows are revalidated
+against the ``values`` files' size and mtime before each query, so
+changes made behind BE's back (e.g. a ``git pull``) are picked up.
+"""
+
+import contextlib
+import os
+import os.path
+import sqlite3
+import sys
+
+import libbe
+import libbe.bug
+from libbe.storage.base import InvalidID
+
+if libbe.TESTING == True:
+    import doctest
+    import unittest
+
+    import libbe.bugdir
+    import libbe.storage.vcs.base
+    import libbe.util.utility
+
+
+INDEX_NAME = 'index.sqlite'
+
+# see libbe.command.depend.BLOCKS_TAG
+_BLOCKS_TAG = 'BLOCKS:'
+
+_SCHEMA = """CREATE TABLE IF NOT EXISTS bugs (
+    bugdir TEXT NOT NULL,
+    uuid TEXT NOT NULL,
+    status TEXT,
+    severity TEXT,
+    assigned TEXT,
+    creator TEXT,
+    reporter TEXT,
+    time INTEGER,
+    summary TEXT,
+    target TEXT,
+    blocks TEXT,
+    extra_strings TEXT,
+    settings TEXT,
+    mtime REAL,
+    size INTEGER,
+    PRIMARY KEY (bugdir, uuid))"""
+
+_COLUMNS = ['bugdir', 'uuid', 'status', 'severity', 'assigned', 'creator',
+            'reporter', 'time', 'summary', 'target', 'extra_strings',
+            'settings']
+
+_indexes = {}
+
+
+def index_path(storage):
+    """Return the path to `storage`'s index file, or `None` if the
+    storage does not keep its data in a ``.be`` directory.
+    """
+    be_dir = getattr(storage, 'be_dir', None)
+    if be_dir is None:
+        return None
+    return os.path.join(be_dir, INDEX_NAME)
+
+
+def get_index(storage, create=False):
+    """Return the :py:class:`BugIndex` for `storage`.
+
+    Returns `None` if the storage does not support an index, or if
+    the index file does not exist and `create` is `False`.
+    """
+    path = index_path(storage)
+    if path is None:
+        return None
+    index = _indexes.get(path)
+    if not os.path.exists(path):
+        if index is not None:
+            index.disconnect()
+            del _indexes[path]
+        if not create:
+            return None
+        index = None
+    if index is None:
+        index = BugIndex(path)
+        index.connect()
+        _indexes[path] = index
+    return index
+
+
+def remove_index(storage):
+    """Remove `storage`'s index file, if there is one."""
+    path = index_path(storage)
+    if path is None:
+        return
+    index = _indexes.pop(path, None)
+    if index is not None:
+        index.disconnect()
+    if os.path.exists(path):
+        os.remove(path)
+
+
+class IndexedBug (object):
+    """A read-only view of an index row.
+
+    Exposes the same attributes as :py:class:`libbe.bug.Bug` for the
+    indexed settings, so it may be passed to
+    :py:class:`libbe.command.depend.Filter`.
+    """
+    def __init__(self, row):
+        for name in _COLUMNS:
+            setattr(self, name, row[name])
+        if self.extra_strings:
+            self.extra_strings = self.extra_strings.split('\n')
+        else:
+            self.extra_strings = []
+
+    def __repr__(self):
+        return 'IndexedBug(uuid=%r)' % self.uuid
+
+
+class BugIndex (object):
+    """SQLite-backed index of the bugs in a storage.
+
+    >>> dir = libbe.util.utility.Dir()
+    >>> index = BugIndex(os.path.join(dir.path, INDEX_NAME))
+    >>> index.connect()
+    >>> index.select('abc')
+    []
+    >>> index.disconnect()
+    >>> dir.cleanup()
+    """
+    def __init__(self, path):
+        self.path = path
+        self._db = None
+        self._batch_depth = 0
+
+    def connect(self):
+        self._db = sqlite3.connect(self.path)
+        self._db.row_factory = sqlite3.Row
+        self._db.text_factory = unicode
+        # the index can always be rebuilt, so don't pay for durability
+        self._db.execute('PRAGMA synchronous = OFF')
+        self._db.execute(_SCHEMA)
+        self._db.commit()
+
+    def disconnect(self):
+        if self._db is not None:
+            self._db.close()
+            self._db = None
+
+    @contextlib.contextmanager
+    def batch(self):
+        """Commit the changes made inside a `with` block once, when
+        the outermost block exits, instead of after each change.  See
+        :py:meth:`libbe.bugdir.BugDir.batch`.
+        """
+        self._batch_depth += 1
+        try:
+            yield self
+        finally:
+            self._batch_depth -= 1
+            self._commit()
+
+    def _commit(self):
+        if self._batch_depth == 0:
+            self._db.commit()
+
+    def update(self, bug, settings, stat=None):
+        """Store `bug`'s settings in the index.
+
+        `settings` is the bug's ``values`` mapfile contents.  `stat`
+        is the ``(mtime, size)`` of the ``values`` file those contents
+        were read from.  When it is `None` the row is revalidated on
+        the next :py:meth:`refresh`.
+        """
+        row = self._db.execute(
+            'SELECT severity FROM bugs WHERE bugdir = ? AND uuid = ?',
+            (bug.bugdir.uuid, bug.uuid)).fetchone()
+        self._update(bug, settings, stat)
+        if bug.severity == 'target' or (
+                row is not None and row['severity'] == 'target'):
+            # bugs blocking this one may have changed targets
+            self._resolve_targets(
+                'bugdir = ? AND (uuid = ? OR instr(blocks, ?) > 0)',
+                (bug.bugdir.uuid, bug.uuid, '\n%s\n' % bug.uuid))
+        else:
+            self._resolve_targets('bugdir = ? AND uuid = ?',
+                                  (bug.bugdir.uuid, bug.uuid))
+        self._commit()
+
+    def _update(self, bug, settings, stat):
+        if stat is None:
+            stat = (None, None)
+        blocks = [s[len(_BLOCKS_TAG):] for s in bug.extra_strings
+                  if s.startswith(_BLOCKS_TAG)]
+        self._db.execute(
+            'INSERT OR REPLACE INTO bugs (bugdir, uuid, status, severity, '
+            'assigned, creator, reporter, time, summary, blocks, '
+            'extra_strings, settings, mtime, size) '
+            'VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
+            (bug.bugdir.uuid, bug.uuid, bug.status, bug.severity,
+             bug.assigned, bug.creator, bug.reporter, bug.time, bug.summary,
+             ''.join('\n%s\n' % uuid for uuid in blocks),
+             '\n'.join(bug.extra_strings), settings) + tuple(stat))
+
+    def _resolve_targets(self, where=None, args=()):
+        # mirrors libbe.command.target.bug_target()
+        query = (
+            "UPDATE bugs SET target = CASE WHEN severity = 'target' "
+            "THEN summary ELSE (SELECT t.summary FROM bugs AS t "
+            "WHERE t.bugdir = bugs.bugdir AND t.severity = 'target' "
+            "AND instr(bugs.blocks, char(10) || t.uuid || char(10)) > 0 "
+            "LIMIT 1) END")
+        if where is not None:
+            query += ' WHERE ' + where
+        self._db.execute(query, args)
+
+    def remove(self, bugdir_uuid, uuid):
+        self._db.execute('DELETE FROM bugs WHERE bugdir = ? AND uuid = ?',
+                         (bugdir_uuid, uuid))
+        self._resolve_targets('bugdir = ? AND instr(blocks, ?) > 0',
+                              (bugdir_uuid, '\n%s\n' % uuid))
+        self._commit()
+
+    def clear(self):
+        self._db.execute('DELETE FROM bugs')
+        self._commit()
+
+    def rebuild(self, bugdirs):
+        """Replace the index contents with the bugs in `bugdirs`."""
+        with self.batch():
+            self.clear()
+            for bugdir in bugdirs:
+                self.refresh(bugdir)
+
+    def refresh(self, bugdir):
+        """Bring the rows for `bugdir` up to date with its storage.
+
+        Only bugs whose ``values`` file changed size or mtime since
+        they were indexed are read back from storage.
+        """
+        storage = bugdir.storage
+        uuids = set(bugdir.uuids())
+        indexed = dict(
+            (row['uuid'], (row['mtime'], row['size'])) for row in
+            self._db.execute('SELECT uuid, mtime, size FROM bugs '
+                             'WHERE bugdir = ?', (bugdir.uuid,)))
+        stale = {}
+        for uuid in uuids:
+            stat = self._stat(storage, '%s/values' % uuid)
+            if stat is None or indexed.get(uuid) != stat:
+                stale[uuid] = stat
+        removed = [uuid for uuid in indexed if uuid not in uuids]
+        if not stale and not removed:
+            return
+        self._db.executemany(
+            'DELETE FROM bugs WHERE bugdir = ? AND uuid = ?',
+            [(bugdir.uuid, uuid) for uuid in removed])
+        ids = dict(('%s/values' % uuid, uuid) for uuid in stale)
+        values = storage.get_many(ids.keys(), default='{}\n')
+        for id, uuid in ids.items():
+            bug = libbe.bug.Bug(bugdir=bugdir, uuid=uuid, from_storage=True)
+            bug.load_settings(values[id])
+            self._update(bug, values[id], stale[uuid])
+        self._resolve_targets()
+        self._commit()
+
+    def _stat(self, storage, id):
+        try:
+            st = os.stat(storage.path(id, relpath=False))
+        except (InvalidID, OSError):
+            return None
+        return (st.st_mtime, st.st_size)
+
+    def select(self, bugdir_uuid, status='all', severity='all'):
+        """Return :py:class:`IndexedBug`\s for the bugs in the bugdir
+        `bugdir_uuid` matching `status` and `severity`.
+
+        As with :py:class:`libbe.command.depend.Filter`, each of
+        `status` and `severity` is either ``'all'`` or a list of
+        accepted values.
+        """
+        query = 'SELECT * FROM bugs WHERE bugdir = ?'
+        args = [bugdir_uuid]
+        for name, value in [('status', status), ('severity', severity)]:
+            if value != 'all':
+                query += ' AND %s IN (%s)' % (
+                    name, ', '.join('?' * len(value)))
+                args.extend(value)
+        query += ' ORDER BY uuid'
+        return [IndexedBug(row) for row in self._db.execute(query, args)]
+
+
+if libbe.TESTING == True:
+    class BugIndexTestCase (unittest.TestCase):
+        """Test cases for :py:class:`BugIndex`."""
+        def setUp(self):
+            self.dir = libbe.util.utility.Dir()
+            self.storage = libbe.storage.vcs.base.VCS(repo=self.dir.path)
+            self.storage.init()
+            self.storage.connect()
+            self.bugdir = libbe.bugdir.BugDir(self.storage, uuid='abc')
+            self.bug_a = self.bugdir.new_bug(summary='Bug A', _uuid='a')
+            self.bug_b = self.bugdir.new_bug(summary='Bug B', _uuid='b')
+            self.bug_b.status = 'closed'
+
+        def tearDown(self):
+            remove_index(self.storage)
+            self.storage.disconnect()
+            self.storage.destroy()
+            self.dir.cleanup()
+
+        def _uuids(self, index, **kwargs):
+            return [b.uuid for b in index.select(self.bugdir.uuid, **kwargs)]
+
+        def test_optional(self):
+            """The index is only used once it has been created."""
+            self.assertEqual(get_index(self.storage), None)
+            index = get_index(self.storage, create=True)
+            self.assertTrue(get_index(self.storage) is index)
+            remove_index(self.storage)
+            self.assertEqual(get_index(self.storage), None)
+
+        def test_rebuild(self):
+            index = get_index(self.storage, create=True)
+            index.rebuild([self.bugdir])
+            self.assertEqual(self._uuids(index), ['a', 'b'])
+            self.assertEqual(self._uuids(index, status=['closed']), ['b'])
+            bugs = index.select(self.bugdir.uuid, status=['open'])
+            self.assertEqual(bugs[0].summary, 'Bug A')
+            self.assertEqual(bugs[0].severity, 'minor')
+
+        def test_save_settings(self):
+            """Bug changes are written through to the index."""
+            index = get_index(self.storage, create=True)
+            index.rebuild([self.bugdir])
+            self.bug_a.status = 'fixed'
+            self.assertEqual(self._uuids(index, status=['fixed']), ['a'])
+            self.bugdir.remove_bug(self.bug_b)
+            self.assertEqual(self._uuids(index), ['a'])
+
+        def test_refresh(self):
+            """Changes made behind BE's back are picked up by refresh()."""
+            index = get_index(self.storage, create=True)
+            index.clear()
+            index.refresh(self.bugdir)
+            self.assertEqual(self._uuids(index), ['a', 'b'])
+            self.storage.set('a/values', '{"status": "fixed"}\n')
+            self.storage.recursive_remove(self.bug_b.id.storage())
+            self.bugdir._clear_bugs()
+            index.refresh(self.bugdir)
+            self.assertEqual(self._uuids(index, status=['fixed']), ['a'])
+            self.assertEqual(self._uuids(index), ['a'])
+
+        def test_target(self):
+            target = self.bugdir.new_bug(summary='1.0', _uuid='t')
+            target.severity = 'target'
+            self.bug_a.extra_strings = ['%st' % _BLOCKS_TAG]
+            index = get_index(self.storage, create=True)
+            index.rebuild([self.bugdir])
+            self.assertEqual(self._targets(index),
+                             {'a': '1.0', 'b': None, 't': '1.0'})
+            target.summary = '1.1'
+            self.assertEqual(self._targets(index),
+                             {'a': '1.1', 'b': None, 't': '1.1'})
+            self.bugdir.remove_bug(target)
+            self.assertEqual(self._targets(index), {'a': None, 'b': None})
+
+        def test_batch_commits_once(self):
+            """Changes inside BugDir.batch() are committed together."""
+            index = get_index(self.storage, create=True)
+            index.rebuild([self.bugdir])
+            commits = []
+            db = index._db
+            class Connection (object):
+                def commit(self):
+                    commits.append(True)
+                    db.commit()
+                def __getattr__(self, name):
+                    return getattr(db, name)
+            index._db = Connection()
+            try:
+                with self.bugdir.batch():
+                    self.bug_a.status = 'fixed'
+                    self.bug_a.severity = 'serious'
+                    self.bug_b.status = 'open'
+                    self.assertEqual(commits, [])
+            finally:
+                index._db = db
+            self.assertEqual(len(commits), 1)
+            self.assertEqual(self._uuids(index, status=['open']), ['b'])
+            self.assertEqual(self._uuids(index, severity=['serious']), ['a'])
+
+        def _targets(self, index):
+            return dict((b.uuid, b.target)
+                        for b in index.select(self.bugdir.uuid))
+
+    unitsuite = unittest.TestLoader().loadTestsFromModule(
+        sys.modules[__name__])
+    suite = unittest.TestSuite([unitsuite, doctest.DocTestSuite()])
@@ -0,0 +1,226 @@
+# Copyright (C) 2026 agent <agent@local>
+#
+# This file is part of Bugs Everywhere.
+#
+# Bugs Everywhere is free software: you can redistribute it and/or modify it
+# under the terms of the GNU General Public License as published by the Free
+# Software Foundation, either version 2 of the License, or (at your option) any
+# later version.
+#
+# Bugs Everywhere is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+# FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General Public License for
+# more details.
+#
+# You should have received a copy of the GNU General Public License along with
+# Bugs Everywhere.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Per-user cache of what the VCS backends found out about their
+executables.
+
+Looking for ``git`` in ``PATH`` and asking it for its version costs a
+process per BE invocation.  The answers are kept in a small JSON file
+at :py:func:`path`::
+
+    {NAME: {"PATH": PATH, "path": EXECUTABLE, "mtime": MTIME,
+            "version": VERSION}, ...}
+
+An entry is only used while ``PATH`` is unchanged and the executable
+still has the recorded modification time, so upgrading a VCS
+invalidates it.
+"""
+
+import distutils.spawn
+import json
+import os
+import os.path
+import tempfile
+
+import libbe
+
+if libbe.TESTING == True:
+    import doctest
+    import sys
+    import unittest
+
+    import libbe.util.utility
+
+
+_cache = None  # loaded from path() on first use
+
+
+def path():
+    """Return the path to the per-user probe cache.
+
+    Defaults to :file:`~/.cache/bugs-everywhere/vcs-probes`, but you
+    can override the directory with ``XDG_CACHE_HOME``, or the entire
+    path with the ``BE_PROBE_CACHE_PATH`` environment variable.
+    """
+    default_dir = os.path.join('~', '.cache')
+    dirname = os.path.expanduser(
+        os.environ.get('XDG_CACHE_HOME', default_dir))
+    default = os.path.join(dirname, 'bugs-everywhere', 'vcs-probes')
+    return os.path.expanduser(os.environ.get('BE_PROBE_CACHE_PATH', default))
+
+
+def _load():
+    global _cache
+    if _cache is None:
+        try:
+            with open(path(), 'r') as f:
+                _cache = json.load(f)
+        except (IOError, ValueError):
+            _cache = {}
+        if not isinstance(_cache, dict):
+            _cache = {}
+    return _cache
+
+
+def _save():
+    """Write the cache back.  Failing to do so (e.g. a read-only home
+    directory) only costs the next invocation a few probes.
+    """
+    filename = path()
+    dirname = os.path.dirname(filename)
+    try:
+        if not os.path.isdir(dirname):
+            os.makedirs(dirname)
+        fd, tmp = tempfile.mkstemp(prefix='.vcs-probes.', dir=dirname)
+        with os.fdopen(fd, 'w') as f:
+            json.dump(_cache, f, indent=1, sort_keys=True)
+        os.rename(tmp, filename)
+    except (IOError, OSError) as e:
+        libbe.LOG.debug('could not save VCS probes to %s: %s', filename, e)
+
+
+def _mtime(executable):
+    try:
+        return os.stat(executable).st_mtime
+    except OSError:
+        return None
+
+
+def _entry(name):
+    """Return the valid cache entry for the executable `name`, probing
+    for its path if there is none.  Returns `None` if `name` is not
+    installed.
+    """
+    cache = _load()
+    search_path = os.environ.get('PATH', os.defpath)
+    entry = cache.get(name)
+    if entry is not None and entry.get('PATH') == search_path \
+            and _mtime(entry['path']) == entry['mtime']:
+        return entry
+    executable = distutils.spawn.find_executable(name)
+    if executable is None:  # not cached, it might be installed any time
+        return None
+    entry = {'PATH': search_path, 'path': executable,
+             'mtime': _mtime(executable)}
+    cache[name] = entry
+    _save()
+    return entry
+
+
+def find_executable(name):
+    """Return the full path to the executable `name`, or `None` if it
+    is not in ``PATH``.
+    """
+    entry = _entry(name)
+    if entry is None:
+        return None
+    return entry['path']
+
+
+def version(name, probe):
+    """Return the version string of the executable `name`.
+
+    `probe()` is only called (and must return the version string) if
+    the cache has no version for the current executable.  Versions of
+    executables that are not installed, and `None` versions, are not
+    cached.
+    """
+    entry = _entry(name)
+    if entry is None:
+        return probe()
+    if entry.get('version') is None:
+        ver = probe()
+        if ver is None:
+            return None
+        entry['version'] = ver
+        _save()
+    return entry['version']
+
+
+def clear():
+    """Forget the cached probes, in memory and on disk."""
+    global _cache
+    _cache = {}
+    if os.path.exists(path()):
+        os.remove(path())
+
+
+if libbe.TESTING == True:
+    class ProbesTestCase (unittest.TestCase):
+        def setUp(self):
+            global _cache
+            self.dir = libbe.util.utility.Dir()
+            self.environ = dict(os.environ)
+            os.environ['BE_PROBE_CACHE_PATH'] = os.path.join(
+                self.dir.path, 'probes')
+            bindir = os.path.join(self.dir.path, 'bin')
+            os.mkdir(bindir)
+            os.environ['PATH'] = bindir
+            self.executable = os.path.join(bindir, 'fakevcs')
+            with open(self.executable, 'w') as f:
+                f.write('#!/bin/sh\n')
+            os.chmod(self.executable, 0755)
+            self._cache = _cache
+            _cache = None
+            self.probes = []
+
+        def tearDown(self):
+            global _cache
+            _cache = self._cache
+            os.environ.clear()
+            os.environ.update(self.environ)
+            self.dir.cleanup()
+
+        def probe(self):
+            self.probes.append(None)
+            return '1.2.%d' % len(self.probes)
+
+        def test_find_executable(self):
+            self.failUnlessEqual(find_executable('fakevcs'), self.executable)
+            self.failUnlessEqual(find_executable('missingvcs'), None)
+
+        def test_version_is_probed_once(self):
+            self.failUnlessEqual(version('fakevcs', self.probe), '1.2.1')
+            self.failUnlessEqual(version('fakevcs', self.probe), '1.2.1')
+            self.failUnlessEqual(len(self.probes), 1)
+
+        def test_version_persists(self):
+            global _cache
+            version('fakevcs', self.probe)
+            _cache = None  # as in a new process
+            self.failUnlessEqual(version('fakevcs', self.probe), '1.2.1')
+            self.failUnlessEqual(len(self.probes), 1)
+
+        def test_changed_executable_is_probed_again(self):
+            version('fakevcs', self.probe)
+            mtime = os.stat(self.executable).st_mtime
+            os.utime(self.executable, (mtime + 10, mtime + 10))
+            self.failUnlessEqual(version('fakevcs', self.probe), '1.2.2')
+
+        def test_changed_path_is_probed_again(self):
+            version('fakevcs', self.probe)
+            os.environ['PATH'] = os.pathsep.join(
+                [os.environ['PATH'], self.dir.path])
+            self.failUnlessEqual(version('fakevcs', self.probe), '1.2.2')
+
+        def test_missing_executable_is_not_cached(self):
+            self.failUnlessEqual(version('missingvcs', self.probe), '1.2.1')
+            self.failUnlessEqual(version('missingvcs', self.probe), '1.2.2')
+
+    unitsuite = unittest.TestLoader().loadTestsFromModule(
+        sys.modules[__name__])
+    suite = unittest.TestSuite([unitsuite, doctest.DocTestSuite()])
@@ -0,0 +1,321 @@
+# Copyright (C) 2026 agent <agent@local>
+#
+# This file is part of Bugs Everywhere.
+#
+# Bugs Everywhere is free software: you can redistribute it and/or modify it
+# under the terms of the GNU General Public License as published by the Free
+# Software Foundation, either version 2 of the License, or (at your option) any
+# later version.
+#
+# Bugs Everywhere is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+# FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General Public License for
+# more details.
+#
+# You should have received a copy of the GNU General Public License along with
+# Bugs Everywhere.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Snapshots of the bug and comment settings in a storage.
+
+A snapshot holds the ``values`` of every bug and comment in a single
+JSON file under ``.be/cache``, named after a cheap fingerprint of the
+``.be`` tree (see :py:meth:`libbe.storage.vcs.base.VCS.snapshot_key`),
+so a fully loaded :py:class:`~libbe.bugdir.BugDir` can be rebuilt with
+one read as long as nothing has changed.  The snapshot data maps bugdir
+uuids to::
+
+    {BUG-UUID: [BUG-VALUES, {COMMENT-UUID: COMMENT-VALUES, ...}], ...}
+
+where the comment values are `None` until that bug's comments have
+been loaded once (see :py:meth:`Snapshot.add_comments`).
+
+The file is inside the working tree, where anything could put it, so
+it is plain JSON rather than a pickle.
+"""
+
+import glob
+import json
+import os
+import os.path
+import tempfile
+
+import libbe
+
+if libbe.TESTING == True:
+    import doctest
+    import sys
+    import unittest
+
+    import libbe.bugdir
+    import libbe.storage.vcs.base
+    import libbe.util.utility
+
+
+SNAPSHOT_DIR = 'cache'
+
+_snapshots = {}
+
+
+def current_key(storage):
+    """Return the snapshot key for `storage`'s current contents, or
+    `None` if `storage` does not support snapshots.
+    """
+    if getattr(storage, 'be_dir', None) is None:
+        return None
+    return storage.snapshot_key()
+
+
+def _path(storage, key):
+    return os.path.join(storage.be_dir, SNAPSHOT_DIR,
+                        'snapshot-%s.json' % key)
+
+
+def load(storage, key):
+    """Return the snapshot data stored under `key`, or `None` if there
+    is none.
+    """
+    if key is None:
+        return None
+    path = _path(storage, key)
+    if path not in _snapshots:
+        try:
+            with open(path, 'rb') as f:
+                data = json.load(f)
+        except (IOError, ValueError):
+            return None
+        if not isinstance(data, dict):
+            return None
+        _snapshots[path] = data
+    return _snapshots[path]
+
+
+def save(storage, key, bugdir_uuid, bugs):
+    """Store `bugs` for the bugdir `bugdir_uuid` under `key`.
+
+    Snapshots stored under other keys are removed.  Failing to write
+    the snapshot is not an error, it is only a cache.
+    """
+    path = _path(storage, key)
+    data = dict(load(storage, key) or {})
+    data[bugdir_uuid] = bugs
+    dirname = os.path.dirname(path)
+    try:
+        if not os.path.isdir(dirname):
+            os.mkdir(dirname)
+        descriptor, filename = tempfile.mkstemp(dir=dirname)
+        try:
+            with os.fdopen(descriptor, 'wb') as f:
+                json.dump(data, f, separators=(',', ':'))
+        except ValueError:  # e.g. values that are not UTF-8
+            os.remove(filename)
+            return
+        os.rename(filename, path)
+        # also removes pickles written by older BEs
+        for old in glob.glob(os.path.join(dirname, 'snapshot-*')):
+            if old != path:
+                os.remove(old)
+                _snapshots.pop(old, None)
+    except (IOError, OSError):
+        return
+    _snapshots[path] = data
+
+
+class Snapshot (object):
+    """The snapshot of `storage` as seen by one command.
+
+    Computing the key can mean walking all of ``.be``, so it is only
+    done when the snapshot is first used, and again only after
+    `storage` has been written to.  Comment values are collected with
+    :py:meth:`add_comments` as bugs load their comments, and written
+    out by :py:meth:`flush`.
+    """
+    def __init__(self, storage):
+        self.storage = storage
+        self._key = None
+        self._writes = None  # storage.writes when _key was computed
+        self._dirty = set()  # bugdir uuids with unsaved comment values
+
+    def _current(self):
+        return self._writes == self.storage.writes
+
+    def key(self):
+        """Return the snapshot key, see :py:func:`current_key`."""
+        if not self._current():
+            self._key = current_key(self.storage)
+            self._writes = self.storage.writes
+            self._dirty.clear()
+        return self._key
+
+    def load(self):
+        """Return the snapshot data, or `None` if there is none."""
+        return load(self.storage, self.key())
+
+    def save(self, bugdir_uuid, bugs):
+        """Store `bugs`, read since the last :py:meth:`key`, for the
+        bugdir `bugdir_uuid`.
+        """
+        if self._current() and self._key is not None:
+            save(self.storage, self._key, bugdir_uuid, bugs)
+            self._dirty.discard(bugdir_uuid)
+
+    def add_comments(self, bugdir_uuid, bug_uuid, values):
+        """Fill in the comment `values` for a bug whose snapshot entry
+        does not have them yet.  Nothing is written until
+        :py:meth:`flush`.
+        """
+        if not self._current() or self._key is None:
+            return
+        bugs = (load(self.storage, self._key) or {}).get(bugdir_uuid)
+        if bugs is None or bugs.get(bug_uuid, [None, {}])[1] is not None:
+            return
+        bugs[bug_uuid] = [bugs[bug_uuid][0], values]
+        self._dirty.add(bugdir_uuid)
+
+    def flush(self):
+        """Write out comment values added since the last save."""
+        if self._dirty and self._current() and self._key is not None:
+            data = load(self.storage, self._key) or {}
+            for bugdir_uuid in sorted(self._dirty):
+                if bugdir_uuid in data:
+                    save(self.storage, self._key, bugdir_uuid,
+                         data[bugdir_uuid])
+        self._dirty.clear()
+
+
+if libbe.TESTING == True:
+    class SnapshotTestCase (unittest.TestCase):
+        """Test cases for snapshot loading and saving."""
+        def setUp(self):
+            self.dir = libbe.util.utility.Dir()
+            self.storage = libbe.storage.vcs.base.VCS(repo=self.dir.path)
+            self.storage.init()
+            self.storage.connect()
+            libbe.storage.vcs.base.age_be_dir(self.storage.be_dir)
+
+        def tearDown(self):
+            self.storage.disconnect()
+            self.storage.destroy()
+            self.dir.cleanup()
+
+        def test_key(self):
+            """The key changes with the .be contents, not the cache."""
+            key = current_key(self.storage)
+            self.assertNotEqual(key, None)
+            self.assertEqual(current_key(self.storage), key)
+            save(self.storage, key, 'abc', {})
+            self.assertEqual(current_key(self.storage), key)
+            self.storage.add('abc', directory=True)
+            self.storage.add('abc/settings', parent='abc')
+            self.storage.set('abc/settings', 'x')
+            libbe.storage.vcs.base.age_be_dir(self.storage.be_dir)
+            self.assertNotEqual(current_key(self.storage), key)
+            with self.storage.transaction():
+                self.storage.set('abc/settings', 'y')
+                self.assertEqual(current_key(self.storage), None)
+
+        def test_racy_edit(self):
+            """Same-size edits within the mtime resolution change the
+            key, or leave no key at all.
+            """
+            self.storage.add('abc', directory=True)
+            self.storage.add('abc/settings', parent='abc')
+            self.storage.set('abc/settings', 'minor')
+            self.assertEqual(current_key(self.storage), None)
+            libbe.storage.vcs.base.age_be_dir(self.storage.be_dir)
+            key = current_key(self.storage)
+            path = os.path.join(self.storage.be_dir, 'abc', 'settings')
+            mtime = os.stat(path).st_mtime
+            self.storage.set('abc/settings', 'major')
+            self.assertEqual(current_key(self.storage), None)
+            os.utime(path, (mtime, mtime))
+            self.assertNotEqual(current_key(self.storage), key)
+
+        def test_save(self):
+            key = current_key(self.storage)
+            self.assertEqual(load(self.storage, key), None)
+            bugs = {'a': ('{}\n', {'c': '{}\n'})}
+            save(self.storage, key, 'abc', bugs)
+            save(self.storage, key, 'def', {})
+            _snapshots.clear()
+            self.assertEqual(load(self.storage, key),
+                             {'abc': {'a': ['{}\n', {'c': '{}\n'}]},
+                              'def': {}})
+            save(self.storage, 'other-key', 'abc', {})
+            _snapshots.clear()
+            self.assertEqual(load(self.storage, key), None)
+            self.assertEqual(self.storage.children(), [])
+
+        def test_not_a_pickle(self):
+            """Snapshots are JSON, and anything else is ignored."""
+            key = current_key(self.storage)
+            save(self.storage, key, 'abc', {'a': ('{}\n', {})})
+            with open(_path(self.storage, key), 'rb') as f:
+                self.assertEqual(json.load(f), {'abc': {'a': ['{}\n', {}]}})
+            with open(_path(self.storage, key), 'wb') as f:
+                f.write("cos\nsystem\n(S'echo unsafe'\ntR.")
+            _snapshots.clear()
+            self.assertEqual(load(self.storage, key), None)
+
+        def test_load_all_bugs(self):
+            bugdir = libbe.bugdir.BugDir(self.storage, uuid='abc')
+            bug = bugdir.new_bug(summary='Bug A', _uuid='a')
+            bug.comment_root.new_reply(body='comment A')
+            libbe.storage.vcs.base.age_be_dir(self.storage.be_dir)
+            bugdir.load_all_bugs()
+            key = current_key(self.storage)
+            self.assertEqual(sorted(load(self.storage, key)['abc']), ['a'])
+            bugdir = libbe.bugdir.BugDir(
+                self.storage, uuid='abc', from_storage=True)
+            bugdir.load_all_bugs()
+            bug = bugdir.bug_from_uuid('a')
+            self.assertEqual(bug.summary, 'Bug A')
+            self.assertEqual([c.body for c in bug.comments()],
+                             ['comment A'])
+            self.storage.set('a/values', '{"summary": "Bug B"}\n')
+            bugdir.load_all_bugs()
+            self.assertEqual(bugdir.bug_from_uuid('a').summary, 'Bug B')
+
+        def test_lazy_key(self):
+            """The key is computed once, when first used, and again
+            only after writes.
+            """
+            calls = []
+            snapshot_key = self.storage.snapshot_key
+            def counting_snapshot_key():
+                calls.append(None)
+                return snapshot_key()
+            self.storage.snapshot_key = counting_snapshot_key
+            snapshot = Snapshot(self.storage)
+            bugdir = libbe.bugdir.BugDir(
+                self.storage, uuid='abc', snapshot=snapshot)
+            bug = bugdir.new_bug(summary='Bug A', _uuid='a')
+            self.assertEqual(len(calls), 0)
+            libbe.storage.vcs.base.age_be_dir(self.storage.be_dir)
+            bugdir.load_all_bugs()
+            bugdir.load_all_bugs()
+            self.assertEqual(len(calls), 1)
+            bugdir.bug_from_uuid('a').summary = 'Bug B'
+            bugdir.load_all_bugs()
+            self.assertEqual(len(calls), 2)
+
+        def test_comments_added_lazily(self):
+            """Comments are not read just to save a snapshot."""
+            bugdir = libbe.bugdir.BugDir(self.storage, uuid='abc')
+            bug = bugdir.new_bug(summary='Bug A', _uuid='a')
+            bug.comment_root.new_reply(body='comment A')
+            libbe.storage.vcs.base.age_be_dir(self.storage.be_dir)
+            bugdir = libbe.bugdir.BugDir(
+                self.storage, uuid='abc', from_storage=True)
+            bugdir.load_all_bugs()
+            key = current_key(self.storage)
+            self.assertEqual(load(self.storage, key)['abc']['a'][1], None)
+            comments = list(bugdir.bug_from_uuid('a').comments())
+            bugdir.snapshot.flush()
+            _snapshots.clear()
+            self.assertEqual(
+                load(self.storage, key)['abc']['a'][1].values(),
+                [self.storage.get(comments[0].id.storage('values'))])
+
+    unitsuite = unittest.TestLoader().loadTestsFromModule(
+        sys.modules[__name__])
+    suite = unittest.TestSuite([unitsuite, doctest.DocTestSuite()])
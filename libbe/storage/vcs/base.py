@@ -27,15 +27,25 @@ base class implements a "do not version" VCS.
 """
 
 import codecs
+import hashlib
+import mmap
 import os
 import os.path
 import re
 import shutil
 import sys
 import tempfile
+import time
 
 import semver
 
+try:
+    # the scandir backport's walk() gets entry types from the directory
+    # listing instead of calling stat() on every entry
+    from scandir import walk as _walk
+except ImportError:
+    from os import walk as _walk  # uses os.scandir since Python 3.5
+
 import libbe
 import libbe.storage
 import libbe.util.encoding
@@ -44,12 +54,13 @@ from libbe.util.utility import Dir, search_parent_directories
 from libbe.util.subproc import invoke
 from libbe.util.plugin import import_by_name
 
-from libbe.unidiff import PatchSet
+import libbe.unidiff
 
 if libbe.TESTING:
     import unittest
     import doctest
 
+    import libbe.bugdir
     import libbe.ui.util.user
 
 VCS_ORDER = ['bzr', 'darcs', 'git', 'hg']
@@ -58,6 +69,39 @@ VCS_ORDER = ['bzr', 'darcs', 'git', 'hg']
 Don't list this module, it is implicitly last.
 """
 
+VCS_MARKERS = {'bzr': '.bzr', 'darcs': '_darcs', 'git': '.git', 'hg': '.hg'}
+"""Map VCS modules to the file or directory marking their repository
+roots, see :py:func:`detect_vcs`.
+"""
+
+BE_DIR_CACHES = ['id-cache', 'id-cache.journal', 'index.sqlite',
+                 'index.sqlite-journal', 'cache']
+"""Unversioned files and directories BE keeps in ``.be`` next to the
+bugdirs.
+"""
+
+SNAPSHOT_RACY_WINDOW = 2
+"""Seconds a file in ``.be`` must be left alone before the non-git
+snapshot key trusts its timestamps, see :py:meth:`VCS._vcs_snapshot_key`.
+Journaled id-cache misses use it as well, see :py:meth:`CachedPathID._find`.
+Two seconds covers FAT, the coarsest filesystem BE is likely to meet.
+"""
+
+REVISION_INDEX = os.path.join('cache', 'revisions')
+"""Path (relative to ``.be``) of the persisted revision index, see
+:py:meth:`VCS._u_revisions`.
+"""
+
+
+def _listdir(path):
+    """Return the entries of the directory path, or an empty list if
+    it is not a directory.
+    """
+    try:
+        return os.listdir(path)
+    except OSError:
+        return []
+
 
 def set_preferred_vcs(name):
     """Manipulate :py:data:`VCS_ORDER` to place `name` first.
@@ -71,12 +115,14 @@ def set_preferred_vcs(name):
     VCS_ORDER.insert(0, name)
 
 
-def _get_matching_vcs(matchfn):
+def _get_matching_vcs(matchfn, names=None):
     """Return the first module for which matchfn(VCS_instance) is True.
 
-    Searches in :py:data:`VCS_ORDER`.
+    Searches in `names`, which defaults to :py:data:`VCS_ORDER`.
     """
-    for submodname in VCS_ORDER:
+    if names is None:
+        names = VCS_ORDER
+    for submodname in names:
         module = import_by_name('libbe.storage.vcs.%s' % submodname)
         vcs = module.new()
         if matchfn(vcs):
@@ -94,12 +140,46 @@ def vcs_by_name(vcs_name):
     return _get_matching_vcs(lambda vcs: vcs.name == vcs_name)
 
 
+def _find_vcs_markers(path):
+    """Return the VCS modules whose :py:data:`VCS_MARKERS` are in the
+    closest of `path` and its parents, in :py:data:`VCS_ORDER`.
+
+    >>> d = Dir()
+    >>> os.mkdir(os.path.join(d.path, '.hg'))
+    >>> os.makedirs(os.path.join(d.path, 'sub', '.git'))
+    >>> os.mkdir(os.path.join(d.path, 'sub', '_darcs'))
+    >>> _find_vcs_markers(d.path)
+    ['hg']
+    >>> sorted(_find_vcs_markers(os.path.join(d.path, 'sub', '_darcs')))
+    ['darcs', 'git']
+    >>> _find_vcs_markers(os.path.join(d.path, 'missing'))
+    []
+    >>> d.cleanup()
+    """
+    path = os.path.realpath(path)
+    if not os.path.exists(path):
+        return []
+    while True:
+        names = [name for name in VCS_ORDER
+                 if os.path.exists(os.path.join(path, VCS_MARKERS[name]))]
+        if names:
+            return names
+        parent = os.path.dirname(path)
+        if parent == path:
+            return []
+        path = parent
+
+
 def detect_vcs(_dir):
     """Return an VCS instance for the vcs being used in this directory.
 
-    Searches in :py:data:`VCS_ORDER`.
+    The VCS is chosen by the repository markers (see
+    :py:data:`VCS_MARKERS`) closest to `_dir`, preferring modules early
+    in :py:data:`VCS_ORDER` if there are several, so only the matching
+    backend is imported and no VCS executable is run.
     """
-    return _get_matching_vcs(lambda vcs: vcs._detect(_dir))
+    return _get_matching_vcs(lambda vcs: True,
+                             names=_find_vcs_markers(_dir))
 
 
 def installed_vcs():
@@ -179,7 +259,7 @@ class CachedPathID (object):
     'def/values'
     >>> c.init()
     >>> sorted(os.listdir(os.path.join(c._root, '.be')))
-    ['abc', 'id-cache']
+    ['abc', 'id-cache', 'id-cache.journal']
     >>> c.connect()
     >>> c.path('123/values') # doctest: +ELLIPSIS
     u'.../.be/abc/bugs/123/values'
@@ -189,7 +269,7 @@ class CachedPathID (object):
     ['abc']
     >>> c.connect() # demonstrate auto init
     >>> sorted(os.listdir(os.path.join(c._root, '.be')))
-    ['abc', 'id-cache']
+    ['abc', 'id-cache', 'id-cache.journal']
     >>> c.add_id(u'xyz', parent=None) # doctest: +ELLIPSIS
     u'.../.be/xyz'
     >>> c.add_id('xyz/def', parent='xyz') # doctest: +ELLIPSIS
@@ -205,54 +285,93 @@ class CachedPathID (object):
     Traceback (most recent call last):
       ...
     InvalidID: qrs in revision None
+    >>> c.add_id('qrs', parent='123') # doctest: +ELLIPSIS
+    u'.../.be/abc/bugs/123/comments/qrs'
+    >>> print ' '.join(sorted(c.remove_tree('abc')))
+    123 456 abc def qrs
+    >>> c.path('def')
+    Traceback (most recent call last):
+      ...
+    InvalidID: def in revision None
     >>> c.disconnect()
     >>> c.destroy()
     >>> dir.cleanup()
     """
     def __init__(self, encoding=None):
         self.encoding = libbe.util.encoding.get_text_file_encoding()
-        self._cache = {}  # key: uuid, value: path
-        self._changed = False
+        self._cache = {}  # key: uuid, value: path (overrides the base file)
+        self._removed = set()  # uuids removed since the base was written
+        self._missing = set()  # uuids known not to exist
+        self._misses = {}  # key: uuid, value: stamp of a journaled miss
+        self._journal = []  # records to append on disconnect
+        self._base = ''  # sorted base file contents (an mmap when open)
+        self._base_file = None
+        self._changed = False  # rewrite the base file on disconnect
+        self._child_ids = None  # key: parent uuid, value: set of uuids
         self._spacer_dirs = ['.be', 'bugs', 'comments']
 
     def root(self, path):
         self._root = os.path.abspath(path).rstrip(os.path.sep)
         self._cache_path = os.path.join(
             self._root, self._spacer_dirs[0], 'id-cache')
+        self._journal_path = self._cache_path + '.journal'
 
     def init(self, cache=None):
         """Create cache file for an existing .be directory.
 
-        The file contains multiple lines of the form::
+        The cache is stored in two files.  The base file contains
+        multiple lines of the form::
 
             UUID\tPATH
+
+        sorted by UUID, so lookups can binary-search it in place.  The
+        journal file records later changes, one per line::
+
+            +UUID\tPATH
+            -UUID
+            ?UUID\tSTAMP
+
+        where ``?`` records a uuid :py:meth:`_find` could not find
+        while the bugdirs and bug lists matched STAMP (see
+        :py:meth:`_miss_stamp`).
+
+        and is folded back into the base file by :py:meth:`compact`.
         """
         if cache is not None:
             self._cache = cache
+        else:
+            self._changed = True
+        self._missing = set()
+        self._misses = {}
 
+        seen = {}
         spaced_root = os.path.join(self._root, self._spacer_dirs[0])
-        for dirpath, _, __ in os.walk(spaced_root, followlinks=True):
+        for dirpath, dirnames, __ in os.walk(spaced_root, followlinks=True):
             if dirpath == spaced_root:
+                dirnames[:] = [d for d in dirnames if d not in BE_DIR_CACHES]
                 continue
             try:
                 _id = self.id(dirpath)
                 relpath = dirpath[len(self._root + os.path.sep):]
                 if _id.count('/') == 0:
-                    if _id in self._cache:
+                    if _id in seen:
                         libbe.LOG.warning(
                             'multiple paths for {0}:\n  {1}\n  {2}'.format(
-                                _id, self._cache[_id], relpath))
-                    self._cache[_id] = relpath
+                                _id, seen[_id], relpath))
+                    seen[_id] = relpath
+                    if self._lookup(_id) != relpath:
+                        self._cache[_id] = relpath
+                        self._removed.discard(_id)
+                        self._changed = True
             except InvalidPath:
                 pass
-        if self._cache != cache:
-            self._changed = True
         if cache is None:
             self.disconnect()
 
     def destroy(self):
-        if os.path.exists(self._cache_path):
-            os.remove(self._cache_path)
+        for path in [self._cache_path, self._journal_path]:
+            if os.path.exists(path):
+                os.remove(path)
 
     def connect(self):
         if not os.path.exists(self._cache_path):
@@ -261,18 +380,188 @@ class CachedPathID (object):
             except IOError:
                 raise libbe.storage.base.ConnectionError
         self._changed = False
-        with(codecs.open(self._cache_path, 'r', self.encoding)) as f:
+        self._missing = set()
+        self._misses = {}
+        if not os.path.exists(self._journal_path):
+            # unsorted cache from an older BE; rewrite it on disconnect
+            with(codecs.open(self._cache_path, 'r', self.encoding)) as f:
+                for line in f:
+                    fields = line.rstrip('\n').split('\t')
+                    self._cache[fields[0]] = fields[1]
+            self._changed = True
+            return
+        self._open_base()
+        with(codecs.open(self._journal_path, 'r', self.encoding)) as f:
             for line in f:
-                fields = line.rstrip('\n').split('\t')
-                self._cache[fields[0]] = fields[1]
+                line = line.rstrip('\n')
+                if line.startswith('+'):
+                    uuid, path = line[1:].split('\t', 1)
+                    self._cache[uuid] = path
+                    self._removed.discard(uuid)
+                    self._misses.pop(uuid, None)
+                elif line.startswith('-'):
+                    self._cache.pop(line[1:], None)
+                    self._removed.add(line[1:])
+                elif line.startswith('?'):
+                    uuid, stamp = line[1:].split('\t', 1)
+                    self._misses[uuid] = stamp
 
     def disconnect(self):
-        if self._changed:
-            f = codecs.open(self._cache_path, 'w', self.encoding)
-            for uuid, path in self._cache.items():
-                f.write('%s\t%s\n' % (uuid, path))
-            f.close()
+        if self._changed or self._journal_too_long():
+            self.compact()
+        elif self._journal:
+            with(codecs.open(self._journal_path, 'a', self.encoding)) as f:
+                f.write(u''.join(self._journal))
+        self._close_base()
         self._cache = {}
+        self._removed = set()
+        self._missing = set()
+        self._misses = {}
+        self._journal = []
+        self._changed = False
+        self._child_ids = None
+
+    def compact(self):
+        """Write every entry to a new base file and empty the journal.
+        """
+        lines = sorted('%s\t%s\n' % (uuid.encode(self.encoding),
+                                     path.encode(self.encoding))
+                       for uuid, path in self.items())
+        self._close_base()
+        descriptor, filename = tempfile.mkstemp(
+            dir=os.path.dirname(self._cache_path))
+        with os.fdopen(descriptor, 'wb') as f:
+            f.write(''.join(lines))
+        if os.name == 'nt' and os.path.exists(self._cache_path):
+            os.remove(self._cache_path)  # rename() won't replace on Windows
+        os.rename(filename, self._cache_path)
+        # keep the misses that still hold
+        if self._misses:
+            stamp = self._miss_stamp()
+            self._misses = dict((uuid, _stamp) for uuid, _stamp
+                                in self._misses.items() if _stamp == stamp)
+        with(codecs.open(self._journal_path, 'w', self.encoding)) as f:
+            f.write(u''.join(u'?%s\t%s\n' % (uuid, self._misses[uuid])
+                             for uuid in sorted(self._misses)))
+        self._cache = {}
+        self._removed = set()
+        self._journal = []
+        self._changed = False
+        self._open_base()
+
+    def _journal_too_long(self):
+        """Compact once the journal grows past a quarter of the base."""
+        if not self._journal or not os.path.exists(self._journal_path):
+            return False
+        size = os.path.getsize(self._journal_path) + \
+            sum(len(record) for record in self._journal)
+        return size > max(len(self._base) // 4, 64 * 1024)
+
+    def _open_base(self):
+        self._base_file = open(self._cache_path, 'rb')
+        if os.fstat(self._base_file.fileno()).st_size > 0:
+            self._base = mmap.mmap(
+                self._base_file.fileno(), 0, access=mmap.ACCESS_READ)
+
+    def _close_base(self):
+        if self._base_file is not None:
+            if self._base:
+                self._base.close()
+            self._base_file.close()
+        self._base = ''
+        self._base_file = None
+
+    def _bisect(self, uuid):
+        """Binary-search the sorted base file for uuid's path."""
+        key = uuid.encode(self.encoding)
+        base = self._base
+        lo = 0
+        hi = len(base)
+        while lo < hi:
+            start = base.rfind('\n', 0, (lo + hi) // 2) + 1
+            if start < lo:
+                start = lo
+            end = base.find('\n', start)
+            if end < 0:
+                end = len(base)
+            line_key, path = base[start:end].split('\t', 1)
+            if line_key == key:
+                return path.decode(self.encoding)
+            elif line_key < key:
+                lo = end + 1
+            else:
+                hi = start
+        return None
+
+    def _lookup(self, uuid):
+        """Return the cached path for uuid, or None."""
+        if uuid in self._cache:
+            return self._cache[uuid]
+        if uuid in self._removed or not self._base:
+            return None
+        return self._bisect(uuid)
+
+    def _set_path(self, uuid, path):
+        if self._child_ids is not None:
+            self._unlink_child(uuid, self._lookup(uuid))
+            self._child_ids.setdefault(
+                self._parent_uuid(path), set()).add(uuid)
+        self._cache[uuid] = path
+        self._removed.discard(uuid)
+        self._missing.discard(uuid)
+        self._misses.pop(uuid, None)
+        self._journal.append(u'+%s\t%s\n' % (uuid, path))
+
+    def _unset_path(self, uuid):
+        if self._child_ids is not None:
+            self._unlink_child(uuid, self._lookup(uuid))
+        self._cache.pop(uuid, None)
+        self._removed.add(uuid)
+        self._missing.add(uuid)
+        self._journal.append(u'-%s\n' % uuid)
+
+    def _parent_uuid(self, path):
+        """Return the uuid whose spacer directory contains path, or
+        None for top-level (bugdir) paths.
+        """
+        fields = path.split(os.path.sep)
+        if len(fields) >= 3 and fields[-2] in self._spacer_dirs[1:]:
+            return fields[-3]
+        return None
+
+    def _unlink_child(self, uuid, path):
+        if path is not None:
+            siblings = self._child_ids.get(self._parent_uuid(path))
+            if siblings is not None:
+                siblings.discard(uuid)
+
+    def child_ids(self, uuid):
+        """Return the set of cached uuids directly below uuid.
+
+        The parent -> children map is built from :py:meth:`items` the
+        first time it is needed after :py:meth:`connect`, and kept up
+        to date from then on.
+        """
+        if self._child_ids is None:
+            self._child_ids = {}
+            for _uuid, path in self.items():
+                self._child_ids.setdefault(
+                    self._parent_uuid(path), set()).add(_uuid)
+        return self._child_ids.get(uuid, set())
+
+    def items(self):
+        """Iterate over all `(uuid, path)` entries."""
+        base = self._base
+        start = 0
+        while start < len(base):
+            end = base.find('\n', start)
+            uuid, path = base[start:end].split('\t', 1)
+            uuid = uuid.decode(self.encoding)
+            if uuid not in self._cache and uuid not in self._removed:
+                yield (uuid, path.decode(self.encoding))
+            start = end + 1
+        for item in self._cache.items():
+            yield item
 
     def path(self, _id, relpath=False):
         fields = _id.split('/', 1)
@@ -281,13 +570,129 @@ class CachedPathID (object):
             extra = []
         else:
             extra = fields[1:]
-        if uuid not in self._cache:
-            self.init(cache=self._cache)
-            if uuid not in self._cache:
+        path = self._lookup(uuid)
+        if path is None:
+            if not self._find(uuid):
                 raise InvalidID(uuid)
+            path = self._lookup(uuid)
         if relpath:
-            return os.path.join(self._cache[uuid], *extra)
-        return os.path.join(self._root, self._cache[uuid], *extra)
+            return os.path.join(path, *extra)
+        return os.path.join(self._root, path, *extra)
+
+    def paths(self, ids, relpath=False):
+        """Return a dict mapping each id in ids to its path.
+
+        Unlike :py:meth:`path`, unknown ids are left out of the result
+        rather than raising InvalidID.
+        """
+        paths = {}
+        for _id in ids:
+            try:
+                paths[_id] = self.path(_id, relpath)
+            except InvalidID:
+                pass
+        return paths
+
+    def note(self, uuid, path):
+        """Record that a directory listing found uuid at path.
+
+        This is how comments added behind the cache's back (e.g. by a
+        VCS merge) under an existing bug are found, since a journaled
+        miss does not notice them (see :py:meth:`_find`).  Like
+        :py:meth:`_find`, it leaves uuids cached elsewhere alone.
+        """
+        if self._lookup(uuid) is None:
+            self._set_path(uuid, path)
+
+    def _miss_stamp(self):
+        """Return a fingerprint of the bugdirs and their bug lists, or
+        None if one of them changed too recently to tell later changes
+        apart (see :py:data:`SNAPSHOT_RACY_WINDOW`).
+
+        This costs one ``listdir`` and one ``stat`` per bugdir, however
+        many bugs there are.
+        """
+        racy = time.time() - SNAPSHOT_RACY_WINDOW
+        spaced_root = os.path.join(self._root, self._spacer_dirs[0])
+        digest = hashlib.sha1()
+        for name in sorted(_listdir(spaced_root)):
+            if name in BE_DIR_CACHES or name == 'version':
+                continue
+            try:
+                mtime = os.stat(os.path.join(
+                        spaced_root, name, self._spacer_dirs[1])).st_mtime
+            except OSError:
+                mtime = None
+            if mtime is not None and mtime >= racy:
+                return None
+            if isinstance(name, unicode):
+                name = name.encode(self.encoding)
+            digest.update('%s\t%r\n' % (name, mtime))
+        return digest.hexdigest()
+
+    def _find(self, uuid):
+        """Search the spacer directories for an uncached uuid.
+
+        Rather than walking the whole tree like :py:meth:`init`, look
+        one level at a time: ``.be/UUID``, then ``.be/*/bugs/UUID``,
+        then ``comments/UUID`` under each known bug.  Directories
+        found along the way are added to the cache.  Return True if
+        uuid was found.
+
+        Searching is linear in the number of bugs (one ``stat`` per
+        bug), so misses are journaled with a :py:meth:`_miss_stamp`,
+        and later processes trust them as long as no bugdir or bug has
+        been added or removed since, which costs the same however many
+        bugs there are.  New comments under an existing bug do not
+        change the stamp; they are found by :py:meth:`note` when the
+        bug's comments are listed, which is how BE reaches comments.
+        Misses are forgotten by :py:meth:`init` and :py:meth:`add_id`.
+        """
+        if uuid in self._missing:
+            return False
+        if uuid in self._misses:
+            if self._misses[uuid] == self._miss_stamp():
+                self._missing.add(uuid)
+                return False
+            del self._misses[uuid]
+        parents = ['']
+        for i, spacer in enumerate(self._spacer_dirs):
+            if i == len(self._spacer_dirs) - 1:
+                # leaf level: probe rather than list
+                for parent in parents:
+                    path = os.path.join(parent, spacer, uuid)
+                    if os.path.isdir(os.path.join(self._root, path)):
+                        self._set_path(uuid, path)
+                        return True
+                break
+            children = []
+            for parent in parents:
+                dirpath = os.path.join(parent, spacer)
+                try:
+                    names = os.listdir(os.path.join(self._root, dirpath))
+                except OSError:
+                    continue
+                for name in names:
+                    if i == 0 and name in BE_DIR_CACHES:
+                        continue
+                    path = os.path.join(dirpath, name)
+                    cached = self._lookup(name)
+                    if cached is None:
+                        if not os.path.isdir(os.path.join(self._root, path)):
+                            continue
+                        self._set_path(name, path)
+                    elif cached != path:
+                        continue
+                    children.append(path)
+            if self._lookup(uuid) is not None:
+                return True
+            parents = children
+        self._missing.add(uuid)
+        stamp = self._miss_stamp()
+        if stamp is not None:
+            self._misses[uuid] = stamp
+            self._journal.append(u'?%s\t%s\n' % (uuid, stamp))
+        return False
 
     def add_id(self, _id, parent=None):
         if _id.count('/') > 0:
@@ -295,7 +700,7 @@ class CachedPathID (object):
             assert _id.startswith(parent), \
                 'Strange ID: "%s" should start with "%s"' % (_id, parent)
             path = self.path(_id)
-        elif _id in self._cache:
+        elif self._lookup(_id) is not None:
             # already added
             path = self.path(_id)
         else:
@@ -310,16 +715,41 @@ class CachedPathID (object):
                 i = self._spacer_dirs.index(parent_spacer)
                 spacer = self._spacer_dirs[i+1]
             path = os.path.join(parent_path, spacer, _id)
-            self._cache[_id] = path
-            self._changed = True
+            self._set_path(_id, path)
             path = os.path.join(self._root, path)
         return path
 
     def remove_id(self, _id):
         if _id.count('/') > 0:
             return  # not a UUID-level path
-        self._cache.pop(_id)
-        self._changed = True
+        if self._lookup(_id) is None:
+            raise KeyError(_id)
+        self._unset_path(_id)
+
+    def remove_tree(self, _id):
+        """Remove _id and every cached uuid below it.
+
+        Return the list of removed uuids.
+        """
+        if _id.count('/') > 0:
+            # not a UUID-level path, look for uuids in its directory
+            prefix = os.path.join(self.path(_id, relpath=True), '')
+            stack = [uuid for uuid, path in self.items()
+                     if path.startswith(prefix)]
+        elif self._lookup(_id) is None:
+            return []
+        else:
+            stack = [_id]
+        removed = []
+        while stack:
+            uuid = stack.pop()
+            if uuid in self._removed:
+                continue  # listed by prefix and as a child
+            stack.extend(self.child_ids(uuid))
+            self._child_ids.pop(uuid, None)
+            self._unset_path(uuid)
+            removed.append(uuid)
+        return removed
 
     def id(self, path):
         path = os.path.join(self._root, path)
@@ -369,6 +799,9 @@ class VCS(libbe.storage.base.VersionedStorage):
         self._cached_path_id = CachedPathID()
         self._rooted = False
         self.__vcs_version = None
+        self._queued_adds = []  # deferred during transaction()
+        self._queued_updates = []
+        self._revision_index = None
 
     def _vcs_get_user_id(self):  # pylint: disable=no-self-use
         """
@@ -422,12 +855,43 @@ class VCS(libbe.storage.base.VersionedStorage):
         remove the file from the filesystem as well.
         """
 
+    def _vcs_remove_many(self, paths, dirs=()):
+        """
+        Remove several files (paths), and then the directories
+        containing them (dirs, listed after their subdirectories) from
+        version control.  The files may be removed from the filesystem
+        as well.  Backends that can do this with a single index update
+        or command should override this.
+        """
+        for path in paths:
+            self._vcs_remove(path)
+        for path in dirs:
+            self._vcs_remove(path)
+
     def _vcs_update(self, path):
         """
         Notify the versioning system of changes to the versioned file
         at path.
         """
 
+    def _vcs_add_many(self, paths):
+        """
+        Add several already created files (and their parent
+        directories, in order) to version control.  Backends that
+        can do this with a single index update or command should
+        override this.
+        """
+        for path in paths:
+            self._vcs_add(path)
+
+    def _vcs_update_many(self, paths):
+        """
+        Notify the versioning system of changes to several versioned
+        files.
+        """
+        for path in paths:
+            self._vcs_update(path)
+
     def _vcs_get_file_contents(self, path, revision=None):
         """
         Get the file contents as they were in a given revision.
@@ -457,6 +921,42 @@ class VCS(libbe.storage.base.VersionedStorage):
         """
         raise NotImplementedError
 
+    def _vcs_paths(self, ids, revision):
+        """
+        Return a dict mapping each of ids to its relative path as of
+        revision.  Ids that did not exist in revision are left out.
+
+        Revision will not be None.  The default implementation calls
+        _vcs_path once per id; backends that can resolve all the ids
+        from a single listing should override it.
+        """
+        paths = {}
+        for id in ids:
+            try:
+                paths[id] = self._vcs_path(id, revision)
+            except InvalidID:
+                pass
+        return paths
+
+    def _vcs_get_many_file_contents(self, paths, revision=None):
+        """
+        Return a dict mapping each of paths to the file contents as
+        they were in a given revision, using the same conventions as
+        _vcs_get_file_contents.  Backends that can read several files
+        with one command should override this.
+        """
+        return dict((path, self._vcs_get_file_contents(path, revision))
+                    for path in paths)
+
+    def _vcs_fingerprints(self, paths, revision=None):
+        """
+        Return a dict mapping relative paths to fingerprints of their
+        contents (including descendants for directories) as of
+        `revision`.  Paths the VCS cannot fingerprint cheaply are left
+        out.
+        """
+        return {}
+
     def _vcs_isdir(self, path, revision):
         """
         Return True if path (as returned by _vcs_path) was a directory
@@ -476,6 +976,26 @@ class VCS(libbe.storage.base.VersionedStorage):
         """
         raise NotImplementedError
 
+    def _vcs_listfiles(self, path, revision):
+        """
+        Return a list of the relative paths of all the files under
+        the directory path as of revision.
+
+        Revision will not be None.  The default implementation walks
+        the tree with _vcs_isdir and _vcs_listdir; backends that can
+        list a whole tree with one command should override it.
+        """
+        files = []
+        stack = [path]
+        while stack:
+            path = stack.pop()
+            if self._vcs_isdir(path, revision):
+                stack.extend(os.path.join(path, child)
+                             for child in self._vcs_listdir(path, revision))
+            else:
+                files.append(path)
+        return files
+
     def _vcs_commit(self, commitfile, allow_empty=False):
         """
         Commit the current working directory, using the contents of
@@ -495,6 +1015,20 @@ class VCS(libbe.storage.base.VersionedStorage):
 
         Return None if revision IDs are not supported, or if the
         specified revision does not exist.
+
+        VCSs implementing :py:meth:`_vcs_revisions` can return
+        ``self._u_revision_id(index)``.
+        """  # pylint: disable=unused-argument,no-self-use
+        return None
+
+    def _vcs_revisions(self, since=None):
+        """
+        Return the names of the revisions committed after since
+        (all revisions if since is None), oldest first, following
+        the same branch as :py:meth:`_vcs_revision_id`.
+
+        Return None if since is no longer in that history (e.g. the
+        branch was rewound), which makes the caller start over.
         """  # pylint: disable=unused-argument,no-self-use
         return None
 
@@ -509,9 +1043,8 @@ class VCS(libbe.storage.base.VersionedStorage):
         from the specified revision to the current situation.
         """
         output = self._diff(revision)
-        patch = PatchSet.from_string(output)
-        return patch.changed_files
-
+        return libbe.unidiff.changed_files(
+            libbe.unidiff.parse(output.splitlines(True)))
 
     @property
     def _vcs_version(self):
@@ -703,6 +1236,7 @@ class VCS(libbe.storage.base.VersionedStorage):
 
     def _disconnect(self):
         self._cached_path_id.disconnect()
+        self._revision_index = None
 
     def path(self, id, revision=None, relpath=True):
         if revision is None:
@@ -715,6 +1249,61 @@ class VCS(libbe.storage.base.VersionedStorage):
             return path
         return os.path.join(self.repo, path)
 
+    def _fingerprints(self, ids, revision=None):
+        paths = self._paths(ids, revision)
+        fingerprints = self._vcs_fingerprints(
+            sorted(set(paths.values())), revision)
+        return dict((id, fingerprints.get(paths.get(id))) for id in ids)
+
+    def snapshot_key(self):
+        """Return a cheap fingerprint of the current contents of the
+        ``.be`` directory, or None if one cannot be computed (e.g.
+        while :py:meth:`transaction` has unflushed changes).
+        """
+        if self._transaction_depth > 0 or self._pending:
+            return None
+        return self._vcs_snapshot_key()
+
+    def _vcs_snapshot_key(self):
+        """Digest the path, size, mtime, ctime, and inode of every file
+        in ``.be``.
+
+        Like git's index, this cannot see an edit that keeps a file's
+        size and lands within the filesystem's timestamp resolution of
+        the previous one, so there is no key while any file was modified
+        less than :py:data:`SNAPSHOT_RACY_WINDOW` ago.  The ctime and
+        inode catch edits that put the old mtime back.
+        """
+        racy = time.time() - SNAPSHOT_RACY_WINDOW
+        digest = hashlib.sha1()
+        for dirpath, dirnames, filenames in os.walk(self.be_dir):
+            if dirpath == self.be_dir:
+                dirnames[:] = [d for d in dirnames if d not in BE_DIR_CACHES]
+                filenames = [f for f in filenames if f not in BE_DIR_CACHES]
+            dirnames.sort()
+            for filename in sorted(filenames):
+                path = os.path.join(dirpath, filename)
+                stat = os.stat(path)
+                if stat.st_mtime >= racy:
+                    return None
+                relpath = path[len(self.be_dir):]
+                if isinstance(relpath, unicode):
+                    relpath = relpath.encode(self.encoding)
+                digest.update('%s\t%d\t%r\t%r\t%d\n' % (
+                        relpath, stat.st_size, stat.st_mtime,
+                        stat.st_ctime, stat.st_ino))
+        return digest.hexdigest()
+
+    def _paths(self, ids, revision=None):
+        """Return a dict mapping each of ids to its relative path,
+        leaving out ids that do not exist in revision.
+        """
+        if revision is None:
+            paths = self._cached_path_id.paths(ids)
+            return dict((id, self._u_rel_path(path))
+                        for id, path in paths.items())
+        return self._vcs_paths(ids, revision)
+
     def _add_path(self, path, directory=False):
         relpath = self._u_rel_path(path)
         reldirs = relpath.split(os.path.sep)
@@ -725,13 +1314,37 @@ class VCS(libbe.storage.base.VersionedStorage):
             dir = os.path.join(dir, reldir)
             if not os.path.exists(dir):
                 os.mkdir(dir)
-                self._vcs_add(self._u_rel_path(dir))
+                self._queue_add(self._u_rel_path(dir))
             elif not os.path.isdir(dir):
                 raise libbe.storage.base.InvalidDirectory
         if not directory:
             if not os.path.exists(path):
                 open(path, 'w').close()
-            self._vcs_add(self._u_rel_path(path))
+            self._queue_add(self._u_rel_path(path))
+
+    def _queue_add(self, path):
+        if self._transaction_depth > 0:
+            self._queued_adds.append(path)
+        else:
+            self._vcs_add(path)
+
+    def _queue_update(self, path):
+        if self._transaction_depth > 0:
+            self._queued_updates.append(path)
+        else:
+            self._vcs_update(path)
+
+    def _flush(self):
+        adds = self._queued_adds
+        updates = self._queued_updates
+        self._queued_adds = []
+        self._queued_updates = []
+        if adds:
+            self._vcs_add_many(adds)
+        added = set(adds)
+        updates = sorted(set(p for p in updates if p not in added))
+        if updates:
+            self._vcs_update_many(updates)
 
     def _add(self, id, parent=None, **kwargs):
         path = self._cached_path_id.add_id(id, parent)
@@ -748,6 +1361,7 @@ class VCS(libbe.storage.base.VersionedStorage):
         return self._vcs_exists(path, revision)
 
     def _remove(self, id):
+        self._flush()
         path = self._cached_path_id.path(id)
         if os.path.exists(path):
             if os.path.isdir(path) and self.children(id):
@@ -762,19 +1376,17 @@ class VCS(libbe.storage.base.VersionedStorage):
 
     def _recursive_remove(self, id):
         path = self._cached_path_id.path(id)
-        for dirpath, dirnames, filenames in os.walk(path, topdown=False):
-            filenames.extend(dirnames)
-            for f in filenames:
-                fullpath = os.path.join(dirpath, f)
-                if not os.path.exists(fullpath):
-                    continue
-                self._vcs_remove(self._u_rel_path(fullpath))
+        paths = []
+        dirs = []
+        for dirpath, dirnames, filenames in _walk(path, topdown=False):
+            reldir = self._u_rel_path(dirpath)
+            paths.extend(os.path.join(reldir, f) for f in filenames)
+            dirs.extend(os.path.join(reldir, d) for d in dirnames)
+        if paths or dirs:
+            self._vcs_remove_many(paths, dirs)
         if os.path.exists(path):
             shutil.rmtree(path)
-        path = self._cached_path_id.path(id, relpath=True)
-        for _id, cache_path in self._cached_path_id._cache.items():
-            if cache_path.startswith(path):
-                self._cached_path_id.remove_id(_id)
+        self._cached_path_id.remove_tree(id)
 
     def _ancestors(self, id=None, revision=None):
         if id is None:
@@ -794,41 +1406,59 @@ class VCS(libbe.storage.base.VersionedStorage):
         return ancestors
 
     def _children(self, id=None, revision=None):
-        if revision is None:
-            isdir = os.path.isdir
-            listdir = os.listdir
-        else:
-            isdir = lambda path: self._vcs_isdir(
-                self._u_rel_path(path), revision)
-            listdir = lambda path: self._vcs_listdir(
-                self._u_rel_path(path), revision)
-
         if id is None:
             path = self.be_dir
         else:
             path = self.path(id, revision, relpath=False)
+        return self._path_children(path, revision)
+
+    def _children_many(self, ids, revision=None):
+        paths = self._paths([id for id in ids if id is not None], revision)
+        children = {}
+        for id in ids:
+            if id is None:
+                path = self.be_dir
+            elif id in paths:
+                path = os.path.join(self.repo, paths[id])
+            else:
+                raise InvalidID(id, revision)
+            children[id] = self._path_children(path, revision)
+        return children
 
-        if not isdir(path):
-            return []
-
-        children = listdir(path)
-
-        for i, child in enumerate(children):
-            if child in self._cached_path_id._spacer_dirs:
-                children[i] = None
-                cache_files = listdir(os.path.join(path, child))
-                children.extend([os.path.join(child, c2) for c2 in cache_files])
-            elif child in ['id-cache', 'version']:
-                children[i] = None
-
-        for i, child in enumerate(children):
-            if child is None:
-                continue
+    def _path_children(self, path, revision=None):
+        if revision is None:
+            listdir = _listdir
+        else:
+            listdir = lambda path: self._vcs_listdir(
+                self._u_rel_path(path), revision)
+            if not self._vcs_isdir(self._u_rel_path(path), revision):
+                return []
 
-            cpath = os.path.join(path, child)
-            children[i] = self._u_path_to_id(cpath)
+        names = listdir(path)
+        if not names:
+            return []
 
-        return [c for c in children if c is not None]
+        children = []
+        spacers = []
+        for name in names:
+            if name in self._cached_path_id._spacer_dirs:
+                spacers.append(name)
+            elif name != 'version' and not (
+                    path == self.be_dir and name in BE_DIR_CACHES):
+                children.append(name)
+        # every entry of a directory shares the id prefix, so parse one
+        # path per directory instead of one per entry
+        ids = self._u_child_ids(path, children)
+        for spacer in spacers:
+            spacer_path = os.path.join(path, spacer)
+            names = listdir(spacer_path)
+            if revision is None:
+                relpath = self._u_rel_path(spacer_path)
+                for name in names:
+                    self._cached_path_id.note(
+                        name, os.path.join(relpath, name))
+            ids.extend(self._u_child_ids(spacer_path, names))
+        return ids
 
     def _get(self, id, default=libbe.util.InvalidObject, revision=None):
         try:
@@ -846,6 +1476,21 @@ class VCS(libbe.storage.base.VersionedStorage):
             return default
         return contents
 
+    def _get_many(self, ids, default=libbe.util.InvalidObject, revision=None):
+        paths = self._paths(ids, revision)
+        contents = self._vcs_get_many_file_contents(
+            sorted(set(paths.values())), revision)
+        values = {}
+        for id in ids:
+            value = contents.get(paths.get(id), libbe.util.InvalidObject)
+            if value in [libbe.storage.base.InvalidDirectory,
+                         libbe.util.InvalidObject] or not value:
+                if default == libbe.util.InvalidObject:
+                    raise InvalidID(id, revision)
+                value = default
+            values[id] = value
+        return values
+
     def _set(self, id, value):
         try:
             path = self._cached_path_id.path(id)
@@ -860,7 +1505,7 @@ class VCS(libbe.storage.base.VersionedStorage):
         with open(path, "wb") as f:
             f.write(value)
 
-        self._vcs_update(self._u_rel_path(path))
+        self._queue_update(self._u_rel_path(path))
 
     def _commit(self, summary, body=None, allow_empty=False):
         summary = summary.strip()+'\n'
@@ -893,11 +1538,50 @@ class VCS(libbe.storage.base.VersionedStorage):
             raise libbe.storage.base.InvalidRevision(index)
         return revid
 
+    def revision_storage(self, revision):
+        """
+        Return a read-only :py:class:`~libbe.storage.base.RevisionStorage`
+        with the contents of the ``.be`` directory as of revision,
+        read with one file listing and one batch of file reads.
+        """
+        if not self.is_readable():
+            raise libbe.storage.base.NotReadable(
+                'Cannot copy unreadable storage.')
+        be_dir = self._cached_path_id._spacer_dirs[0]
+        files = [path for path in self._vcs_listfiles(be_dir, revision)
+                 if path.split(os.path.sep)[1] not in
+                 ['version'] + BE_DIR_CACHES]
+        contents = self._vcs_get_many_file_contents(sorted(files), revision)
+        storage = libbe.storage.base.RevisionStorage(self, revision)
+        for path in sorted(files):
+            parts = path.split(os.path.sep)
+            parent = _id = None
+            for i in range(2, len(parts)+1):
+                try:
+                    _id = self._u_path_to_id(os.path.sep.join(parts[:i]))
+                except (SpacerCollision, InvalidPath):
+                    _id = None
+                    continue
+                if _id not in storage._data:
+                    storage.add_entry(_id, parent=parent, directory=True)
+                parent = _id
+            if _id is None:
+                continue
+            value = contents.get(path)
+            if value in [libbe.storage.base.InvalidDirectory,
+                         libbe.util.InvalidObject] or not value:
+                value = None
+            storage.set_entry(_id, value)
+        return storage
+
     def changed(self, revision):
         add, mod, rem = self._vcs_changed(revision)
 
         def paths_to_ids(paths):
             for p in paths:
+                parts = p.split(os.path.sep)
+                if len(parts) == 2 and parts[1] in BE_DIR_CACHES:
+                    continue  # may have been committed by accident
                 try:
                     _id = self._u_path_to_id(p)
                     yield _id
@@ -949,32 +1633,48 @@ class VCS(libbe.storage.base.VersionedStorage):
             return None
         return ret
 
-    def _u_find_id_from_manifest(self, id, manifest, revision=None):
-        """Search for the relative path to id using manifest, a list of all
-        files.
-        
-        Returns None if the id is not found.
+    def _u_manifest_ids(self, manifest):
+        """Return a dict mapping the ids of the files and directories
+        in manifest, a list of all files, to their relative paths.
         """
-        be_dir = self._cached_path_id._spacer_dirs[0]
         be_dir_sep = self._cached_path_id._spacer_dirs[0] + os.path.sep
-        files = [f for f in manifest if f.startswith(be_dir_sep)]
-        for file in files:
-            if not file.startswith(be_dir+os.path.sep):
+        paths = set()
+        for file in manifest:
+            if not file.startswith(be_dir_sep):
                 continue
             parts = file.split(os.path.sep)
-            dir = parts.pop(0)  # don't add the first spacer dir
-            for part in parts[:-1]:
-                dir = os.path.join(dir, part)
-                if dir not in files:
-                    files.append(dir)
-        for file in files:
+            for i in range(2, len(parts)+1):
+                paths.add(os.path.sep.join(parts[:i]))
+        ids = {}
+        for path in sorted(paths):
             try:
-                p_id = self._u_path_to_id(file)
-                if p_id == id:
-                    return file
+                p_id = self._u_path_to_id(path)
             except (SpacerCollision, InvalidPath):
-                pass
-        raise InvalidID(id, revision=revision)
+                continue
+            if p_id not in ids:
+                ids[p_id] = path
+        return ids
+
+    def _u_find_id_from_manifest(self, id, manifest, revision=None):
+        """Search for the relative path to id using manifest, a list of all
+        files.
+
+        Raises InvalidID if the id is not found.
+        """
+        path = self._u_manifest_ids(manifest).get(id)
+        if path is None:
+            raise InvalidID(id, revision=revision)
+        return path
+
+    def _u_find_ids_from_manifest(self, ids, manifest, revision=None):
+        """Search for the relative paths to several ids using manifest,
+        a list of all files.
+
+        Returns a dict mapping each id found to its path.  Ids that
+        are not found are left out.
+        """
+        paths = self._u_manifest_ids(manifest)
+        return dict((id, paths[id]) for id in ids if id in paths)
 
     def _u_find_id(self, id, revision):
         """Search for the relative path to id as of revision.
@@ -998,6 +1698,68 @@ class VCS(libbe.storage.base.VersionedStorage):
     def _u_path_to_id(self, path):
         return self._cached_path_id.id(path)
 
+    def _u_child_ids(self, path, names):
+        """Return the ids of the entries `names` in directory `path`.
+        """
+        if not names:
+            return []
+        prefix = self._u_path_to_id(os.path.join(path, u'_'))[:-1]
+        return [prefix + name for name in names]
+
+    def _u_revisions(self):
+        """Return the list of all revision names, oldest first.
+
+        The list is kept in :py:data:`REVISION_INDEX` and extended
+        with :py:meth:`_vcs_revisions` from its last entry, so only
+        the revisions committed since the last call are read from the
+        VCS.
+        """
+        revisions = self._revision_index
+        path = os.path.join(self.be_dir, REVISION_INDEX)
+        if revisions is None:
+            try:
+                with open(path, 'rb') as f:
+                    revisions = f.read().decode('utf-8').splitlines()
+            except IOError:
+                revisions = []
+        new = None
+        if revisions:
+            new = self._vcs_revisions(since=revisions[-1])
+        if new is None:
+            revisions = []
+            new = self._vcs_revisions()
+        if new:
+            revisions = revisions + new
+            dirname = os.path.dirname(path)
+            try:
+                if not os.path.isdir(dirname):
+                    os.mkdir(dirname)
+                descriptor, filename = tempfile.mkstemp(dir=dirname)
+                with os.fdopen(descriptor, 'wb') as f:
+                    f.write(u''.join(u'%s\n' % revision
+                                     for revision in revisions
+                                     ).encode('utf-8'))
+                os.rename(filename, path)
+            except (IOError, OSError):
+                pass  # it is only a cache
+        self._revision_index = revisions
+        return revisions
+
+    def _u_revision_id(self, index):
+        """Return the <index>th revision from :py:meth:`_u_revisions`,
+        see :py:meth:`_vcs_revision_id`.
+        """
+        revisions = self._u_revisions()
+        try:
+            if index > 0:
+                return revisions[index-1]
+            elif index < 0:
+                return revisions[index]
+            else:
+                return None
+        except IndexError:
+            return None
+
     def _u_rel_path(self, path, root=None):
         """Return the relative path to path from root.
 
@@ -1076,6 +1838,9 @@ class VCS(libbe.storage.base.VersionedStorage):
 
         relpath = self._u_rel_path(path)
         contents = self._vcs_get_file_contents(relpath, revision=revision)
+        if contents in [libbe.util.InvalidObject,
+                        libbe.storage.base.InvalidDirectory]:
+            raise libbe.storage.InvalidStorageVersion(None)
         if not isinstance(contents, unicode):
             contents = unicode(contents, self.encoding)
 
@@ -1091,6 +1856,16 @@ class VCS(libbe.storage.base.VersionedStorage):
             self._vcs_add(self._u_rel_path(path))
 
 if libbe.TESTING:
+    def age_be_dir(be_dir, seconds=10):
+        """Backdate everything in `be_dir` past
+        :py:data:`SNAPSHOT_RACY_WINDOW`, so tests get snapshot keys
+        and journaled misses without sleeping.
+        """
+        when = time.time() - SNAPSHOT_RACY_WINDOW - seconds
+        for dirpath, dirnames, filenames in os.walk(be_dir):
+            for name in dirnames + filenames:
+                os.utime(os.path.join(dirpath, name), (when, when))
+
     class VCSTestCase(unittest.TestCase):
         """ Test cases for base VCS class (in addition to the Storage test
             cases). """
@@ -1154,6 +1929,49 @@ if libbe.TESTING:
                 dp == rp or rp is None,
                 "%(vcs_name)s VCS root in wrong dir (%(dp)s %(rp)s)" % vars())
 
+        def _untracked_bugdir(self):
+            """Return a bugdir with a committed bug a, and a function
+            copying it to a new uuid behind the VCS's back.
+            """
+            bugdir = libbe.bugdir.BugDir(self.s, uuid='abc')
+            bug = bugdir.new_bug(summary='Bug A', _uuid='a')
+            bug.comment_root.new_reply(body='comment A')
+            self.s.commit('Add bug A')
+            def copy(uuid, id='a'):
+                path = self.s._cached_path_id.path(id)
+                shutil.copytree(
+                    path, os.path.join(os.path.dirname(path), uuid))
+            return (bugdir, copy)
+
+        def test_untracked_bug_is_listed(self):
+            """A new, unadded bug directory should invalidate snapshots.
+            """
+            bugdir,copy = self._untracked_bugdir()
+            age_be_dir(self.s.be_dir)
+            bugdir.load_all_bugs()  # saves a snapshot
+            copy('b')
+            age_be_dir(self.s.be_dir)
+            bugdir = libbe.bugdir.BugDir(
+                self.s, uuid='abc', from_storage=True)
+            bugdir.load_all_bugs()
+            self.failUnlessEqual(sorted(bugdir.uuids()), ['a', 'b'])
+
+        def test_untracked_comment_changes_fingerprint(self):
+            """A new, unadded comment should change its bug's fingerprint.
+            """
+            bugdir,copy = self._untracked_bugdir()
+            comment = list(bugdir.bug_from_uuid('a').comments())[0]
+            before = self.s.fingerprint('a')
+            copy('c', id=comment.uuid)
+            after = self.s.fingerprint('a')
+            self.failUnless(after is None or after != before,
+                            '%s unchanged' % after)
+
+        def test_storage_version_unknown_revision(self):
+            """An unknown revision should raise InvalidRevision."""
+            self.failUnlessRaises(InvalidRevision, self.s.storage_version,
+                                  revision='no-such-revision')
+
         """ Test cases for VCS.get_user_id method. """
 
         def test_get_existing_user_id(self):
@@ -1166,6 +1984,150 @@ if libbe.TESTING:
                 if email is not None:
                     self.failUnless('@' in email, email)
 
+    class CachedPathIDTestCase(unittest.TestCase):
+        """Test cases for CachedPathID lookups of uncached ids."""
+
+        def setUp(self):
+            super(CachedPathIDTestCase, self).setUp()
+            self.dir = Dir()
+            self.bugs = os.path.join(self.dir.path, '.be', 'abc', 'bugs')
+            os.makedirs(os.path.join(self.bugs, '123', 'comments', 'def'))
+            self.c = CachedPathID()
+            self.c.root(self.dir.path)
+            self.c.connect()
+
+        def tearDown(self):
+            self.c.disconnect()
+            self.c.destroy()
+            self.dir.cleanup()
+            super(CachedPathIDTestCase, self).tearDown()
+
+        def test_find_new_directories(self):
+            """Uncached directories should be found without init()."""
+            os.makedirs(os.path.join(self.bugs, '456', 'comments', 'ghi'))
+            path = self.c.path('ghi', relpath=True)
+            expected = os.path.join(
+                '.be', 'abc', 'bugs', '456', 'comments', 'ghi')
+            self.failUnless(path == expected, path)
+            self.failUnless('456' in self.c._cache, self.c._cache)
+
+        def test_miss_is_remembered(self):
+            """Repeated misses should not touch the filesystem."""
+            self.assertRaises(InvalidID, self.c.path, 'xyz')
+            listdir = os.listdir
+            calls = []
+            def counting_listdir(path):
+                calls.append(path)
+                return listdir(path)
+            os.listdir = counting_listdir
+            try:
+                self.assertRaises(InvalidID, self.c.path, 'xyz')
+            finally:
+                os.listdir = listdir
+            self.failUnless(calls == [], calls)
+
+        def test_add_id_forgets_miss(self):
+            """Adding an id should clear a remembered miss."""
+            self.assertRaises(InvalidID, self.c.path, 'xyz')
+            path = self.c.add_id('xyz', parent='123')
+            self.failUnless(self.c.path('xyz') == path,
+                            (self.c.path('xyz'), path))
+
+        def test_miss_is_journaled(self):
+            """A later process should trust a miss without stat'ing
+            every bug, until a bug is added.
+            """
+            age_be_dir(os.path.join(self.dir.path, '.be'))
+            self.assertRaises(InvalidID, self.c.path, 'xyz')
+            self.c.disconnect()
+            self.c.connect()
+            isdir = os.path.isdir
+            calls = []
+            def counting_isdir(path):
+                calls.append(path)
+                return isdir(path)
+            os.path.isdir = counting_isdir
+            try:
+                self.assertRaises(InvalidID, self.c.path, 'xyz')
+            finally:
+                os.path.isdir = isdir
+            self.failUnless(calls == [], calls)
+            self.c.disconnect()
+            os.makedirs(os.path.join(self.bugs, '456', 'comments', 'xyz'))
+            self.c.connect()
+            self.failUnless(self.c.path('xyz', relpath=True) ==
+                            os.path.join('.be', 'abc', 'bugs', '456',
+                                         'comments', 'xyz'))
+
+        def test_note_overrides_miss(self):
+            """Comments seen in a listing should be found even if a
+            journaled miss does not know about them yet.
+            """
+            age_be_dir(os.path.join(self.dir.path, '.be'))
+            self.assertRaises(InvalidID, self.c.path, 'xyz')
+            self.c.disconnect()
+            path = os.path.join('.be', 'abc', 'bugs', '123', 'comments',
+                                'xyz')
+            os.mkdir(os.path.join(self.dir.path, path))
+            self.c.connect()
+            self.assertRaises(InvalidID, self.c.path, 'xyz')
+            self.c.note('xyz', path)
+            self.failUnless(self.c.path('xyz', relpath=True) == path)
+
+        def test_journal(self):
+            """Changes should be appended to the journal, not the base."""
+            with open(self.c._cache_path, 'rb') as f:
+                base = f.read()
+            self.c.add_id('xyz', parent='123')
+            self.c.remove_id('def')
+            shutil.rmtree(os.path.join(self.bugs, '123', 'comments', 'def'))
+            self.c.disconnect()
+            with open(self.c._cache_path, 'rb') as f:
+                self.failUnless(f.read() == base)
+            with open(self.c._journal_path, 'rb') as f:
+                journal = f.read()
+            expected = '+xyz\t%s\n-def\n' % os.path.join(
+                '.be', 'abc', 'bugs', '123', 'comments', 'xyz')
+            self.failUnless(journal == expected, journal)
+            self.c.connect()
+            self.failUnless(self.c.path('xyz', relpath=True) ==
+                            os.path.join('.be', 'abc', 'bugs', '123',
+                                         'comments', 'xyz'))
+            self.assertRaises(InvalidID, self.c.path, 'def')
+
+        def test_compact(self):
+            """Compaction should fold the journal into the sorted base."""
+            ids = ['%03d' % i for i in range(100)]
+            for _id in reversed(ids):
+                self.c.add_id(_id, parent='123')
+            self.c.remove_id('def')
+            self.c.disconnect()
+            self.c.connect()
+            self.c.compact()
+            self.failUnless(os.path.getsize(self.c._journal_path) == 0)
+            with open(self.c._cache_path, 'rb') as f:
+                uuids = [line.split('\t')[0] for line in f]
+            self.failUnless(uuids == sorted(ids + ['123', 'abc']), uuids)
+            for _id in ids:
+                self.failUnless(self.c._bisect(_id) is not None, _id)
+            self.failUnless(self.c._bisect('def') is None)
+
+        def test_unsorted_cache_file(self):
+            """Caches from older BEs should be read and rewritten."""
+            self.c.disconnect()
+            os.remove(self.c._journal_path)
+            path = os.path.join('.be', 'abc', 'bugs', '123')
+            with open(self.c._cache_path, 'wb') as f:
+                f.write('123\t%s\nabc\t.be/abc\n' % path)
+            self.c.connect()
+            self.failUnless(self.c.path('123', relpath=True) == path)
+            self.c.disconnect()
+            self.failUnless(os.path.exists(self.c._journal_path))
+            with open(self.c._cache_path, 'rb') as f:
+                uuids = [line.split('\t')[0] for line in f]
+            self.failUnless(uuids == ['123', 'abc'], uuids)
+            self.c.connect()
+
     def make_vcs_testcase_subclasses(vcs_class, namespace):
         c = vcs_class()
         if c.installed():
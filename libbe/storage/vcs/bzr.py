@@ -44,6 +44,9 @@ import StringIO
 import sys
 
 import libbe
+import libbe.storage.base
+import libbe.util
+from libbe.util.lru import LRUCache
 import base
 
 if libbe.TESTING == True:
@@ -51,9 +54,35 @@ if libbe.TESTING == True:
     import unittest
 
 
+# number of revision trees Bzr keeps read-locked in memory
+_TREE_CACHE_SIZE = 8
+
+
 def new():
     return Bzr()
 
+
+class _RevisionTree (object):
+    """A read-locked `bzrlib` revision tree with its paths indexed.
+    """
+    def __init__(self, tree):
+        self.tree = tree
+        self.tree.lock_read()
+        self.entries = {}  # path -> (file id, kind)
+        self.children = {}  # directory -> list of child names
+        for path,entry in tree.iter_entries_by_dir():
+            self.entries[path] = (entry.file_id, entry.kind)
+            if entry.kind == 'directory':
+                self.children.setdefault(path, [])
+            if path:
+                dirname,name = os.path.split(path)
+                self.children.setdefault(dirname, []).append(name)
+        self.ids = None  # id -> path, see Bzr._bzr_ids
+
+    def close(self):
+        self.tree.unlock()
+
+
 class Bzr(base.VCS):
     """:py:class:`base.VCS` implementation for Bazaar.
     """
@@ -63,6 +92,20 @@ class Bzr(base.VCS):
     def __init__(self, *args, **kwargs):
         base.VCS.__init__(self, *args, **kwargs)
         self.versioned = True
+        self._trees = LRUCache(
+            size=_TREE_CACHE_SIZE, evict=lambda revision,tree: tree.close())
+
+    def __getstate__(self):
+        """Copies lock their own revision trees.
+        """
+        attrs = dict(self.__dict__)
+        attrs['_trees'] = LRUCache(
+            size=_TREE_CACHE_SIZE, evict=lambda revision,tree: tree.close())
+        return attrs
+
+    def _disconnect(self):
+        self._trees.clear()
+        base.VCS._disconnect(self)
 
     @property
     def _vcs_version(self):
@@ -122,18 +165,23 @@ class Bzr(base.VCS):
             cmd.cleanup_now()
 
     def _vcs_exists(self, path, revision=None):
-        manifest = self._vcs_listdir(
-            self.repo, revision=revision, recursive=True)
+        if revision is not None:
+            return path in self._bzr_tree(revision).entries
+        manifest = self._bzr_ls(self.repo, revision=None, recursive=True)
         if path in manifest:
             return True
         return False
 
     def _vcs_remove(self, path):
+        self._vcs_remove_many([path])
+
+    def _vcs_remove_many(self, paths, dirs=()):
         # --force to also remove unversioned files.
-        path = os.path.join(self.repo, path)
         cmd = bzrlib.builtins.cmd_remove()
         cmd.outf = StringIO.StringIO()
-        cmd.run(file_list=[path], file_deletion_strategy='no-backup')
+        cmd.run(file_list=[os.path.join(self.repo, p)
+                           for p in list(paths) + list(dirs)],
+                file_deletion_strategy='no-backup')
         if self < '2.2.0':
             cmd.cleanup_now()
 
@@ -150,46 +198,66 @@ class Bzr(base.VCS):
             raise base.InvalidRevision(revision)
         return rev_spec
 
+    def _bzr_tree(self, revision):
+        """Return the :py:class:`_RevisionTree` for revision.
+
+        Trees are kept until the connection closes or a commit moves
+        relative revisions, so later reads are dict lookups.
+        """
+        tree = self._trees.get(revision)
+        if tree is None:
+            branch = bzrlib.branch.Branch.open(self.repo)
+            rev_spec = self._parse_revision_string(revision)[0]
+            try:
+                revision_id = rev_spec.as_revision_id(branch)
+            except bzrlib.errors.BzrError:
+                raise base.InvalidRevision(revision)
+            tree = _RevisionTree(
+                branch.repository.revision_tree(revision_id))
+            self._trees[revision] = tree
+        return tree
+
+    def _bzr_ids(self, revision):
+        tree = self._bzr_tree(revision)
+        if tree.ids is None:
+            tree.ids = self._u_manifest_ids(tree.entries.keys())
+        return tree.ids
+
     def _vcs_get_file_contents(self, path, revision=None):
         if revision == None:
             return base.VCS._vcs_get_file_contents(self, path, revision)
-        path = os.path.join(self.repo, path)
-        revision = self._parse_revision_string(revision)
-        cmd = bzrlib.builtins.cmd_cat()
-        cmd.outf = StringIO.StringIO()
-        if self < '1.6.0':
-            # old bzrlib cmd_cat uses sys.stdout not self.outf for output.
-            stdout = sys.stdout
-            sys.stdout = cmd.outf
-        try:
-            cmd.run(filename=path, revision=revision)
-        except bzrlib.errors.BzrCommandError, e:
-            if 'not present in revision' in str(e):
-                raise base.InvalidPath(path, root=self.repo, revision=revision)
-            raise
-        finally:
-            if self < '2.0.0':
-                cmd.outf = sys.stdout
-                sys.stdout = stdout
-            if self < '2.2.0':
-                cmd.cleanup_now()
-        return cmd.outf.getvalue()
+        tree = self._bzr_tree(revision)
+        if path not in tree.entries:
+            return libbe.util.InvalidObject
+        file_id,kind = tree.entries[path]
+        if kind == 'directory':
+            return libbe.storage.base.InvalidDirectory
+        return tree.tree.get_file_text(file_id)
 
     def _vcs_path(self, id, revision):
-        manifest = self._vcs_listdir(
-            self.repo, revision=revision, recursive=True)
-        return self._u_find_id_from_manifest(id, manifest, revision=revision)
+        path = self._bzr_ids(revision).get(id)
+        if path is None:
+            raise base.InvalidID(id, revision=revision)
+        return path
+
+    def _vcs_paths(self, ids, revision):
+        paths = self._bzr_ids(revision)
+        return dict((id, paths[id]) for id in ids if id in paths)
 
     def _vcs_isdir(self, path, revision):
-        try:
-            self._vcs_listdir(path, revision)
-        except AttributeError, e:
-            if 'children' in str(e):
-                return False
-            raise
-        return True
+        return path.rstrip(os.path.sep) in self._bzr_tree(revision).children
+
+    def _vcs_listdir(self, path, revision):
+        children = self._bzr_tree(revision).children
+        return list(children.get(path.rstrip(os.path.sep), []))
 
-    def _vcs_listdir(self, path, revision, recursive=False):
+    def _vcs_listfiles(self, path, revision):
+        path = path.rstrip(os.path.sep) + os.path.sep
+        return [p for p,(file_id,kind) in
+                self._bzr_tree(revision).entries.items()
+                if p.startswith(path) and kind != 'directory']
+
+    def _bzr_ls(self, path, revision, recursive=False):
         path = os.path.join(self.repo, path)
         revision = self._parse_revision_string(revision)
         cmd = bzrlib.builtins.cmd_ls()
@@ -233,6 +301,7 @@ class Bzr(base.VCS):
             os.chdir(cwd)
             if self < '2.2.0':
                 cmd.cleanup_now()
+        self._trees.clear()  # relative revisions have moved
         return self._vcs_revision_id(-1)
 
     def _vcs_revision_id(self, index):
@@ -264,6 +333,37 @@ class Bzr(base.VCS):
         assert status in [0,1], "Invalid status %d" % status
         return cmd.outf.getvalue()
 
+    def _vcs_changed(self, revision):
+        revision = self._parse_revision_string(revision)
+        cmd = bzrlib.builtins.cmd_status()
+        cmd.outf = StringIO.StringIO()
+        cmd.run(revision=revision, file_list=[self.be_dir], short=True)
+        if self < '2.2.0':
+            cmd.cleanup_now()
+        new = set()
+        modified = set()
+        removed = set()
+        # short status lines are "VC* PATH", with versioning change V
+        # (+ added, - removed, R renamed) and content change C
+        # (N created, D deleted, K kind changed, M modified)
+        for line in cmd.outf.getvalue().splitlines():
+            if not line.strip():
+                continue
+            flags,path = line[:3], line[4:]
+            if path.endswith('/'):
+                continue  # directories
+            if flags[0] == 'R':
+                old,path = path.split(' => ', 1)
+                removed.add(old)
+                new.add(path)
+            elif flags[0] == '+' or flags[1] == 'N':
+                new.add(path)
+            elif flags[0] == '-' or flags[1] == 'D':
+                removed.add(path)
+            elif flags[1] in 'KM':
+                modified.add(path)
+        return (new, modified, removed)
+
 
 if libbe.TESTING == True:
     base.make_vcs_testcase_subclasses(Bzr, sys.modules[__name__])
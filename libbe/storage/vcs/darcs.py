@@ -23,17 +23,23 @@
 .. _Darcs: http://darcs.net/
 """
 
+import filecmp
+import hashlib
 import os
 import re
 import shutil
-import distutils.spawn
 import sys
+import tempfile
 import time  # work around http://mercurial.selenic.com/bts/issue618
 from xml.etree import ElementTree
 from xml.sax.saxutils import unescape
 
 import libbe
+import libbe.storage.base
+import libbe.util
+from ...util.lru import LRUCache
 from ...util.subproc import CommandError
+from ..util import probes
 from . import base
 
 if libbe.TESTING:
@@ -41,6 +47,20 @@ if libbe.TESTING:
     import unittest
 
 
+# revision snapshots live in .be/cache/SNAPSHOT_DIR
+SNAPSHOT_DIR = 'darcs-revisions'
+
+# disk space the revision snapshots may use; the least recently used
+# ones are removed beyond that
+SNAPSHOT_BUDGET = 64 * 2**20
+
+# number of revisions whose id -> path maps Darcs keeps in memory
+_ID_CACHE_SIZE = 8
+
+# number of revision -> patch hash resolutions Darcs keeps in memory
+_HASH_CACHE_SIZE = 64
+
+
 def new():
     return Darcs()
 
@@ -54,9 +74,14 @@ class Darcs(base.VCS):
         base.VCS.__init__(self, *args, **kwargs)
         self.versioned = True
         self.__updated = [] # work around http://mercurial.selenic.com/bts/issue618
+        self._snapshot_ids = LRUCache(size=_ID_CACHE_SIZE)
+        self._patch_hashes = LRUCache(size=_HASH_CACHE_SIZE)
 
     @property
     def _vcs_version(self):
+        return probes.version(self.client, self._probe_version)
+
+    def _probe_version(self):
         try:
             status,output,error = self._u_invoke_client('--version')
         except CommandError:  # command not found?
@@ -102,7 +127,7 @@ class Darcs(base.VCS):
 
     @staticmethod
     def _vcs_installed():
-        return distutils.spawn.find_executable(Darcs.name)
+        return probes.find_executable(Darcs.name)
 
     def _vcs_destroy(self):
         vcs_dir = os.path.join(self.repo, '_darcs')
@@ -121,77 +146,132 @@ class Darcs(base.VCS):
         if not os.path.isdir(self._u_abspath(path)):
             os.remove(os.path.join(self.repo, path)) # darcs notices removal
 
+    def _vcs_remove_many(self, paths, dirs=()):
+        pass # the caller removes the files, and darcs notices removal
+
     def _vcs_update(self, path):
         self.__updated.append(path) # work around http://mercurial.selenic.com/bts/issue618
         pass # darcs notices changes
 
+    def _darcs_patch_hash(self, revision):
+        """Return the hash of the latest patch named revision.
+
+        Patch names are neither unique nor safe to use as regular
+        expressions, so they are matched exactly, and the snapshots
+        are keyed by the hash of the patch they resolve to.
+        """
+        hash = self._patch_hashes.get(revision)
+        if hash is None:
+            escaped = revision.replace('\\', '\\\\').replace('"', '\\"')
+            patches = self._patches(
+                '--match', 'exact "%s"' % escaped, '--max-count', '1')
+            if not patches:
+                raise base.InvalidRevision(revision)
+            hash = patches[0][0]
+            self._patch_hashes[revision] = hash
+        return hash
+
+    def _darcs_snapshot(self, revision):
+        """Return the path to a snapshot of the repository as of
+        revision.
+
+        Snapshots are made with one ``darcs get --to-match`` and only
+        keep the ``.be`` directory.  They are stored under
+        ``.be/cache``, named after the patch hash (see
+        :py:meth:`_darcs_patch_hash`), so later reads of the same
+        revision, even by other processes, are plain file reads.
+        """
+        hash = self._darcs_patch_hash(revision)
+        root = os.path.join(self.be_dir, 'cache', SNAPSHOT_DIR)
+        path = os.path.join(root, hashlib.sha1(hash).hexdigest())
+        if not os.path.isdir(path):
+            if not os.path.isdir(root):
+                os.makedirs(root)
+            tempdir = tempfile.mkdtemp(prefix='get-', dir=root)
+            try:
+                self._u_invoke_client(
+                    'get', '--to-match', 'hash %s' % hash, self.repo,
+                    os.path.join(tempdir, 'repo'))
+                be_dir = self._u_rel_path(self.be_dir)
+                os.rename(os.path.join(tempdir, 'repo', be_dir),
+                          os.path.join(tempdir, be_dir))
+                shutil.rmtree(os.path.join(tempdir, 'repo'))
+                os.rename(tempdir, path)
+            except:
+                shutil.rmtree(tempdir)
+                raise
+            self._darcs_evict_snapshots(root, keep=path)
+        os.utime(path, None)  # mark as recently used
+        return path
+
+    def _darcs_evict_snapshots(self, root, keep):
+        snapshots = []
+        total = 0
+        for name in os.listdir(root):
+            path = os.path.join(root, name)
+            size = 0
+            for dirpath,dirnames,filenames in os.walk(path):
+                size += sum(os.path.getsize(os.path.join(dirpath, f))
+                            for f in filenames)
+            snapshots.append((os.stat(path).st_mtime, path, size))
+            total += size
+        for mtime,path,size in sorted(snapshots):
+            if total <= SNAPSHOT_BUDGET:
+                break
+            if path != keep:
+                shutil.rmtree(path)
+                total -= size
+
+    def _darcs_snapshot_path(self, path, revision):
+        return os.path.join(self._darcs_snapshot(revision), path)
+
     def _vcs_get_file_contents(self, path, revision=None):
         if revision == None:
             return base.VCS._vcs_get_file_contents(self, path, revision)
-        if self > '2.0.0':
-            status,output,error = self._u_invoke_client( \
-                'show', 'contents', '--patch', revision, path)
-            return output
-        # Darcs versions < 2.0.0pre2 lack the 'show contents' command
-
-        patch = self._diff(revision, path=path, unicode_output=False)
-
-        # '--output -' to be supported in GNU patch > 2.5.9
-        # but that hasn't been released as of June 30th, 2009.
-
-        # Rewrite path to status before the patch we want
-        args=['patch', '--reverse', path]
-        status,output,error = self._u_invoke(args, stdin=patch)
-
-        if os.path.exists(os.path.join(self.repo, path)) == True:
-            contents = base.VCS._vcs_get_file_contents(self, path)
-        else:
-            contents = ''
-
-        # Now restore path to it's current incarnation
-        args=['patch', path]
-        status,output,error = self._u_invoke(args, stdin=patch)
-        return contents
+        path = self._darcs_snapshot_path(path, revision)
+        if not os.path.exists(path):
+            return libbe.util.InvalidObject
+        if os.path.isdir(path):
+            return libbe.storage.base.InvalidDirectory
+        with open(path, 'rb') as f:
+            return f.read()
 
     def _vcs_path(self, id, revision):
-        return self._u_find_id(id, revision)
+        path = self._darcs_ids(revision).get(id)
+        if path is None:
+            raise base.InvalidID(id, revision=revision)
+        return path
+
+    def _vcs_paths(self, ids, revision):
+        paths = self._darcs_ids(revision)
+        return dict((id, paths[id]) for id in ids if id in paths)
+
+    def _darcs_ids(self, revision):
+        hash = self._darcs_patch_hash(revision)
+        ids = self._snapshot_ids.get(hash)
+        if ids is None:
+            be_dir = self._u_rel_path(self.be_dir)
+            ids = self._u_manifest_ids(self._vcs_listfiles(be_dir, revision))
+            self._snapshot_ids[hash] = ids
+        return ids
 
     def _vcs_isdir(self, path, revision):
-        if self > '2.3.1':
-            # Sun Nov 15 20:32:06 EST 2009  thomashartman1@gmail.com
-            #   * add versioned show files functionality (darcs show files -p 'some patch')
-            _, output, __ = self._u_invoke_client(
-                'show', 'files', '--no-files', '--no-pending', '--patch',
-                revision)
-            children = output.rstrip('\n').splitlines()
-            rpath = '.'
-            children = [self._u_rel_path(c, rpath) for c in children]
-            if path in children:
-                return True
-            return False
-        raise NotImplementedError(
-            'Darcs versions <= 2.3.1 lack the --patch option for "show files"')
+        return os.path.isdir(self._darcs_snapshot_path(path, revision))
 
     def _vcs_listdir(self, path, revision):
-        if self > '2.3.1':
-            # Sun Nov 15 20:32:06 EST 2009  thomashartman1@gmail.com
-            #   * add versioned show files functionality (darcs show files -p 'some patch')
-            # Wed Dec  9 05:42:21 EST 2009  Luca Molteni <volothamp@gmail.com>
-            #   * resolve issue835 show file with file directory arguments
-            path = path.rstrip(os.path.sep)
-            _, output, __ = self._u_invoke_client(
-                'show', 'files', '--no-pending', '--patch', revision, path)
-            files = output.rstrip('\n').splitlines()
-            if path == '.':
-                descendents = [self._u_rel_path(f, path) for f in files
-                               if f != '.']
-            else:
-                rel_files = [self._u_rel_path(f, path) for f in files]
-                descendents = [f for f in rel_files
-                               if f != '.' and not f.startswith('..')]
-            return [f for f in descendents if f.count(os.path.sep) == 0]
-        # Darcs versions <= 2.3.1 lack the --patch option for 'show files'
-        raise NotImplementedError
+        path = self._darcs_snapshot_path(path, revision)
+        if not os.path.isdir(path):
+            return []  # like "darcs show files" for a missing path
+        return os.listdir(path)
+
+    def _vcs_listfiles(self, path, revision):
+        snapshot = self._darcs_snapshot(revision)
+        files = []
+        for dirpath,dirnames,filenames in os.walk(
+                os.path.join(snapshot, path)):
+            files.extend(self._u_rel_path(os.path.join(dirpath, f), snapshot)
+                         for f in filenames)
+        return files
 
     def _vcs_commit(self, commitfile, allow_empty=False):
         id = self.get_user_id()
@@ -210,6 +290,7 @@ class Darcs(base.VCS):
             status,output,error = self._u_invoke_client(*args)
         self.__updated = []
         # end work around
+        self._patch_hashes.clear()  # the new patch may reuse a name
         if self._u_any_in_string(empty_strings, output) == True:
             if allow_empty == False:
                 raise base.EmptyCommit()
@@ -224,12 +305,14 @@ class Darcs(base.VCS):
             revision = match.groups()[0]
         return revision
 
-    def _revisions(self):
+    def _patches(self, *args):
         """
-        Return a list of revisions in the repository.
+        Return a list of (hash, name) pairs for the patches listed by
+        ``darcs changes --xml`` with args, newest first.
         """
-        status,output,error = self._u_invoke_client('changes', '--xml')
-        revisions = []
+        status,output,error = self._u_invoke_client(
+            'changes', '--xml', *args)
+        patches = []
         xml_str = output.encode('unicode_escape').replace(r'\n', '\n')
         element = ElementTree.XML(xml_str)
         assert element.tag == 'changelog', element.tag
@@ -238,24 +321,61 @@ class Darcs(base.VCS):
             for child in patch.getchildren():
                 if child.tag == 'name':
                     text = unescape(unicode(child.text).decode('unicode_escape').strip())
-                    revisions.append(text)
+                    patches.append((patch.get('hash'), text))
+        return patches
+
+    def _revisions(self, from_patch=None):
+        """
+        Return a list of revisions in the repository, starting with
+        the one matching from_patch if given.
+        """
+        args = []
+        if from_patch is not None:
+            args.extend(['--from-patch', from_patch])
+        revisions = [name for hash,name in self._patches(*args)]
         revisions.reverse()
         return revisions
 
     def _vcs_revision_id(self, index):
-        revisions = self._revisions()
+        return self._u_revision_id(index)
+
+    def _vcs_revisions(self, since=None):
+        if since is None:
+            return self._revisions()
         try:
-            if index > 0:
-                return revisions[index-1]
-            elif index < 0:
-                return revisions[index]
-            else:
-                return None
-        except IndexError:
+            revisions = self._revisions(from_patch=since)
+        except CommandError:
+            return None  # since was unrecorded
+        if not revisions or revisions[0] != since:
             return None
+        return revisions[1:]
+
+    def _vcs_changed(self, revision):
+        """
+        Compare the revision snapshot (see :py:meth:`_darcs_snapshot`)
+        with the working tree by name and contents, without producing
+        a diff.
+        """
+        snapshot = self._darcs_snapshot(revision)
+        be_dir = self._u_rel_path(self.be_dir)
+        old = set(self._vcs_listfiles(be_dir, revision))
+        current = set()
+        for dirpath,dirnames,filenames in os.walk(self.be_dir):
+            if dirpath == self.be_dir:
+                dirnames[:] = [d for d in dirnames
+                               if d not in base.BE_DIR_CACHES]
+                filenames = [f for f in filenames
+                             if f not in base.BE_DIR_CACHES]
+            current.update(self._u_rel_path(os.path.join(dirpath, f))
+                           for f in filenames)
+        modified = set(
+            path for path in old & current
+            if not filecmp.cmp(os.path.join(snapshot, path),
+                               os.path.join(self.repo, path), shallow=False))
+        return (current - old, modified, old - current)
 
     def _diff(self, revision, path=None, unicode_output=True):
-        revisions = self._revisions()
+        revisions = self._u_revisions()
         i = revisions.index(revision)
         args = ['diff', '--unified']
         if i+1 < len(revisions):
@@ -25,11 +25,11 @@
 .. _Git: http://git-scm.com/
 """
 
-import distutils.spawn
 import os
 import os.path
 import re
 import shutil
+import subprocess
 import unittest
 
 try:
@@ -44,16 +44,28 @@ else:
             'pygit2 <= 0.17.3 not supported')
 
 import libbe
-from libbe.unidiff import PatchSet
+import libbe.storage
+import libbe.util
 from ...ui.util import user as _user
 from ...util import encoding as _encoding
+from ...util.lru import LRUCache as _LRUCache
+from ...util.subproc import CommandError as _CommandError
+from ...util.subproc import invoke as _invoke
+from ..util import probes as _probes
+from ..base import ConnectionError as _ConnectionError
+from ..base import DirectoryNotEmpty as _DirectoryNotEmpty
 from ..base import EmptyCommit as _EmptyCommit
+from ..base import InvalidDirectory as _InvalidDirectory
+from ..base import InvalidRevision as _InvalidRevision
+from ..base import VersionedStorage as _VersionedStorage
 from . import base
 
 if libbe.TESTING == True:
     import doctest
     import sys
 
+    import libbe.util.utility
+
 
 def new():
     if _pygit2:
@@ -62,6 +74,112 @@ def new():
         return ExecGit()
 
 
+def _is_dirty(path, dirty):
+    """Return True if `path` or one of its descendants is in `dirty`."""
+    prefix = path + '/'
+    for dirty_path in dirty:
+        if dirty_path == path or dirty_path.startswith(prefix):
+            return True
+    return False
+
+
+def _pygit_user_id(repository):
+    """Return the user id configured for `repository`, or None."""
+    try:
+        name = repository.config['user.name']
+    except KeyError:
+        name = ''
+    try:
+        email = repository.config['user.email']
+    except KeyError:
+        email = ''
+    if name != '' or email != '': # got something!
+        # guess missing info, if necessary
+        if name == '':
+            name = _user.get_fallback_fullname()
+        if email == '':
+            email = _user.get_fallback_email()
+        if '@' not in email:
+            raise ValueError((name, email))
+        return _user.create_user_id(name, email)
+    return None # Git has no infomation
+
+
+# number of revisions whose commit and trees PygitGit keeps in memory
+_REVISION_CACHE_SIZE = 8
+
+_FULL_REVISION_REGEXP = re.compile('^[0-9a-f]{40}$')
+
+
+class _CatFile (object):
+    """A long-running ``git cat-file --batch`` (or ``--batch-check``)
+    process, so reading many objects doesn't fork a ``git`` for each.
+    """
+    def __init__(self, client, cwd, check=False):
+        self.check = check
+        if check:
+            self.args = [client, 'cat-file', '--batch-check']
+        else:
+            self.args = [client, 'cat-file', '--batch']
+        self.cwd = cwd
+        self._popen = None
+
+    def read(self, spec):
+        """Return `(type, contents)` for the object named by `spec`,
+        or `None` if there is no such object.  `contents` is `None`
+        for ``--batch-check``.
+        """
+        if self._popen is None:
+            libbe.LOG.debug('%s$ %s', self.cwd, ' '.join(self.args))
+            with open(os.devnull, 'w') as devnull:
+                self._popen = subprocess.Popen(
+                    self.args, stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+                    stderr=devnull, cwd=self.cwd)
+        try:
+            self._popen.stdin.write(spec + '\n')
+            self._popen.stdin.flush()
+            header = self._popen.stdout.readline()
+        except IOError:
+            header = ''
+        if not header.endswith('\n'):
+            status = self.close()
+            raise _CommandError(self.args, status or -1, stderr=spec)
+        fields = header.split()
+        if fields[-1] in ['missing', 'ambiguous']:
+            return None
+        type = fields[1]
+        if self.check:
+            return (type, None)
+        contents = self._popen.stdout.read(int(fields[2]))
+        self._popen.stdout.read(1)  # trailing newline
+        return (type, contents)
+
+    def close(self):
+        """Stop the process, returning its exit status."""
+        if self._popen is None:
+            return None
+        self._popen.stdin.close()
+        status = self._popen.wait()
+        self._popen = None
+        return status
+
+
+def _parse_tree(contents):
+    """Return the entry names from a raw git tree object.
+
+    >>> _parse_tree('100644 values\\x00' + 'x' * 20 +
+    ...             '40000 comments\\x00' + 'y' * 20)
+    ['values', 'comments']
+    """
+    names = []
+    offset = 0
+    while offset < len(contents):
+        end = contents.index('\0', offset)
+        names.append(contents[offset:end].split(' ', 1)[1])
+        offset = end + 21  # skip the NUL and binary object ID
+    return names
+
+
 class PygitGit(base.VCS):
     """:py:class:`base.VCS` implementation for Git.
 
@@ -75,6 +193,7 @@ class PygitGit(base.VCS):
         base.VCS.__init__(self, *args, **kwargs)
         self.versioned = True
         self._pygit_repository = None
+        self._pygit_revisions = _LRUCache(size=_REVISION_CACHE_SIZE)
 
     def __getstate__(self):
         """`pygit2.Repository`\s don't seem to pickle well.
@@ -82,6 +201,7 @@ class PygitGit(base.VCS):
         attrs = dict(self.__dict__)
         if self._pygit_repository is not None:
             attrs['_pygit_repository'] = self._pygit_repository.path
+        attrs['_pygit_revisions'] = _LRUCache(size=_REVISION_CACHE_SIZE)
         return attrs
 
     def __setstate__(self, state):
@@ -103,24 +223,7 @@ class PygitGit(base.VCS):
         return _pygit2 is not None
 
     def _vcs_get_user_id(self):
-        try:
-            name = self._pygit_repository.config['user.name']
-        except KeyError:
-            name = ''
-        try:
-            email = self._pygit_repository.config['user.email']
-        except KeyError:
-            email = ''
-        if name != '' or email != '': # got something!
-            # guess missing info, if necessary
-            if name == '':
-                name = _user.get_fallback_fullname()
-            if email == '':
-                email = _user.get_fallback_email()
-            if '@' not in email:
-                raise ValueError((name, email))
-            return _user.create_user_id(name, email)
-        return None # Git has no infomation
+        return _pygit_user_id(self._pygit_repository)
 
     def _vcs_detect(self, path):
         try:
@@ -166,39 +269,86 @@ class PygitGit(base.VCS):
             self._pygit_repository.index.write()
             os.remove(os.path.join(self.repo, path))
 
+    def _vcs_remove_many(self, paths, dirs=()):
+        index = self._pygit_repository.index
+        index.read()
+        for path in paths:
+            try:
+                del index[path]
+            except KeyError:
+                pass  # not added yet
+            os.remove(os.path.join(self.repo, path))
+        index.write()
+
     def _vcs_update(self, path):
         self._vcs_add(path)
 
+    def _vcs_add_many(self, paths):
+        self._pygit_repository.index.read()
+        for path in paths:
+            if not os.path.isdir(self._u_abspath(path)):
+                self._pygit_repository.index.add(path)
+        self._pygit_repository.index.write()
+
+    def _vcs_update_many(self, paths):
+        self._vcs_add_many(paths)
+
     def _git_get_commit(self, revision):
+        return self._git_get_revision(revision=revision)[0]
+
+    def _git_get_revision(self, revision):
+        """Return `(commit, trees)` for `revision`.
+
+        `trees` maps the paths of the trees visited so far (`''` for
+        the root) to `(tree, entries)`, where `entries` maps entry
+        names to tree entries.  The most recently used revisions are
+        kept, so walking the same revision again is a dict lookup per
+        path component.
+        """
         if isinstance(revision, str):
             revision = unicode(revision, 'ascii')
-        commit = self._pygit_repository.revparse_single(revision)
-        assert commit.type == _pygit2.GIT_OBJ_COMMIT, commit
-        return commit
+        key = revision
+        if not _FULL_REVISION_REGEXP.match(revision):
+            # symbolic revisions (HEAD, branches, ...) can move
+            key = None
+        cached = self._pygit_revisions.get(key)
+        if cached is None:
+            try:
+                commit = self._pygit_repository.revparse_single(revision)
+            except (KeyError, ValueError):
+                raise _InvalidRevision(revision)
+            assert commit.type == _pygit2.GIT_OBJ_COMMIT, commit
+            key = commit.hex
+            cached = self._pygit_revisions.get(key)
+            if cached is None:
+                cached = (commit, {'': self._git_tree_entries(commit.tree)})
+                self._pygit_revisions[key] = cached
+        return cached
 
-    def _git_get_object(self, path, revision):
-        commit = self._git_get_commit(revision=revision)
-        tree = commit.tree
-        sections = path.split(os.path.sep)
-        for section in sections[:-1]:  # traverse trees
-            child_tree = None
-            for entry in tree:
-                if entry.name == section:
-                    eobj = entry.to_object()
-                    if eobj.type == _pygit2.GIT_OBJ_TREE:
-                        child_tree = eobj
-                        break
-                    else:
-                        raise ValueError(path)  # not a directory
-            if child_tree is None:
-                raise ValueError((path, sections, section, [e.name for e in tree]))
+    def _git_tree_entries(self, tree):
+        return (tree, dict((entry.name, entry) for entry in tree))
+
+    def _git_get_tree(self, trees, path):
+        if path not in trees:
+            dirname,name = os.path.split(path)
+            entry = self._git_get_tree(trees, dirname)[1].get(name)
+            if entry is None:
                 raise ValueError(path)  # not found
-            tree = child_tree
-        eobj = None
-        for entry in tree:
-            if entry.name == sections[-1]:
-                eobj = entry.to_object()
-        return eobj
+            tree = entry.to_object()
+            if tree.type != _pygit2.GIT_OBJ_TREE:
+                raise ValueError(path)  # not a directory
+            trees[path] = self._git_tree_entries(tree)
+        return trees[path]
+
+    def _git_get_object(self, path, revision):
+        commit,trees = self._git_get_revision(revision=revision)
+        if path in trees:
+            return trees[path][0]
+        dirname,name = os.path.split(path)
+        entry = self._git_get_tree(trees, dirname)[1].get(name)
+        if entry is None:
+            return None
+        return entry.to_object()
 
     def _vcs_get_file_contents(self, path, revision=None):
         if revision == None:
@@ -212,15 +362,57 @@ class PygitGit(base.VCS):
     def _vcs_path(self, id, revision):
         return self._u_find_id(id, revision)
 
+    def _vcs_fingerprints(self, paths, revision=None):
+        # blob and tree object IDs; the working tree is fingerprinted
+        # through the index, except for paths with unstaged changes or
+        # untracked files
+        repo = self._pygit_repository
+        dirty = []
+        if revision is None:
+            repo.index.read()
+            unstaged = (_pygit2.GIT_STATUS_WT_MODIFIED |
+                        _pygit2.GIT_STATUS_WT_DELETED |
+                        _pygit2.GIT_STATUS_WT_NEW)
+            dirty = [path for path,flags in repo.status().items()
+                     if flags & unstaged]
+            tree = repo[repo.index.write_tree()]
+        else:
+            tree = self._git_get_commit(revision=revision).tree
+        fingerprints = {}
+        for path in paths:
+            if _is_dirty(path, dirty):
+                continue
+            try:
+                fingerprints[path] = tree[path].hex
+            except KeyError:
+                pass
+        return fingerprints
+
     def _vcs_isdir(self, path, revision):
         obj = self._git_get_object(path=path, revision=revision)
         return obj.type == _pygit2.GIT_OBJ_TREE
 
     def _vcs_listdir(self, path, revision):
-        tree = self._git_get_object(path=path, revision=revision)
-        assert tree.type == _pygit2.GIT_OBJ_TREE, tree
+        commit,trees = self._git_get_revision(revision=revision)
+        tree = self._git_get_tree(trees, path)[0]
         return [e.name for e in tree]
 
+    def _vcs_listfiles(self, path, revision):
+        commit,trees = self._git_get_revision(revision=revision)
+        files = []
+        stack = [path]
+        while stack:
+            path = stack.pop()
+            for name,entry in self._git_get_tree(trees, path)[1].items():
+                child = os.path.join(path, name)
+                obj = entry.to_object()
+                if obj.type == _pygit2.GIT_OBJ_TREE:
+                    trees[child] = self._git_tree_entries(obj)
+                    stack.append(child)
+                else:
+                    files.append(child)
+        return files
+
     def _vcs_commit(self, commitfile, allow_empty=False):
         self._pygit_repository.index.read()
         tree_oid = self._pygit_repository.index.write_tree()
@@ -252,22 +444,23 @@ class PygitGit(base.VCS):
         return commit.hex
 
     def _vcs_revision_id(self, index):
-        walker = self._pygit_repository.walk(
-            self._pygit_repository.head.oid, _pygit2.GIT_SORT_TIME)
-        if index < 0:
-            target_i = -1 - index  # -1: 0, -2: 1, ...
-            for i,commit in enumerate(walker):
-                if i == target_i:
-                    return commit.hex
-        elif index > 0:
-            revisions = [commit.hex for commit in walker]
-            # revisions is [newest, older, ..., oldest]
-            if index > len(revisions):
-                return None
-            return revisions[len(revisions) - index]
-        else:
-            raise NotImplementedError('initial revision')
-        return None
+        return self._u_revision_id(index)
+
+    def _vcs_revisions(self, since=None):
+        try:
+            commit = self._pygit_repository.head
+        except _pygit2.GitError:  # no head; nothing committed yet
+            return []
+        revisions = []
+        while commit.hex != since:
+            revisions.append(commit.hex)
+            if not commit.parents:
+                if since is not None:
+                    return None  # since is not a first-parent ancestor
+                break
+            commit = commit.parents[0]
+        revisions.reverse()
+        return revisions
 
     def _vcs_changed(self, revision):
         commit = self._git_get_commit(revision=revision)
@@ -290,18 +483,57 @@ class ExecGit (PygitGit):
     """
     name='git'
     client='git'
+    _max_args = 500  # paths per command, to stay under ARG_MAX
 
     def __init__(self, *args, **kwargs):
         super(ExecGit, self).__init__(*args, **kwargs)
         self.__vcs_version = None
+        self._cat_files = {}  # check -> _CatFile, for revisioned reads
+
+    def __getstate__(self):
+        """Copies start their own `git cat-file` processes.
+        """
+        attrs = dict(self.__dict__)
+        attrs['_cat_files'] = {}
+        return attrs
+
+    def _disconnect(self):
+        for cat_file in self._cat_files.values():
+            cat_file.close()
+        self._cat_files = {}
+        super(ExecGit, self)._disconnect()
+
+    def _git_check_revision(self, revision):
+        """Raise InvalidRevision unless revision names a commit."""
+        status,output,error = self._u_invoke_client(
+            'rev-parse', '--verify', '--quiet', '%s^{commit}' % revision,
+            expect=(0,1,128))
+        if status != 0:
+            raise _InvalidRevision(revision)
+
+    def _git_cat_file(self, revision, path, check=False):
+        """Return `(type, contents)` for path as of revision, or `None`
+        if it did not exist.  See :py:class:`_CatFile`.
+        """
+        if check not in self._cat_files:
+            self._cat_files[check] = _CatFile(
+                self.client, cwd=self.repo, check=check)
+        spec = '%s:%s' % (revision, path)
+        if isinstance(spec, unicode):
+            spec = spec.encode(self.encoding)
+        return self._cat_files[check].read(spec)
 
     @property
     def _vcs_version(self):
         if self.__vcs_version is None:
-            _, output, __ = self._u_invoke_client('--version')
-            self.__vcs_version = output.strip().split()[-1]
+            self.__vcs_version = _probes.version(
+                self.client, self._probe_version)
         return self.__vcs_version
 
+    def _probe_version(self):
+        _, output, __ = self._u_invoke_client('--version')
+        return output.strip().split()[-1]
+
     def _vcs_get_user_id(self):
         status,output,error = self._u_invoke_client(
             'config', 'user.name', expect=(0,1))
@@ -341,7 +573,7 @@ class ExecGit (PygitGit):
 
     @staticmethod
     def _vcs_installed():
-        return distutils.spawn.find_executable(ExecGit.name)
+        return _probes.find_executable(ExecGit.name)
 
     def _vcs_init(self, path):
         self._u_invoke_client('init', cwd=path)
@@ -360,36 +592,118 @@ class ExecGit (PygitGit):
         if not os.path.isdir(self._u_abspath(path)):
             self._u_invoke_client('rm', '-f', path)
 
+    def _vcs_remove_many(self, paths, dirs=()):
+        # directories go away with their last file
+        for i in range(0, len(paths), self._max_args):
+            self._u_invoke_client('rm', '-f', '-q', '--ignore-unmatch', '--',
+                                  *paths[i:i+self._max_args])
+
     def _vcs_update(self, path):
         self._vcs_add(path)
 
+    def _vcs_add_many(self, paths):
+        paths = [p for p in paths if not os.path.isdir(self._u_abspath(p))]
+        for i in range(0, len(paths), self._max_args):
+            self._u_invoke_client('add', '--', *paths[i:i+self._max_args])
+
+    def _vcs_update_many(self, paths):
+        self._vcs_add_many(paths)
+
     def _vcs_get_file_contents(self, path, revision=None):
         if revision == None:
             return base.VCS._vcs_get_file_contents(self, path, revision)
-        else:
-            arg = '%s:%s' % (revision,path)
-            status,output,error = self._u_invoke_client('show', arg)
-            return output
+        obj = self._git_cat_file(revision, path)
+        if obj is None:
+            self._git_check_revision(revision)
+            return libbe.util.InvalidObject
+        type,contents = obj
+        if type != 'blob':
+            return _InvalidDirectory
+        return contents
+
+    def _vcs_fingerprints(self, paths, revision=None):
+        # blob and tree object IDs from a single listing of .be; the
+        # working tree is fingerprinted through the index, except for
+        # paths with unstaged changes or untracked files
+        be_dir = self._u_rel_path(self.be_dir)
+        dirty = []
+        if revision is None:
+            status,output,error = self._u_invoke_client(
+                'diff-files', '--name-only', '-z', '--', be_dir)
+            dirty = [path for path in output.split('\0') if path]
+            dirty.extend(self._git_untracked(be_dir))
+            status,output,error = self._u_invoke_client(
+                'write-tree', expect=(0,128))
+            if status != 0:
+                return {}
+            revision = output.strip()
+        status,output,error = self._u_invoke_client(
+            'ls-tree', '-r', '-t', '-z', revision, '--', be_dir,
+            expect=(0,128))
+        if status != 0:
+            return {}
+        oids = {}
+        for entry in output.split('\0'):
+            if entry:
+                info,path = entry.split('\t', 1)
+                oids[path] = info.split()[2]
+        return dict((path, oids[path]) for path in paths
+                    if path in oids and not _is_dirty(path, dirty))
+
+    def _git_untracked(self, be_dir):
+        """Return the untracked paths under `be_dir`, except for BE's
+        own caches.
+        """
+        status,output,error = self._u_invoke_client(
+            'ls-files', '--others', '--exclude-standard', '-z', '--', be_dir)
+        caches = ['%s/%s' % (be_dir, name) for name in base.BE_DIR_CACHES]
+        return [path for path in output.split('\0') if path and not
+                [c for c in caches if path == c or path.startswith(c + '/')]]
+
+    def _vcs_snapshot_key(self):
+        # The staged .be tree identifies its contents, as long as
+        # nothing under .be has been changed or created without being
+        # staged.
+        be_dir = self._u_rel_path(self.be_dir)
+        status,output,error = self._u_invoke_client(
+            'diff-files', '--quiet', '--', be_dir, expect=(0,1))
+        if status == 0 and not self._git_untracked(be_dir):
+            status,output,error = self._u_invoke_client(
+                'write-tree', '--prefix=%s/' % be_dir, expect=(0,128))
+            if status == 0:
+                return output.strip()
+        return base.VCS._vcs_snapshot_key(self)
 
     def _vcs_path(self, id, revision):
         return self._u_find_id(id, revision)
 
+    def _vcs_paths(self, ids, revision):
+        status,output,error = self._u_invoke_client(
+            'ls-tree', '-r', '--name-only', revision, '--',
+            self._cached_path_id._spacer_dirs[0])
+        return self._u_find_ids_from_manifest(
+            ids, output.splitlines(), revision=revision)
+
     def _vcs_isdir(self, path, revision):
-        arg = '%s:%s' % (revision,path)
-        args = ['ls-tree', arg]
-        kwargs = {'expect':(0,128)}
-        status,output,error = self._u_invoke_client(*args, **kwargs)
-        if status != 0:
-            if 'not a tree object' in error:
-                return False
-            raise base.CommandError(args, status, stderr=error)
-        return True
+        obj = self._git_cat_file(revision, path, check=True)
+        if obj is None:
+            raise _CommandError(
+                ['cat-file', '%s:%s' % (revision, path)], 128,
+                stderr='Not a valid object name')
+        return obj[0] == 'tree'
 
     def _vcs_listdir(self, path, revision):
-        arg = '%s:%s' % (revision,path)
+        obj = self._git_cat_file(revision, path)
+        if obj is None or obj[0] != 'tree':
+            raise _CommandError(
+                ['cat-file', '%s:%s' % (revision, path)], 128,
+                stderr='Not a tree object')
+        return [name.decode(self.encoding) for name in _parse_tree(obj[1])]
+
+    def _vcs_listfiles(self, path, revision):
         status,output,error = self._u_invoke_client(
-            'ls-tree', '--name-only', arg)
-        return output.rstrip('\n').splitlines()
+            'ls-tree', '-r', '-z', '--name-only', revision, '--', path)
+        return [f for f in output.split('\0') if f]
 
     def _vcs_commit(self, commitfile, allow_empty=False):
         args = ['commit', '--file', commitfile]
@@ -409,23 +723,27 @@ class ExecGit (PygitGit):
         return full_revision
 
     def _vcs_revision_id(self, index):
+        return self._u_revision_id(index)
+
+    def _vcs_revisions(self, since=None):
         args = ['rev-list', '--first-parent', '--reverse', 'HEAD']
+        if since is not None:
+            # list since itself too, to check it is still an ancestor
+            args.append('^%s^@' % since)
         kwargs = {'expect':(0,128)}
         status,output,error = self._u_invoke_client(*args, **kwargs)
         if status == 128:
             if error.startswith("fatal: ambiguous argument 'HEAD': unknown "):
-                return None
+                return []
+            if since is not None:
+                return None  # e.g. since was garbage collected
             raise base.CommandError(args, status, stderr=error)
         revisions = output.splitlines()
-        try:
-            if index > 0:
-                return revisions[index-1]
-            elif index < 0:
-                return revisions[index]
-            else:
+        if since is not None:
+            if not revisions or revisions[0] != since:
                 return None
-        except IndexError:
-            return None
+            return revisions[1:]
+        return revisions
 
     def _diff(self, revision):
         _, output, __ = self._u_invoke_client('diff', revision)
@@ -437,14 +755,692 @@ class ExecGit (PygitGit):
           (new, modified, removed)
         from the specified revision to the current situation.
         """
-        output = self._diff(revision)
-        patch = PatchSet.from_string(output)
-        return patch.changed_files
+        _, output, __ = self._u_invoke_client(
+            'diff', '--name-status', '--no-renames', '-z', revision, '--',
+            self._u_rel_path(self.be_dir))
+        new = set()
+        modified = set()
+        removed = set()
+        fields = output.split('\0')
+        for status,path in zip(fields[0::2], fields[1::2]):
+            if status == 'A':
+                new.add(path)
+            elif status == 'D':
+                removed.add(path)
+            else:  # M, T (type change), U (unmerged)
+                modified.add(path)
+        return (new, modified, removed)
+
+
+# file modes of PygitBranch tree entries
+_TREE_MODE = 0o040000
+_BLOB_MODE = 0o100644
+
+# number of revisions whose trees PygitBranch keeps in memory
+_BRANCH_REVISION_CACHE_SIZE = 8
+
+# old value git update-ref uses for refs that must not exist yet
+_NO_OID = '0' * 40
+
+
+class ConcurrentUpdate (_ConnectionError):
+    """Raised when a :py:class:`PygitBranch` ref moved since the
+    storage connected, so writing it would lose another process's
+    changes, or when git could not lock it.  `error` is git's
+    explanation, which names the lock file if one is in the way.
+    """
+    def __init__(self, ref, error=None):
+        if error is None:
+            msg = ('%s was updated by another process; reconnect and '
+                   'redo your changes' % ref)
+        else:
+            msg = ('could not update %s, another process may have changed '
+                   'or locked it:\n  %s' % (ref, error))
+        _ConnectionError.__init__(self, msg)
+        self.ref = ref
+
+
+class _TreeNode (object):
+    """A git tree that can be changed in memory.
+
+    `entries` is read from the tree object `oid` on first use and maps
+    names to :py:class:`_TreeNode`\s for subtrees and to `(oid,
+    filemode)` tuples for blobs.  Only the subtrees that were changed
+    are written back by :py:meth:`write`.
+    """
+    def __init__(self, repository, oid=None):
+        self.repository = repository
+        self.oid = oid  # None until the changed tree is written
+        self._entries = None
+
+    @property
+    def entries(self):
+        if self._entries is None:
+            self._entries = {}
+            if self.oid is not None:
+                for entry in self.repository[self.oid]:
+                    if entry.filemode == _TREE_MODE:
+                        self._entries[entry.name] = _TreeNode(
+                            self.repository, entry.oid)
+                    else:
+                        self._entries[entry.name] = (
+                            entry.oid, entry.filemode)
+        return self._entries
+
+    def modified(self):
+        """Mark the tree as changed, so it is rewritten."""
+        self.entries  # read them before forgetting where from
+        self.oid = None
+
+    def write(self):
+        """Write the changed subtrees, returning this tree's oid."""
+        if self.oid is None:
+            builder = self.repository.TreeBuilder()
+            for name,entry in sorted(self.entries.items()):
+                if isinstance(entry, _TreeNode):
+                    builder.insert(name, entry.write(), _TREE_MODE)
+                else:
+                    builder.insert(name, entry[0], entry[1])
+            self.oid = builder.write()
+        return self.oid
+
+
+class PygitBranch (_VersionedStorage):
+    """:py:class:`~libbe.storage.base.VersionedStorage` keeping the
+    bug database on a git ref instead of in the working tree.
+
+    The ref (:py:attr:`ref`) holds commits whose trees have the same
+    ``.be`` layout as the other VCS backends, but blobs and trees are
+    written directly with :py:mod:`pygit2`, so the checkout and the
+    index are never touched.  Uncommitted changes are kept on
+    :py:attr:`worktree_ref`, as a commit on top of :py:attr:`ref`
+    that is rewritten whenever the storage is flushed.
+    """
+    name = 'pygit2-branch'
+    ref = 'refs/be/main'
+    worktree_ref = 'refs/be/worktree'
+
+    def __init__(self, *args, **kwargs):
+        _VersionedStorage.__init__(self, *args, **kwargs)
+        self._repository = None
+        self._root = None  # working tree
+        self._paths = None  # uuid -> path in the working tree
+        self._worktree_tree = None  # tree oid on worktree_ref
+        self._ref_oids = {}  # ref -> commit oid (or None) at connect
+        self._empty_blob = None
+        self._branch_revisions = _LRUCache(size=_BRANCH_REVISION_CACHE_SIZE)
+        self._spacer_dirs = base.CachedPathID()._spacer_dirs
+
+    def version(self):
+        if _pygit2:
+            return getattr(_pygit2, '__version__', '?')
+        return None
+
+    def get_user_id(self):
+        if self._repository is None:
+            return None
+        return _pygit_user_id(self._repository)
+
+    def storage_version(self, revision=None):
+        root = self._branch_state(revision)[0]
+        entry = self._branch_entry(root, self._spacer_dirs[0] + '/version')
+        if not isinstance(entry, tuple):
+            raise libbe.storage.InvalidStorageVersion(None)
+        contents = self._repository[entry[0]].read_raw()
+        return unicode(contents, self.encoding).strip()
+
+    def _branch_open(self):
+        try:
+            gitdir = _pygit2.discover_repository(self.repo)
+        except KeyError:
+            raise _ConnectionError(self)
+        return _pygit2.Repository(gitdir)
+
+    def _branch_head(self, ref=None):
+        """Return the commit `ref` (default :py:attr:`ref`) points to,
+        or None if there is no such ref.
+        """
+        if ref is None:
+            ref = self.ref
+        try:
+            oid = self._repository.lookup_reference(ref).oid
+        except KeyError:
+            return None
+        return self._repository[oid]
+
+    def _init(self):
+        try:
+            self._repository = self._branch_open()
+        except _ConnectionError:
+            self._repository = _pygit2.init_repository(self.repo, False)
+        self._root = _TreeNode(self._repository)
+        self._ref_oids = self._branch_ref_oids()
+        version = libbe.storage.STORAGE_VERSION + '\n'
+        self._branch_set_entry(
+            self._spacer_dirs[0] + '/version',
+            (self._repository.create_blob(version), _BLOB_MODE))
+        self._branch_write_worktree()
+        self._repository = None
+        self._root = None
+
+    def _destroy(self):
+        repository = self._branch_open()
+        for ref in [self.worktree_ref, self.ref]:
+            try:
+                repository.lookup_reference(ref).delete()
+            except KeyError:
+                pass
+
+    def _connect(self):
+        self._repository = self._branch_open()
+        self._ref_oids = self._branch_ref_oids()
+        head = self._branch_head(self.worktree_ref)
+        if head is None:
+            head = self._branch_head()
+        if head is None:
+            self._repository = None
+            raise _ConnectionError(self)
+        self._worktree_tree = head.tree.oid
+        self._root = _TreeNode(self._repository, self._worktree_tree)
+        self._paths = self._branch_paths(self._root)
+
+    def _disconnect(self):
+        self._repository = None
+        self._root = None
+        self._paths = None
+        self._empty_blob = None
+        self._ref_oids = {}
+        self._branch_revisions.clear()
+
+    def _flush(self):
+        if self._root is not None:
+            self._branch_write_worktree()
+
+    def _branch_signature(self):
+        name,email = _user.parse_user_id(_user.get_user_id(self))
+        # using default times is recent, see
+        #   https://github.com/libgit2/pygit2/pull/129
+        return _pygit2.Signature(name, email or '')
+
+    def _branch_ref_oids(self):
+        """Return a dict mapping :py:attr:`ref` and
+        :py:attr:`worktree_ref` to the commit oids they point at, or
+        None for missing refs.
+        """
+        oids = {}
+        for ref in [self.ref, self.worktree_ref]:
+            try:
+                oids[ref] = self._repository.lookup_reference(ref).oid
+            except KeyError:
+                oids[ref] = None
+        return oids
+
+    def _branch_update_refs(self, oids):
+        """Point the refs in `oids` (a dict mapping refs to commit
+        oids) at their new commits.
+
+        This is a compare-and-swap done by a single ``git update-ref
+        --stdin`` transaction, using git's own ref locks: both refs
+        must still point where they did when we connected (or last
+        updated them), or :py:class:`ConcurrentUpdate` is raised and
+        nothing is written.
+        """
+        commands = []
+        for ref in [self.ref, self.worktree_ref]:
+            old = self._ref_oids.get(ref)
+            old = _NO_OID if old is None else old.hex
+            if ref in oids:
+                commands.append('update %s %s %s\n'
+                                % (ref, oids[ref].hex, old))
+            else:
+                commands.append('verify %s %s\n' % (ref, old))
+        status,output,error = _invoke(
+            ['git', '--git-dir', self._repository.path, 'update-ref',
+             '--stdin'], stdin=''.join(commands), expect=(0, 128))
+        if status != 0:
+            refs = [ref for ref in [self.worktree_ref, self.ref]
+                    if ref in error] or [self.ref]
+            raise ConcurrentUpdate(refs[0], error.strip())
+        self._ref_oids.update(oids)
+
+    def _branch_write_worktree(self):
+        """Point :py:attr:`worktree_ref` at the current working tree."""
+        tree_oid = self._root.write()
+        if tree_oid == self._worktree_tree:
+            return
+        head = self._branch_head()
+        if head is not None and head.oid != self._ref_oids.get(self.ref):
+            raise ConcurrentUpdate(self.ref)
+        if head is not None and head.tree.oid == tree_oid:
+            oid = head.oid  # no uncommitted changes
+        else:
+            parents = []
+            if head is not None:
+                parents.append(head.oid)
+            signature = self._branch_signature()
+            oid = self._repository.create_commit(
+                None, signature, signature, 'Uncommitted changes\n',
+                tree_oid, parents)
+        self._branch_update_refs({self.worktree_ref: oid})
+        self._worktree_tree = tree_oid
+
+    def _branch_entry(self, root, path):
+        """Return the entry at `path` in the tree `root`, or None."""
+        entry = root
+        for name in path.split('/'):
+            if not isinstance(entry, _TreeNode):
+                return None
+            entry = entry.entries.get(name)
+            if entry is None:
+                return None
+        return entry
+
+    def _branch_set_entry(self, path, entry):
+        """Set the working tree entry at `path`, creating the trees
+        above it as needed.  Remove it if `entry` is None.
+        """
+        node = self._root
+        node.modified()
+        names = path.split('/')
+        for name in names[:-1]:
+            child = node.entries.get(name)
+            if not isinstance(child, _TreeNode):
+                child = node.entries[name] = _TreeNode(self._repository)
+            child.modified()
+            node = child
+        if entry is None:
+            node.entries.pop(names[-1], None)
+        else:
+            node.entries[names[-1]] = entry
+
+    def _branch_paths(self, root):
+        """Return a dict mapping the UUIDs in the tree `root` to their
+        paths, like :py:class:`~libbe.storage.vcs.base.CachedPathID`.
+        """
+        paths = {}
+        parents = ['']
+        for level,spacer in enumerate(self._spacer_dirs):
+            children = []
+            for parent in parents:
+                container = '/'.join(p for p in [parent, spacer] if p)
+                node = self._branch_entry(root, container)
+                if not isinstance(node, _TreeNode):
+                    continue
+                for name,entry in node.entries.items():
+                    if level == 0 and (name == 'version' or
+                                       name in base.BE_DIR_CACHES):
+                        continue
+                    path = '%s/%s' % (container, name)
+                    paths[name] = path
+                    if isinstance(entry, _TreeNode):
+                        children.append(path)
+            parents = children
+        return paths
+
+    def _branch_id(self, path):
+        """Return the id for `path`, see
+        :py:meth:`~libbe.storage.vcs.base.CachedPathID.id`.
+
+        >>> s = PygitBranch()
+        >>> s._branch_id('.be/abc/bugs/123/values')
+        '123/values'
+        >>> s._branch_id('.be/abc/settings')
+        'abc/settings'
+        """
+        names = path.split('/')[1:]
+        level = 1
+        while (len(names) > 2 and level < len(self._spacer_dirs) and
+               names[1] == self._spacer_dirs[level]):
+            names = names[2:]
+            level += 1
+        return '/'.join(names)
+
+    def _branch_state(self, revision=None):
+        """Return `(root, paths)` for the working tree or `revision`."""
+        if revision is None:
+            return (self._root, self._paths)
+        try:
+            commit = self._repository.revparse_single(revision)
+        except (KeyError, ValueError):
+            raise _InvalidRevision(revision)
+        state = self._branch_revisions.get(commit.hex)
+        if state is None:
+            root = _TreeNode(self._repository, commit.tree.oid)
+            state = (root, self._branch_paths(root))
+            self._branch_revisions[commit.hex] = state
+        return state
+
+    def _branch_path(self, id, revision=None):
+        root,paths = self._branch_state(revision)
+        uuid,sep,rest = id.partition('/')
+        if uuid not in paths:
+            raise base.InvalidID(id, revision=revision)
+        return (root, paths[uuid] + sep + rest)
+
+    def _add(self, id, parent=None, directory=False):
+        if '/' in id:
+            path = self._branch_path(id)[1]
+        elif id in self._paths:
+            return
+        elif parent is None:
+            path = '%s/%s' % (self._spacer_dirs[0], id)
+        else:
+            root,parent_path = self._branch_path(parent)
+            if not isinstance(self._branch_entry(root, parent_path),
+                              _TreeNode):
+                raise _InvalidDirectory(
+                    'Non-directory %s cannot have children' % parent)
+            level = (parent_path.count('/') - 1) // 2
+            path = '%s/%s/%s' % (
+                parent_path, self._spacer_dirs[level + 1], id)
+        if directory:
+            entry = _TreeNode(self._repository)
+        else:
+            if self._empty_blob is None:
+                self._empty_blob = self._repository.create_blob('')
+            entry = (self._empty_blob, _BLOB_MODE)
+        self._branch_set_entry(path, entry)
+        if '/' not in id:
+            self._paths[id] = path
+
+    def _exists(self, id, revision=None):
+        try:
+            root,path = self._branch_path(id, revision)
+        except base.InvalidID:
+            return False
+        return self._branch_entry(root, path) is not None
+
+    def _remove(self, id):
+        path = self._branch_path(id)[1]
+        if self._children(id):
+            raise _DirectoryNotEmpty(id)
+        self._branch_remove_path(path)
+        self._paths.pop(id, None)
+
+    def _recursive_remove(self, id):
+        path = self._branch_path(id)[1]
+        prefix = path + '/'
+        for uuid,uuid_path in list(self._paths.items()):
+            if uuid_path.startswith(prefix):
+                del self._paths[uuid]
+        self._branch_remove_path(path)
+        self._paths.pop(id, None)
+
+    def _branch_remove_path(self, path):
+        self._branch_set_entry(path, None)
+        dirname = path.rsplit('/', 1)[0]
+        if (dirname.rsplit('/', 1)[-1] in self._spacer_dirs[1:] and
+                not self._branch_entry(self._root, dirname).entries):
+            self._branch_set_entry(dirname, None)  # empty spacer dir
+
+    def _ancestors(self, id=None, revision=None):
+        if id is None:
+            return []
+        path = self._branch_path(id, revision)[1]
+        ancestors = []
+        while path.count('/') > 1:
+            path = path.rsplit('/', 1)[0]
+            if path.rsplit('/', 1)[-1] in self._spacer_dirs[1:]:
+                continue
+            ancestors.append(self._branch_id(path))
+        return ancestors
+
+    def _children(self, id=None, revision=None):
+        if id is None:
+            root = self._branch_state(revision)[0]
+            path = self._spacer_dirs[0]
+        else:
+            root,path = self._branch_path(id, revision)
+        node = self._branch_entry(root, path)
+        if not isinstance(node, _TreeNode):
+            return []
+        children = []
+        for name,entry in node.entries.items():
+            if (name in self._spacer_dirs[1:] and
+                    isinstance(entry, _TreeNode)):
+                children.extend(self._branch_id('%s/%s/%s' % (path, name, c))
+                                for c in entry.entries)
+            elif name == 'version' or (
+                    id is None and name in base.BE_DIR_CACHES):
+                continue
+            else:
+                children.append(self._branch_id('%s/%s' % (path, name)))
+        return children
+
+    def _children_many(self, ids, revision=None):
+        return dict((id, self._children(id, revision=revision))
+                    for id in ids)
+
+    def _get(self, id, default=libbe.util.InvalidObject, revision=None):
+        try:
+            root,path = self._branch_path(id, revision)
+        except base.InvalidID:
+            if default == libbe.util.InvalidObject:
+                raise
+            return default
+        entry = self._branch_entry(root, path)
+        contents = None
+        if isinstance(entry, tuple):
+            contents = self._repository[entry[0]].read_raw()
+        if not contents:
+            if default == libbe.util.InvalidObject:
+                raise base.InvalidID(id, revision)
+            return default
+        return contents
+
+    def _get_many(self, ids, default=libbe.util.InvalidObject,
+                  revision=None):
+        return dict((id, self._get(id, default=default, revision=revision))
+                    for id in ids)
+
+    def _fingerprints(self, ids, revision=None):
+        fingerprints = {}
+        for id in ids:
+            fingerprints[id] = None
+            try:
+                root,path = self._branch_path(id, revision)
+            except base.InvalidID:
+                continue
+            entry = self._branch_entry(root, path)
+            if isinstance(entry, tuple):
+                fingerprints[id] = entry[0].hex
+            elif entry is not None and entry.oid is not None:
+                fingerprints[id] = entry.oid.hex
+        return fingerprints
+
+    def _set(self, id, value):
+        root,path = self._branch_path(id)
+        entry = self._branch_entry(root, path)
+        if entry is None:
+            raise base.InvalidID(id)
+        elif isinstance(entry, _TreeNode):
+            raise _InvalidDirectory(id)
+        self._branch_set_entry(
+            path, (self._repository.create_blob(value), entry[1]))
+
+    def _commit(self, summary, body=None, allow_empty=False):
+        message = summary.strip() + '\n'
+        if body is not None:
+            message += '\n' + body.strip() + '\n'
+        if isinstance(message, unicode):
+            message = message.encode(self.encoding)
+        tree_oid = self._root.write()
+        head = self._branch_head()
+        parents = []
+        if head is not None:
+            if head.oid != self._ref_oids.get(self.ref):
+                raise ConcurrentUpdate(self.ref)
+            if not allow_empty and head.tree.oid == tree_oid:
+                raise _EmptyCommit()
+            parents.append(head.oid)
+        signature = self._branch_signature()
+        oid = self._repository.create_commit(
+            None, signature, signature, message, tree_oid, parents,
+            self.encoding)
+        self._branch_update_refs({self.ref: oid, self.worktree_ref: oid})
+        self._worktree_tree = tree_oid
+        return self._repository[oid].hex
+
+    def revision_id(self, index=None):
+        if index is None:
+            return None
+        try:
+            if int(index) != index:
+                raise _InvalidRevision(index)
+        except ValueError:
+            raise _InvalidRevision(index)
+        revisions = []
+        commit = self._branch_head()
+        while commit is not None:  # first parents, newest first
+            revisions.append(commit.hex)
+            commit = commit.parents[0] if commit.parents else None
+        revisions.reverse()
+        try:
+            if index > 0:
+                return revisions[index-1]
+            elif index < 0:
+                return revisions[index]
+        except IndexError:
+            pass
+        raise _InvalidRevision(index)
+
+    def changed(self, revision):
+        """Compare the trees by object id, only descending into
+        subtrees that differ.
+        """
+        be_dir = self._spacer_dirs[0]
+        old_root = self._branch_state(revision)[0]
+        stack = [(be_dir, self._branch_entry(old_root, be_dir),
+                  self._branch_entry(self._root, be_dir))]
+        new = []
+        modified = []
+        removed = []
+        while stack:
+            path,old,current = stack.pop()
+            if (isinstance(old, _TreeNode) and
+                    isinstance(current, _TreeNode)):
+                if old.oid is not None and old.oid == current.oid:
+                    continue
+                for name in set(old.entries) | set(current.entries):
+                    if path == be_dir and (name == 'version' or
+                                           name in base.BE_DIR_CACHES):
+                        continue
+                    stack.append(('%s/%s' % (path, name),
+                                  old.entries.get(name),
+                                  current.entries.get(name)))
+            elif isinstance(old, tuple) and isinstance(current, tuple):
+                if old[0] != current[0]:
+                    modified.append(self._branch_id(path))
+            else:
+                removed.extend(self._branch_files(path, old))
+                new.extend(self._branch_files(path, current))
+        return (new, modified, removed)
+
+    def _branch_files(self, path, entry):
+        """Return the ids of the files in `entry` (found at `path`)."""
+        if entry is None:
+            return []
+        elif isinstance(entry, tuple):
+            return [self._branch_id(path)]
+        ids = []
+        for name,child in entry.entries.items():
+            ids.extend(self._branch_files('%s/%s' % (path, name), child))
+        return ids
 
 
 if libbe.TESTING == True:
     base.make_vcs_testcase_subclasses(PygitGit, sys.modules[__name__])
     base.make_vcs_testcase_subclasses(ExecGit, sys.modules[__name__])
+    if _pygit2 is not None:
+        libbe.storage.base.make_versioned_storage_testcase_subclasses(
+            PygitBranch, sys.modules[__name__])
+
+    class PygitBranchTestCase (unittest.TestCase):
+        """Test cases for PygitBranch's use of the repository."""
+        def setUp(self):
+            if _pygit2 is None:
+                self.skipTest('pygit2 not found')
+            self.dir = libbe.util.utility.Dir()
+            self.s = PygitBranch(repo=self.dir.path)
+            self.s.init()
+            self.s.connect()
+
+        def tearDown(self):
+            if _pygit2 is not None:
+                self.s.disconnect()
+                self.s.destroy()
+                self.dir.cleanup()
+
+        def test_worktree_untouched(self):
+            """Writes and commits should only touch the refs."""
+            self.s.add('abc', directory=True)
+            self.s.add('abc/settings', parent='abc')
+            self.s.set('abc/settings', 'x\n')
+            revision = self.s.commit('Add abc')
+            self.assertEqual(os.listdir(self.dir.path), ['.git'])
+            repository = _pygit2.Repository(
+                _pygit2.discover_repository(self.dir.path))
+            self.assertEqual(len(repository.index), 0)
+            self.assertEqual(
+                repository.lookup_reference(PygitBranch.ref).oid.hex,
+                revision)
+            self.s.set('abc/settings', 'y\n')
+            self.s.flush()
+            other = PygitBranch(repo=self.dir.path)
+            other.connect()
+            self.assertEqual(other.get('abc/settings'), 'y\n')
+            self.assertEqual(other.get('abc/settings', revision=revision),
+                             'x\n')
+            self.assertEqual(other.changed(revision),
+                             ([], ['abc/settings'], []))
+            other.disconnect()
+
+        def test_concurrent_writes_are_rejected(self):
+            """A storage must not overwrite refs another storage moved
+            since it connected.
+            """
+            self.s.add('abc', directory=True)
+            self.s.add('abc/settings', parent='abc')
+            self.s.set('abc/settings', 'x\n')
+            self.s.commit('Add abc')
+            other = PygitBranch(repo=self.dir.path)
+            other.connect()
+            self.s.set('abc/settings', 'y\n')
+            self.s.flush()
+            other.set('abc/settings', 'z\n')
+            self.assertRaises(ConcurrentUpdate, other.flush)
+            self.assertRaises(ConcurrentUpdate, other.commit, 'Set z')
+            other.set('abc/settings', 'x\n')  # nothing left to flush
+            other.disconnect()
+            third = PygitBranch(repo=self.dir.path)
+            third.connect()
+            self.assertEqual(third.get('abc/settings'), 'y\n')
+            third.set('abc/settings', 'z\n')
+            third.commit('Set z')
+            third.disconnect()
+            self.s.set('abc/settings', 'w\n')
+            self.assertRaises(ConcurrentUpdate, self.s.commit, 'Set w')
+            self.s.set('abc/settings', 'y\n')
+
+        def test_stale_ref_lock_is_reported(self):
+            """A lock left by a dead git process should be named in
+            the error rather than hanging or crashing.
+            """
+            self.s.add('abc', directory=True)
+            lock = os.path.join(
+                self.s._repository.path, 'refs', 'be', 'worktree.lock')
+            open(lock, 'w').close()
+            try:
+                try:
+                    self.s.flush()
+                except ConcurrentUpdate, e:
+                    self.assertEqual(e.ref, PygitBranch.worktree_ref)
+                    self.failUnless(lock in str(e), str(e))
+                else:
+                    self.fail('flushed past %s' % lock)
+            finally:
+                os.remove(lock)
+            self.s.flush()
 
     unitsuite =unittest.TestLoader().loadTestsFromModule(sys.modules[__name__])
     suite = unittest.TestSuite([unitsuite, doctest.DocTestSuite()])
@@ -49,31 +49,164 @@ import os.path
 import re
 import shutil
 import StringIO
+import struct
+import subprocess
 import sys
-import time # work around http://mercurial.selenic.com/bts/issue618
+import tempfile
 
 import libbe
+import libbe.storage.base
+import libbe.util
+from libbe.storage.util import probes
+from libbe.util.lru import LRUCache
+from libbe.util.subproc import CommandError
 import base
 
 if libbe.TESTING == True:
     import doctest
+    import time
     import unittest
 
+    import libbe.util.utility
+
+
+# commands run in-process before starting a command server.  Starting
+# the server costs about as much as this many in-process commands save.
+_COMMAND_SERVER_THRESHOLD = 32
+
+# number of revisions whose manifests Hg keeps in memory
+_MANIFEST_CACHE_SIZE = 8
+
+_REVISION_REGEXP = re.compile('^[0-9a-f]+$')
+
 
 def new():
     return Hg()
 
+
+class _CommandServer (object):
+    """A running ``hg serve --cmdserver pipe``.
+
+    The server keeps Mercurial loaded and the repository open between
+    commands, which are sent over its stdin and stdout using the
+    framing described at https://www.mercurial-scm.org/wiki/CommandServer
+    """
+    def __init__(self, executable, cwd, encoding):
+        self.args = [executable, 'serve', '--cmdserver', 'pipe',
+                     '--config', 'ui.interactive=False']
+        self.cwd = cwd
+        self.encoding = encoding
+        self._popen = None
+
+    def start(self):
+        libbe.LOG.debug('%s$ %s', self.cwd, ' '.join(self.args))
+        env = dict(os.environ)
+        env['HGENCODING'] = self.encoding
+        self._popen = subprocess.Popen(
+            self.args, stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+            cwd=self.cwd, env=env)
+        channel,data = self._read()
+        if channel != 'o' or 'runcommand' not in data.split('\n')[0]:
+            self.close()
+            raise CommandError(self.args, -1, stderr=data)
+
+    def _read(self):
+        header = self._popen.stdout.read(5)
+        if len(header) != 5:
+            status = self.close()
+            raise CommandError(self.args, status or -1,
+                               stderr='command server exited')
+        channel = header[0]
+        length = struct.unpack('>I', header[1:])[0]
+        if channel in 'IL':  # input request, length is the wanted size
+            return (channel, length)
+        return (channel, self._popen.stdout.read(length))
+
+    def run(self, args):
+        """Run the hg command `args`, returning `(status, output)`."""
+        args = [a.encode(self.encoding) if isinstance(a, unicode) else a
+                for a in args]
+        data = '\0'.join(args)
+        self._popen.stdin.write(
+            'runcommand\n' + struct.pack('>I', len(data)) + data)
+        self._popen.stdin.flush()
+        output = []
+        while True:
+            channel,data = self._read()
+            if channel == 'o':
+                output.append(data)
+            elif channel == 'e':
+                sys.stderr.write(data)
+            elif channel == 'r':
+                return (struct.unpack('>i', data)[0], ''.join(output))
+            elif channel in 'IL':  # we have no input to give
+                self._popen.stdin.write(struct.pack('>I', 0))
+                self._popen.stdin.flush()
+            elif channel.isupper():  # required channel we don't know
+                self.close()
+                raise CommandError(args, -1,
+                                   stderr='unknown channel %r' % channel)
+
+    def close(self):
+        """Stop the server, returning its exit status."""
+        if self._popen is None:
+            return None
+        self._popen.stdin.close()
+        status = self._popen.wait()
+        self._popen = None
+        return status
+
+
+class _Manifest (object):
+    """The files tracked in a revision, indexed for lookups.
+
+    >>> m = _Manifest(['.be/version', '.be/abc/settings'])
+    >>> sorted(m.files)
+    ['.be/abc/settings', '.be/version']
+    >>> sorted(m.children['.be'])
+    ['abc', 'version']
+    >>> '.be/abc' in m.children
+    True
+    """
+    def __init__(self, files):
+        self.files = set(files)
+        self.children = {}  # directory -> set of child names
+        for f in files:
+            parts = f.split(os.path.sep)
+            for i in range(1, len(parts)):
+                self.children.setdefault(
+                    os.path.sep.join(parts[:i]), set()).add(parts[i])
+        self.ids = None  # id -> path, see Hg._hg_manifest_ids
+
+
 class Hg(base.VCS):
     """:py:class:`base.VCS` implementation for Mercurial.
+
+    Commands run in-process through :py:mod:`mercurial.dispatch`.
+    Once a connection has run a few dozen of them, later commands are
+    sent to a persistent command server instead (see
+    :py:class:`_CommandServer`), unless the ``hg`` executable is
+    missing or :py:attr:`command_server` is `False`.
     """
     name='hg'
     client=None # mercurial module
+    command_server = True
 
     def __init__(self, *args, **kwargs):
         base.VCS.__init__(self, *args, **kwargs)
         self.versioned = True
         # work around http://mercurial.selenic.com/bts/issue618
         self.__updated = []
+        self._command_server = None  # False if it failed to start
+        self._dispatched = 0  # commands run in-process this connection
+        self._manifests = LRUCache(size=_MANIFEST_CACHE_SIZE)
+
+    def __getstate__(self):
+        """Copies start their own command servers.
+        """
+        attrs = dict(self.__dict__)
+        attrs['_command_server'] = None
+        return attrs
 
     @property
     def _vcs_version(self):
@@ -85,6 +218,10 @@ class Hg(base.VCS):
         assert len(kwargs) == 1, kwargs
         fullargs = ['--cwd', kwargs['cwd']]
         fullargs.extend(args)
+        server = self._get_command_server()
+        if server is not None:
+            status,output = server.run(fullargs)
+            return output.rstrip('\n')
         cwd = os.getcwd()
         output = StringIO.StringIO()
         if self >= '1.9':
@@ -98,6 +235,35 @@ class Hg(base.VCS):
         os.chdir(cwd)
         return output.getvalue().rstrip('\n')
 
+    def _get_command_server(self):
+        if not self.command_server or not self.connected \
+                or self._command_server is False:
+            return None
+        if self._command_server is None:
+            if self._dispatched < _COMMAND_SERVER_THRESHOLD:
+                self._dispatched += 1
+                return None
+            executable = probes.find_executable('hg')
+            if executable is None:
+                self._command_server = False
+                return None
+            server = _CommandServer(executable, self.repo, self.encoding)
+            try:
+                server.start()
+            except (OSError, CommandError), e:
+                libbe.LOG.debug('no hg command server: %s', e)
+                self._command_server = False
+                return None
+            self._command_server = server
+        return self._command_server
+
+    def _disconnect(self):
+        if self._command_server:
+            self._command_server.close()
+        self._command_server = None
+        self._dispatched = 0
+        base.VCS._disconnect(self)
+
     @staticmethod
     def _vcs_intalled():  # pylint: disable=no-self-use
         return mercurial is not None
@@ -132,35 +298,91 @@ class Hg(base.VCS):
     def _vcs_remove(self, path):
         self._u_invoke_client('rm', '--force', path)
 
+    def _vcs_remove_many(self, paths, dirs=()):
+        if paths:
+            self._u_invoke_client('rm', '--force', *paths)
+
     def _vcs_update(self, path):
         self.__updated.append(path) # work around http://mercurial.selenic.com/bts/issue618
 
+    def _vcs_add_many(self, paths):
+        paths = [p for p in paths if not os.path.isdir(self._u_abspath(p))]
+        if paths:
+            self._u_invoke_client('add', *paths)
+
     def _vcs_get_file_contents(self, path, revision=None):
         if revision == None:
             return base.VCS._vcs_get_file_contents(self, path, revision)
         else:
             return self._u_invoke_client('cat', '-r', revision, path)
 
+    def _vcs_get_many_file_contents(self, paths, revision=None):
+        if revision == None:
+            return base.VCS._vcs_get_many_file_contents(self, paths, revision)
+        manifest = self._hg_manifest(revision)
+        contents = {}
+        for path in paths:
+            if path in manifest.children:
+                contents[path] = libbe.storage.base.InvalidDirectory
+            elif path not in manifest.files:
+                contents[path] = libbe.util.InvalidObject
+        paths = [path for path in paths if path in manifest.files]
+        if not paths:
+            return contents
+        # one `hg cat` for the lot, writing each file under tempdir
+        tempdir = tempfile.mkdtemp(prefix='be-hg-')
+        try:
+            self._u_invoke_client('cat', '--rev', revision, '--output',
+                                  os.path.join(tempdir, '%p'), *paths)
+            for path in paths:
+                with open(os.path.join(tempdir, path), 'rb') as f:
+                    contents[path] = f.read()
+        finally:
+            shutil.rmtree(tempdir)
+        return contents
+
+    def _hg_manifest(self, revision):
+        """Return the :py:class:`_Manifest` for revision.
+
+        Manifests for revision IDs and numbers are kept for later
+        calls; symbolic revisions like ``tip`` may move, so they are
+        always read again.
+        """
+        manifest = self._manifests.get(revision)
+        if manifest is None:
+            manifest = _Manifest(self._u_invoke_client(
+                    'manifest', '--rev', revision).splitlines())
+            if _REVISION_REGEXP.match(revision):
+                self._manifests[revision] = manifest
+        return manifest
+
+    def _hg_manifest_ids(self, revision):
+        manifest = self._hg_manifest(revision)
+        if manifest.ids is None:
+            manifest.ids = self._u_manifest_ids(manifest.files)
+        return manifest.ids
+
     def _vcs_path(self, id, revision):
-        manifest = self._u_invoke_client(
-            'manifest', '--rev', revision).splitlines()
-        return self._u_find_id_from_manifest(id, manifest, revision=revision)
+        path = self._hg_manifest_ids(revision).get(id)
+        if path is None:
+            raise base.InvalidID(id, revision=revision)
+        return path
+
+    def _vcs_paths(self, ids, revision):
+        paths = self._hg_manifest_ids(revision)
+        return dict((id, paths[id]) for id in ids if id in paths)
 
     def _vcs_isdir(self, path, revision):
-        output = self._u_invoke_client('manifest', '--rev', revision)
-        files = output.splitlines()
-        if path in files:
-            return False
-        return True
+        return path.rstrip(os.path.sep) in self._hg_manifest(revision).children
 
-    def _vcs_listdir(self, path, revision):
-        output = self._u_invoke_client('manifest', '--rev', revision)
-        files = output.splitlines()
+    def _vcs_listfiles(self, path, revision):
         path = path.rstrip(os.path.sep) + os.path.sep
-        descendent_files = [self._u_rel_path(f, path) for f in files
-                            if f.startswith(path)]
-        return sorted(set(
-                f.split(os.path.sep, 1)[0] for f in descendent_files))
+        return [f for f in self._hg_manifest(revision).files
+                if f.startswith(path)]
+
+    def _vcs_listdir(self, path, revision):
+        children = self._hg_manifest(revision).children
+        return sorted(children.get(path.rstrip(os.path.sep), []))
 
     def _vcs_commit(self, commitfile, allow_empty=False):
         args = ['commit', '--logfile', commitfile]
@@ -169,9 +391,14 @@ class Hg(base.VCS):
         strings = ['nothing changed']
         if self._u_any_in_string(strings, output) == True \
                 and len(self.__updated) > 0:
-            time.sleep(1)
-            for path in self.__updated:
-                os.utime(os.path.join(self.repo, path), None)
+            # hg skipped files whose size and mtime match its dirstate,
+            # though they were rewritten within the same second.  Any
+            # other mtime makes it compare their contents.
+            for path in set(self.__updated):
+                path = os.path.join(self.repo, path)
+                if os.path.exists(path):
+                    stat = os.stat(path)
+                    os.utime(path, (stat.st_atime, stat.st_mtime - 1))
             output = self._u_invoke_client(*args)
         self.__updated = []
         # end work around
@@ -195,9 +422,137 @@ class Hg(base.VCS):
         return self._u_invoke_client(
             'diff', '-r', revision, '--git')
 
+    def _vcs_changed(self, revision):
+        output = self._u_invoke_client(
+            'status', '--rev', revision, '--added', '--modified',
+            '--removed', '--deleted', '--print0',
+            self._u_rel_path(self.be_dir))
+        new = set()
+        modified = set()
+        removed = set()
+        for line in output.split('\0'):
+            if not line:
+                continue
+            status,path = line[0], line[2:]
+            if status == 'A':
+                new.add(path)
+            elif status == 'M':
+                modified.add(path)
+            else:  # R (removed) and ! (deleted)
+                removed.add(path)
+        return (new, modified, removed)
+
 
 if libbe.TESTING == True:
     base.make_vcs_testcase_subclasses(Hg, sys.modules[__name__])
 
+    class HgCommandServerTestCase (unittest.TestCase):
+        """Test cases for running commands through the command server."""
+        def setUp(self):
+            if not Hg._vcs_intalled():
+                self.skipTest('hg VCS not found')
+            self.dir = libbe.util.utility.Dir()
+            self.s = Hg(repo=self.dir.path)
+            self.s.init()
+            self.s.connect()
+            self.s._dispatched = _COMMAND_SERVER_THRESHOLD
+
+        def tearDown(self):
+            if Hg._vcs_intalled():
+                self.s.disconnect()
+                self.s.destroy()
+                self.dir.cleanup()
+
+        def test_server_matches_dispatch(self):
+            if self.s._get_command_server() is None:
+                self.skipTest('hg command server not available')
+            self.s.add('abc')
+            self.s.set('abc', 'x\n')
+            revision = self.s.commit('initial')
+            output = self.s._u_invoke_client('manifest', '--rev', revision)
+            self.s.command_server = False
+            self.assertEqual(
+                self.s._u_invoke_client('manifest', '--rev', revision),
+                output)
+            self.assertTrue('.be/abc' in output.splitlines(), output)
+
+        def test_disconnect_stops_server(self):
+            server = self.s._get_command_server()
+            if server is None:
+                self.skipTest('hg command server not available')
+            self.s.disconnect()
+            self.assertEqual(server._popen, None)
+            self.assertEqual(self.s._get_command_server(), None)
+            self.s.connect()
+
+    class HgCommitTestCase (unittest.TestCase):
+        """Test cases for quick successive commits."""
+        def setUp(self):
+            if not Hg._vcs_intalled():
+                self.skipTest('hg VCS not found')
+            self.dir = libbe.util.utility.Dir()
+            self.s = Hg(repo=self.dir.path)
+            self.s.init()
+            self.s.connect()
+
+        def tearDown(self):
+            if Hg._vcs_intalled():
+                self.s.disconnect()
+                self.s.destroy()
+                self.dir.cleanup()
+
+        def test_commit_burst(self):
+            """Edit/commit cycles should not wait for the clock to tick."""
+            self.s.add('a')
+            start = time.time()
+            revisions = []
+            for i in range(50):
+                # same-size values, so only the contents tell them apart
+                self.s.set('a', '%02d' % (i / 2))
+                try:
+                    revisions.append((i / 2, self.s.commit('edit %d' % i)))
+                except base.EmptyCommit:
+                    self.assertEqual(i % 2, 1)
+            elapsed = time.time() - start
+            self.assertEqual(len(revisions), 25)
+            for value,revision in revisions:
+                self.assertEqual(self.s.get('a', revision=revision),
+                                 '%02d' % value)
+            self.assertTrue(elapsed < 25, elapsed)
+
+    class HgManifestTestCase (unittest.TestCase):
+        """Test cases for the per-revision manifest cache."""
+        def setUp(self):
+            if not Hg._vcs_intalled():
+                self.skipTest('hg VCS not found')
+            self.dir = libbe.util.utility.Dir()
+            self.s = Hg(repo=self.dir.path)
+            self.s.init()
+            self.s.connect()
+
+        def tearDown(self):
+            if Hg._vcs_intalled():
+                self.s.disconnect()
+                self.s.destroy()
+                self.dir.cleanup()
+
+        def test_manifest_read_once(self):
+            self.s.add('a', directory=True)
+            for id in ['b', 'c']:
+                self.s.add(id, parent='a')
+                self.s.set(id, id)
+            revision = self.s.commit('initial')
+            calls = []
+            invoke = self.s._u_invoke_client
+            def counting_invoke(*args, **kwargs):
+                calls.append(args[0])
+                return invoke(*args, **kwargs)
+            self.s._u_invoke_client = counting_invoke
+            self.assertEqual(sorted(self.s.children('a', revision=revision)),
+                             ['b', 'c'])
+            self.assertEqual(self.s.get('b', revision=revision), 'b')
+            self.assertEqual(self.s.get('c', revision=revision), 'c')
+            self.assertEqual(calls.count('manifest'), 1)
+
     unitsuite =unittest.TestLoader().loadTestsFromModule(sys.modules[__name__])
     suite = unittest.TestSuite([unitsuite, doctest.DocTestSuite()])
@@ -19,7 +19,13 @@
 # Bugs Everywhere.  If not, see <http://www.gnu.org/licenses/>.
 
 
-"""Classes used by the unified diff parser to keep the diff data."""
+"""Classes used by the unified diff parser to keep the diff data.
+
+:py:func:`parse` reads a diff one line at a time and yields each
+:py:class:`PatchedFile` as soon as it is complete, so large diffs can be
+processed without holding the whole patch in memory.
+:py:class:`PatchSet` collects them into a list.
+"""
 
 from __future__ import unicode_literals
 
@@ -309,6 +315,91 @@ class PatchedFile(list):
         return not (self.is_added_file or self.is_removed_file)
 
 
+def parse(diff, encoding=None):
+    """Yield the :py:class:`PatchedFile`\\ s in the unified diff read
+    line by line from the iterable `diff`.
+
+    If `encoding` is None, the lines are assumed to be unicode.
+
+    >>> lines = iter([
+    ...     '--- a/x\\n', '+++ b/x\\n', '@@ -1 +1 @@\\n', '-1\\n', '+2\\n',
+    ...     '--- /dev/null\\n', '+++ b/y\\n', '@@ -0,0 +1 @@\\n', '+3\\n'])
+    >>> files = parse(lines)
+    >>> patched_file = next(files)
+    >>> str(patched_file.path), patched_file.is_modified_file
+    ('x', True)
+    >>> str(next(lines))  # the rest of the diff has not been read yet
+    '+++ b/y\\n'
+    """
+    current_file = None
+    source_file = source_timestamp = None
+    diff = enumerate(diff, 1)
+    rename = False
+    for _, line in diff:
+        if encoding is not None:
+            line = line.decode(encoding)
+        # check for source file header
+        is_source_filename = RE_SOURCE_FILENAME.match(line)
+        if is_source_filename:
+            source_file = is_source_filename.group('filename')
+            if source_file:
+                rename = False
+            else:
+                source_file = is_source_filename.group('renamefile')
+                rename = True
+            source_timestamp = is_source_filename.group('timestamp')
+            # the previous file is complete
+            if current_file is not None:
+                yield current_file
+            current_file = None
+            continue
+
+        # check for target file header
+        is_target_filename = RE_TARGET_FILENAME.match(line)
+        if is_target_filename:
+            if current_file is not None:
+                raise UnidiffParseError('Target without source: %s' % line)
+            target_file = is_target_filename.group('filename')
+            if not target_file:
+                target_file = is_target_filename.group('renamefile')
+            target_timestamp = is_target_filename.group('timestamp')
+            current_file = PatchedFile(source_file, target_file,
+                                       source_timestamp, target_timestamp,
+                                       rename=rename)
+            continue
+
+        # check for hunk header
+        is_hunk_header = RE_HUNK_HEADER.match(line)
+        if is_hunk_header:
+            if current_file is None:
+                raise UnidiffParseError('Unexpected hunk found: %s' % line)
+            current_file.parse_hunk(line, diff, encoding)
+    if current_file is not None:
+        yield current_file
+
+
+def changed_files(patched_files):
+    """Return the `(added, modified, removed)` sets of paths touched
+    by the iterable `patched_files`, e.g. the output of :py:func:`parse`.
+    """
+    added = set()
+    modified = set()
+    removed = set()
+    for patch in patched_files:
+        if patch.is_renamed_file:
+            removed.add(patch.source_file)
+            added.add(patch.target_file)
+        elif patch.is_added_file:
+            added.add(patch.path)
+        elif patch.is_modified_file:
+            modified.add(patch.path)
+        elif patch.is_removed_file:
+            removed.add(patch.path)
+        else:
+            raise SystemError("This should not happen")
+    return (added, modified, removed)
+
+
 @implements_to_string
 class PatchSet(list):
     """A list of PatchedFiles."""
@@ -327,49 +418,7 @@ class PatchSet(list):
         return '\n'.join(unicode(patched_file) for patched_file in self)
 
     def _parse(self, diff, encoding):
-        current_file = None
-
-        diff = enumerate(diff, 1)
-        rename = False
-        for _, line in diff:
-            if encoding is not None:
-                line = line.decode(encoding)
-            # check for source file header
-            is_source_filename = RE_SOURCE_FILENAME.match(line)
-            if is_source_filename:
-                source_file = is_source_filename.group('filename')
-                if source_file:
-                    rename = False
-                else:
-                    source_file = is_source_filename.group('renamefile')
-                    rename = True
-                source_timestamp = is_source_filename.group('timestamp')
-                # reset current file
-                current_file = None
-                continue
-
-            # check for target file header
-            is_target_filename = RE_TARGET_FILENAME.match(line)
-            if is_target_filename:
-                if current_file is not None:
-                    raise UnidiffParseError('Target without source: %s' % line)
-                target_file = is_target_filename.group('filename')
-                if not target_file:
-                    target_file = is_target_filename.group('renamefile')
-                target_timestamp = is_target_filename.group('timestamp')
-                # add current file to PatchSet
-                current_file = PatchedFile(source_file, target_file,
-                                           source_timestamp, target_timestamp,
-                                           rename=rename)
-                self.append(current_file)
-                continue
-
-            # check for hunk header
-            is_hunk_header = RE_HUNK_HEADER.match(line)
-            if is_hunk_header:
-                if current_file is None:
-                    raise UnidiffParseError('Unexpected hunk found: %s' % line)
-                current_file.parse_hunk(line, diff, encoding)
+        self.extend(parse(diff, encoding=encoding))
 
     @classmethod
     def from_filename(cls, filename, encoding=DEFAULT_ENCODING, errors=None):
@@ -395,23 +444,7 @@ class PatchSet(list):
 
     @property
     def changed_files(self):
-        added = []
-        modified = []
-        removed = []
-        for patch in self:
-            if patch.is_renamed_file:
-                removed.append(patch.source_file)
-                added.append(patch.target_file)
-            elif patch.is_added_file:
-                added.append(patch.path)
-            elif patch.is_modified_file:
-                modified.append(patch.path)
-            elif patch.is_removed_file:
-                removed.append(patch.path)
-            else:
-                raise SystemError("This should not happen")
-
-        return (set(added), set(modified), set(removed))
+        return changed_files(self)
 
     @staticmethod
     def _convert_string(data, encoding=None, errors='strict'):
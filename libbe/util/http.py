@@ -26,16 +26,26 @@
 
 """ Utility module for executing GET & POST HTTP methods """
 
+import errno
+import httplib
+import socket
+import StringIO
 import urllib
 import urllib2
+import urlparse
 
 from libbe import TESTING
 
 if TESTING:
+    import threading
+    import time
     import unittest
 
 HTTP_OK = 200
+HTTP_MOVED_PERMANENTLY = 301
 HTTP_FOUND = 302
+HTTP_SEE_OTHER = 303
+HTTP_NOT_MODIFIED = 304
 HTTP_TEMP_REDIRECT = 307
 HTTP_USER_ERROR = 418
 """Status returned to indicate exceptions on the server side.
@@ -49,6 +59,8 @@ HTTP_VALID = [HTTP_OK, HTTP_FOUND, HTTP_TEMP_REDIRECT, HTTP_USER_ERROR]
 
 USER_AGENT = 'BE-agent'
 
+MAX_REDIRECTS = 10
+
 
 class HTTPError(Exception):
     """ HTTP Error Exception """
@@ -66,8 +78,135 @@ class HTTPError(Exception):
         return self.msg
 
 
+class ConnectionPool (object):
+    """Keep-alive HTTP/1.1 connections for :py:func:`get_post_url`.
+
+    Up to `size` idle connections per host are kept open after each
+    request and reused by later requests, instead of opening a new
+    TCP (and TLS) connection every time.  `timeout` is the socket
+    timeout in seconds.
+
+    A request that fails on a reused connection, which the server may
+    have closed in the meantime, is retried on a new one.  It is only
+    retried if sending it failed, or if the connection was closed
+    before any of the response arrived and the method is idempotent,
+    so that a request the server may have acted on is never repeated.
+    Timeouts are never retried.
+    """
+    idempotent_methods = ['GET', 'HEAD']
+
+    def __init__(self, size=4, timeout=30):
+        self.size = size
+        self.timeout = timeout
+        self._idle = {}  # (scheme, netloc) -> [connection, ...]
+
+    def close(self):
+        """Close all idle connections."""
+        for connections in self._idle.values():
+            for connection in connections:
+                connection.close()
+        self._idle = {}
+
+    def _connect(self, scheme, netloc):
+        if scheme == 'https':
+            connection = httplib.HTTPSConnection(netloc, timeout=self.timeout)
+        elif scheme == 'http':
+            connection = httplib.HTTPConnection(netloc, timeout=self.timeout)
+        else:
+            raise urllib2.URLError(
+                'unsupported URL scheme {}'.format(scheme))
+        connection.connect()
+        # POST headers and bodies are sent separately
+        connection.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        return connection
+
+    def request(self, method, url, body=None, headers=None):
+        """Send a request and return `(response, page)`.
+
+        `response` is the :py:class:`httplib.HTTPResponse`, which has
+        already been read into `page`.
+        """
+        scheme, netloc, path, query, _ = urlparse.urlsplit(url)
+        selector = path or '/'
+        if query:
+            selector = '{}?{}'.format(selector, query)
+        key = (scheme, netloc)
+        idle = self._idle.get(key, [])
+        while True:
+            reused = len(idle) > 0
+            connection = None
+            response = None
+            sent = False
+            try:
+                if reused:
+                    connection = idle.pop()
+                else:
+                    connection = self._connect(scheme, netloc)
+                connection.request(method, selector, body, headers or {})
+                sent = True
+                response = connection.getresponse()
+                page = response.read()
+            except (httplib.HTTPException, socket.error), e:
+                if connection is not None:
+                    connection.close()
+                if reused and not isinstance(e, socket.timeout) and (
+                        not sent or (
+                            response is None and _nothing_received(e)
+                            and method in self.idempotent_methods)):
+                    continue
+                raise urllib2.URLError(e)
+            break
+        if response.will_close:
+            connection.close()
+        else:
+            idle = self._idle.setdefault(key, [])
+            if len(idle) < self.size:
+                idle.append(connection)
+            else:
+                connection.close()
+        return (response, page)
+
+
+def _nothing_received(error):
+    """Return True if `error` means the connection was closed before
+    any of the response arrived.
+    """
+    if isinstance(error, httplib.BadStatusLine):
+        return error.line == "''" or error.line.startswith('No status line')
+    return getattr(error, 'errno', None) in [
+        errno.ECONNRESET, errno.ECONNABORTED, errno.EPIPE]
+
+
+def _pooled_get_post_url(pool, url, data, headers):
+    """Like :py:func:`urllib2.urlopen` for :py:func:`get_post_url`,
+    but through `pool`.  Return `(page, final_url, info)`.
+    """
+    method = 'GET' if data is None else 'POST'
+    if data is not None:
+        headers.setdefault('Content-Type', 'application/x-www-form-urlencoded')
+    for _ in range(MAX_REDIRECTS + 1):
+        response, page = pool.request(method, url, data, headers)
+        location = response.getheader('Location')
+        if response.status in [HTTP_MOVED_PERMANENTLY, HTTP_FOUND,
+                               HTTP_SEE_OTHER, HTTP_TEMP_REDIRECT] \
+                and location:
+            url = urlparse.urljoin(url, location)
+            if response.status != HTTP_TEMP_REDIRECT:
+                method = 'GET'
+                data = None
+                headers.pop('Content-Type', None)
+            continue
+        if not 200 <= response.status < 300:  # as urllib2
+            raise urllib2.HTTPError(
+                url, response.status, response.reason, response.msg,
+                StringIO.StringIO(page))
+        return (page, url, response.msg)
+    raise urllib2.HTTPError(url, response.status, 'too many redirects',
+                            response.msg, StringIO.StringIO(page))
+
+
 def get_post_url(url, get=True, data=None, data_dict=None, headers=None,
-                 agent=None):
+                 agent=None, pool=None):
     """Execute a GET or POST transaction.
 
     Parameters
@@ -85,6 +224,9 @@ def get_post_url(url, get=True, data=None, data_dict=None, headers=None,
       Extra HTTP headers to add to the request.
     agent : str
       User agent string overriding the BE default.
+    pool : ConnectionPool
+      Send the request over one of the pool's keep-alive connections
+      rather than a new connection.
     """
     headers = headers or []
     if agent is None:
@@ -104,8 +246,10 @@ def get_post_url(url, get=True, data=None, data_dict=None, headers=None,
         assert data_dict is None, (data, data_dict)
     headers = dict(headers)
     headers['User-Agent'] = agent
-    req = urllib2.Request(url, data=data, headers=headers)
     try:
+        if pool is not None:
+            return _pooled_get_post_url(pool, url, data, headers)
+        req = urllib2.Request(url, data=data, headers=headers)
         response = urllib2.urlopen(req)
     except urllib2.HTTPError, e:
         if e.code == HTTP_USER_ERROR:
@@ -129,8 +273,133 @@ def get_post_url(url, get=True, data=None, data_dict=None, headers=None,
     return (page, final_url, info)
 
 
+def encode_frames(frames):
+    """Pack a list of `(key, value)` string pairs into one response body.
+
+    Each frame is a header line `LENGTH KEY` followed by `LENGTH`
+    bytes of value.  A value of `None` is sent with a length of -1.
+
+    >>> encode_frames([('a', 'xyz'), ('b c', None), ('d', '')])
+    '3 a\\nxyz-1 b c\\n0 d\\n'
+
+    Unicode keys and values are sent as UTF-8.
+
+    >>> encode_frames([('get', 'caf\\xc3\\xa9'), ('children', u'caf\\xe9')])
+    '5 get\\ncaf\\xc3\\xa95 children\\ncaf\\xc3\\xa9'
+    """
+    body = []
+    for key, value in frames:
+        if isinstance(key, unicode):
+            key = key.encode('utf-8')
+        if isinstance(value, unicode):
+            value = value.encode('utf-8')
+        if value is None:
+            body.append('-1 {}\n'.format(key))
+        else:
+            body.append('{} {}\n'.format(len(value), key))
+            body.append(value)
+    return ''.join(body)
+
+
+def decode_frames(body):
+    """Unpack a response body packed by :py:func:`encode_frames`.
+
+    >>> decode_frames('3 a\\nxyz-1 b c\\n0 d\\n')
+    [('a', 'xyz'), ('b c', None), ('d', '')]
+    """
+    frames = []
+    offset = 0
+    while offset < len(body):
+        end = body.index('\n', offset)
+        length, key = body[offset:end].split(' ', 1)
+        length = int(length)
+        offset = end + 1
+        if length < 0:
+            frames.append((key, None))
+        else:
+            frames.append((key, body[offset:offset+length]))
+            offset += length
+    return frames
+
+
 if TESTING:
 
+    class ConnectionPoolTestCase(unittest.TestCase):
+        """Test cases for ConnectionPool's retries, against a server
+        that answers the first request on each connection and then
+        drops (or hangs on) the next one.
+        """  # pylint: disable=missing-docstring
+
+        def setUp(self):
+            self.listener = socket.socket()
+            self.listener.bind(('localhost', 0))
+            self.listener.listen(5)
+            self.listener.settimeout(0.1)
+            self.url = 'http://localhost:{}/'.format(
+                self.listener.getsockname()[1])
+            self.mode = 'drop'
+            self.requests = []
+            self.stopped = False
+            self.thread = threading.Thread(target=self.serve)
+            self.thread.start()
+            self.pool = ConnectionPool(timeout=0.5)
+
+        def tearDown(self):
+            self.pool.close()
+            self.stopped = True
+            self.thread.join()
+            self.listener.close()
+
+        def serve(self):
+            while not self.stopped:
+                try:
+                    connection, _ = self.listener.accept()
+                except socket.timeout:
+                    continue
+                connection.settimeout(None)
+                stream = connection.makefile('rb')
+                served = False
+                while True:
+                    request_line = stream.readline()
+                    if not request_line:
+                        break
+                    length = 0
+                    line = request_line
+                    while line.strip():
+                        line = stream.readline()
+                        if line.lower().startswith('content-length:'):
+                            length = int(line.split(':', 1)[1])
+                    stream.read(length)
+                    self.requests.append(request_line.split()[0])
+                    if served:
+                        if self.mode == 'hang':
+                            time.sleep(1)
+                        break
+                    connection.sendall('HTTP/1.1 200 OK\r\n'
+                                       'Content-Length: 2\r\n\r\nok')
+                    served = True
+                stream.close()
+                connection.close()
+
+        def test_dropped_get_is_retried(self):
+            self.pool.request('GET', self.url)
+            response, page = self.pool.request('GET', self.url)
+            self.failUnlessEqual(page, 'ok')
+            self.failUnlessEqual(self.requests, ['GET', 'GET', 'GET'])
+
+        def test_dropped_post_is_not_retried(self):
+            self.pool.request('POST', self.url, 'a=1')
+            self.failUnlessRaises(urllib2.URLError, self.pool.request,
+                                  'POST', self.url, 'a=1')
+            self.failUnlessEqual(self.requests, ['POST', 'POST'])
+
+        def test_timeout_is_not_retried(self):
+            self.mode = 'hang'
+            self.pool.request('GET', self.url)
+            self.failUnlessRaises(urllib2.URLError, self.pool.request,
+                                  'GET', self.url)
+            self.failUnlessEqual(self.requests, ['GET', 'GET'])
+
     class GetPostUrlTestCase(unittest.TestCase):
         """Test cases for get_post_url()
         """  # pylint: disable=missing-docstring
@@ -0,0 +1,97 @@
+# Copyright (C) 2026 agent <agent@local>
+#
+# This file is part of Bugs Everywhere.
+#
+# Bugs Everywhere is free software: you can redistribute it and/or modify it
+# under the terms of the GNU General Public License as published by the Free
+# Software Foundation, either version 2 of the License, or (at your option) any
+# later version.
+#
+# Bugs Everywhere is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+# FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General Public License for
+# more details.
+#
+# You should have received a copy of the GNU General Public License along with
+# Bugs Everywhere.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Define :py:class:`LRUCache`, a bounded mapping.
+"""
+
+import collections
+
+
+class LRUCache (object):
+    """A mapping holding at most `size` items, dropping the least
+    recently used item when it grows past that.  If given,
+    `evict(key, value)` is called for each dropped or cleared item,
+    e.g. to release resources held by the value.
+
+    >>> c = LRUCache(size=2)
+    >>> c['a'] = 1
+    >>> c['b'] = 2
+    >>> c['a']
+    1
+    >>> c['c'] = 3
+    >>> sorted(c.keys())
+    ['a', 'c']
+    >>> 'b' in c
+    False
+    >>> c.get('b', 'missing')
+    'missing'
+    >>> len(c)
+    2
+    >>> c.clear()
+    >>> len(c)
+    0
+
+    >>> def evict(key, value):
+    ...     print 'evicting', key
+    >>> c = LRUCache(size=1, evict=evict)
+    >>> c['a'] = 1
+    >>> c['b'] = 2
+    evicting a
+    >>> c.clear()
+    evicting b
+    """
+    def __init__(self, size, evict=None):
+        self.size = size
+        self.evict = evict
+        self._items = collections.OrderedDict()
+
+    def __len__(self):
+        return len(self._items)
+
+    def __contains__(self, key):
+        return key in self._items
+
+    def __getitem__(self, key):
+        value = self._items.pop(key)
+        self._items[key] = value
+        return value
+
+    def __setitem__(self, key, value):
+        self._items.pop(key, None)
+        self._items[key] = value
+        while len(self._items) > self.size:
+            key,value = self._items.popitem(last=False)
+            if self.evict is not None:
+                self.evict(key, value)
+
+    def __delitem__(self, key):
+        del self._items[key]
+
+    def get(self, key, default=None):
+        if key in self._items:
+            return self[key]
+        return default
+
+    def keys(self):
+        return self._items.keys()
+
+    def clear(self):
+        items = self._items.items()
+        self._items.clear()
+        if self.evict is not None:
+            for key,value in items:
+                self.evict(key, value)
@@ -25,6 +25,7 @@ See Also
 :py:mod:`libbe.command.serve_commands`.
 """
 
+import BaseHTTPServer
 import copy
 import hashlib
 import logging
@@ -34,8 +35,11 @@ import os.path
 import re
 import select
 import signal
+import socket
+import SocketServer
 import StringIO
 import sys
+import threading
 import time
 import traceback
 import types
@@ -463,6 +467,12 @@ class WSGI_DataObject (WSGI_Object):
             return []
         return [content]
 
+    def not_modified_response(self, environ, start_response, headers=[]):
+        response = '304 Not Modified'
+        self.log_request(environ, status=response, bytes=0)
+        start_response(response, headers)
+        return []
+
     def query_data(self, environ):
         if not environ['REQUEST_METHOD'] in ['GET', 'HEAD']:
             raise HandlerError(404, 'Not Found')
@@ -585,6 +595,72 @@ class SilentRequestHandler (wsgiref.simple_server.WSGIRequestHandler):
         pass
 
 
+class KeepAliveServerHandler (wsgiref.simple_server.ServerHandler):
+    http_version = '1.1'
+
+    def cleanup_headers(self):
+        wsgiref.simple_server.ServerHandler.cleanup_headers(self)
+        if 'Content-Length' not in self.headers:
+            # the client reads the body until the connection closes
+            self.headers['Connection'] = 'close'
+            self.request_handler.close_connection = 1
+
+
+class KeepAliveRequestHandler (SilentRequestHandler):
+    """Serve several HTTP/1.1 requests per connection.
+
+    The connection is closed when the client asks for it, when a
+    response has no Content-Length (so the client reads it until the
+    connection closes), or after :py:attr:`timeout` idle seconds.
+    """
+    protocol_version = 'HTTP/1.1'
+    timeout = 30  # seconds
+
+    # wsgiref's handler serves a single request per connection
+    handle = BaseHTTPServer.BaseHTTPRequestHandler.handle
+
+    def setup(self):
+        SilentRequestHandler.setup(self)
+        # responses are written in pieces, don't wait for the client's
+        # delayed ACK between them
+        self.connection.setsockopt(
+            socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+    def handle_one_request(self):
+        try:
+            self.raw_requestline = self.rfile.readline(65537)
+        except socket.timeout:
+            self.close_connection = 1
+            return
+        if not self.raw_requestline:
+            self.close_connection = 1
+            return
+        if len(self.raw_requestline) > 65536:
+            self.send_error(414)
+            self.close_connection = 1
+            return
+        if not self.parse_request():
+            return
+        handler = KeepAliveServerHandler(
+            self.rfile, self.wfile, self.get_stderr(), self.get_environ())
+        handler.request_handler = self
+        with self.server.app_lock:
+            handler.run(self.server.get_app())
+
+
+class KeepAliveWSGIServer (SocketServer.ThreadingMixIn,
+                           wsgiref.simple_server.WSGIServer):
+    """Serve each connection in its own thread, so idle keep-alive
+    connections do not block other clients.  The application is only
+    called by one thread at a time.
+    """
+    daemon_threads = True
+
+    def __init__(self, *args, **kwargs):
+        wsgiref.simple_server.WSGIServer.__init__(self, *args, **kwargs)
+        self.app_lock = threading.Lock()
+
+
 class ServerCommand (libbe.command.base.Command):
     """Serve something over HTTP.
 
@@ -734,7 +810,8 @@ class ServerCommand (libbe.command.base.Command):
         else:
             server = wsgiref.simple_server.make_server(
                 params['host'], params['port'], app,
-                handler_class=SilentRequestHandler)
+                server_class=KeepAliveWSGIServer,
+                handler_class=KeepAliveRequestHandler)
         return (server, details)
 
     def _daemonize(self, params):
@@ -1041,6 +1118,56 @@ if libbe.TESTING:
             self.failUnless(self.users.changed == False,
                             self.users.changed)
 
+
+    class KeepAliveServerTestCase (unittest.TestCase):
+        def setUp(self):
+            self.inputs = []
+            def app(environ, start_response):
+                if not [i for i in self.inputs
+                        if i is environ['wsgi.input']]:
+                    self.inputs.append(environ['wsgi.input'])
+                body = environ['PATH_INFO']
+                headers = [('Content-Type', 'text/plain')]
+                if body != '/chunked':
+                    headers.append(('Content-Length', str(len(body))))
+                start_response('200 OK', headers)
+                return list(body)
+            self.server = wsgiref.simple_server.make_server(
+                'localhost', 0, app, server_class=KeepAliveWSGIServer,
+                handler_class=KeepAliveRequestHandler)
+            self.thread = threading.Thread(target=self.server.serve_forever)
+            self.thread.start()
+            self.url = 'http://localhost:{}'.format(self.server.server_port)
+            self.pool = libbe.util.http.ConnectionPool()
+
+        def tearDown(self):
+            self.pool.close()
+            self.server.shutdown()
+            self.thread.join()
+            self.server.server_close()
+
+        def get(self, path):
+            page,final_url,info = libbe.util.http.get_post_url(
+                self.url + path, pool=self.pool)
+            return page
+
+        def test_connection_is_reused(self):
+            for path in ['/a', '/b', '/c']:
+                self.failUnlessEqual(self.get(path), path)
+            self.failUnlessEqual(len(self.inputs), 1)
+
+        def test_unknown_length_closes(self):
+            self.failUnlessEqual(self.get('/chunked'), '/chunked')
+            self.failUnlessEqual(self.get('/a'), '/a')
+            self.failUnlessEqual(len(self.inputs), 2)
+
+        def test_stale_connection_is_retried(self):
+            self.get('/a')
+            for connection in self.pool._idle.values()[0]:
+                connection.sock.shutdown(socket.SHUT_RDWR)
+            self.failUnlessEqual(self.get('/b'), '/b')
+            self.failUnlessEqual(len(self.inputs), 2)
+
     unitsuite =unittest.TestLoader().loadTestsFromModule(sys.modules[__name__])
     suite = unittest.TestSuite([unitsuite, doctest.DocTestSuite()])
 